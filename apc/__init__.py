@@ -1,12 +1,37 @@
 #!/usr/bin/env python
 
-from apc.utility import APC  # noqa
-from apc.utility import APC_DEFAULT_HOST  # noqa
-from apc.utility import APC_DEFAULT_USER  # noqa
-from apc.utility import APC_DEFAULT_PASSWORD  # noqa
+import importlib
+
+# Public names, imported from their module on first use: 'import apc'
+# (and the command line) must not pay for pexpect and the drivers
+_EXPORTS = {
+    'APC':                   'apc.utility',
+    'APC_DEFAULT_HOST':      'apc.defaults',
+    'APC_DEFAULT_USER':      'apc.defaults',
+    'APC_DEFAULT_PASSWORD':  'apc.defaults',
+    'APC_DEFAULT_LOCK_DIR':  'apc.defaults',
+    'APC_DEFAULT_TRANSPORT': 'apc.defaults',
+    'APCSession':            'apc.session',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module 'apc' has no attribute %r" % name)
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
 
 # Release data
-from apc import release
+from apc import release  # noqa: E402
 
 __version__ = release.__version__
 __date__ = release.__date__
@@ -0,0 +1,279 @@
+'''
+asyncio APC driver
+
+Drives the same telnet menus as apc.utility, over native asyncio streams,
+so that a single event loop can talk to many PDUs at once:
+
+    results = asyncio.run(gather_status(hosts, user, password))
+'''
+
+import asyncio
+import re
+import time
+import pexpect
+from apc.lockfile import FlockLock
+from apc.outlet import Outlets
+from apc.telnet import TelnetParser, escape
+from apc.utility import AbstractAPC, driver_class, APC_ESCAPE, APC_YES, APC_LOGOUT
+from apc.utility import APC_MASTER_PATTERN
+from apc.utility import APC_VERSION_PATTERN, APC_DEFAULT_LOCK_DIR, LOCK_TIMEOUT, lock_path
+
+
+APC_TELNET_PORT = 23
+APC_TIMEOUT = 10
+
+# Lock polling interval bounds (seconds): flock(2) cannot be awaited
+LOCK_POLL_MIN = 0.005
+LOCK_POLL_MAX = 0.25
+
+
+class AsyncAPC:
+    '''
+    asyncio counterpart of the APC drivers
+
+    >>> async with AsyncAPC(host, user, password) as apc:
+    ...     await apc.reboot(8)
+    '''
+    def __init__(self, host, user, password, port=APC_TELNET_PORT, quiet=True,
+                 lock_dir=APC_DEFAULT_LOCK_DIR, timeout=APC_TIMEOUT):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.quiet = quiet
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.telnet = TelnetParser()
+        self.buffer = b''
+        self.before = b''
+        self.version = None
+        self.driver = None
+        self.lock = None
+        self.all_outlets = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+    async def _lock(self):
+        self.lock = FlockLock(lock_path(self.host, self.lock_dir))
+        deadline = time.time() + LOCK_TIMEOUT
+        interval = LOCK_POLL_MIN
+        while not self.lock.lock():
+            if time.time() >= deadline:
+                raise SystemError('Cannot acquire %s\n' % self.lock.name)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, LOCK_POLL_MAX)
+
+    async def connect(self):
+        await self._lock()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+
+            await self.expect('User Name : ')
+            self.sendnl(self.user)
+            await self.expect('Password  : ')
+            self.sendnl(self.password)
+            await self.expect('Communication Established')
+        except BaseException:
+            self._close()
+            raise
+
+        match = APC_VERSION_PATTERN.search(str(self.before))
+        if not match:
+            self._close()
+            raise Exception('Could not parse APC version')
+        self.version = match.group(1)
+        self.driver = driver_class(self.version)
+        self.info('Logged in as user %s, version %s' % (self.user, self.version))
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.lock is not None and self.lock.locked:
+            self.lock.unlock()
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        try:
+            self.sendnl(APC_LOGOUT)
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._close()
+        self.info('DISCONNECTED from %s' % self.host)
+
+    def info(self, msg):
+        if not self.quiet:
+            print(msg)
+
+    def send(self, s):
+        self.writer.write(escape(s.encode('utf-8')))
+
+    def sendnl(self, s):
+        self.send(s + '\r\n')
+
+    async def expect(self, pattern, timeout=None):
+        '''
+        Read until pattern matches, like pexpect's expect(): the text
+        before the match is kept in self.before
+        '''
+        regex = re.compile(pattern.encode('utf-8'))
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + (self.timeout if timeout is None else timeout)
+        while True:
+            match = regex.search(self.buffer)
+            if match:
+                self.before = self.buffer[:match.start()]
+                self.buffer = self.buffer[match.end():]
+                return match
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT('Timeout waiting for %r from %s' % (pattern, self.host))
+            try:
+                data = await asyncio.wait_for(self.reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                raise pexpect.TIMEOUT('Timeout waiting for %r from %s' % (pattern, self.host))
+            if not data:
+                raise pexpect.EOF('%s closed the connection' % self.host)
+            payload, reply = self.telnet.feed(data)
+            if reply:
+                self.writer.write(reply)
+            self.buffer += payload
+
+    def _escape_to_main(self, depth=6):
+        self.send(APC_ESCAPE * depth)
+
+    def master_outlet(self):
+        return self.all_outlets
+
+    async def get_outlet(self, outlet):
+        if self.all_outlets is None:
+            # The master control entry follows the last outlet of the list
+            self._select(self.driver.APC_OUTLET_MENU)
+            match = await self.expect(APC_MASTER_PATTERN.pattern)
+            self.all_outlets = int(match.group(1))
+            self._escape_to_main()
+        return AbstractAPC.get_outlet(self, outlet)
+
+    def notify(self, outlet_name, state):
+        self.info('APC %s: %s %s' % (self.host, outlet_name, state))
+
+    def _select(self, keys):
+        for key in keys:
+            self.sendnl(key)
+
+    def control_outlet(self, outlet):
+        self._select(self.driver.APC_OUTLET_MENU + (str(outlet), '1'))
+
+    def configure_outlet(self, outlet):
+        self._select(self.driver.APC_OUTLET_MENU + (str(outlet), '2'))
+
+    async def get_command_result(self):
+        await self.expect(self.driver.APC_COMMAND_RESULT)
+
+    async def status(self):
+        if self.driver.APC_STATUS_MENU is None:
+            raise NotImplementedError()
+        self._select(self.driver.APC_STATUS_MENU)
+        await self.expect(self.driver.APC_STATUS_HEADER)
+        await self.expect('<ESC>')
+        ol_collection = Outlets.parse_table(self.before.decode('utf-8'))
+        if ol_collection:
+            self.all_outlets = max(ol.id for ol in ol_collection) + 1
+        self._escape_to_main()
+        return ol_collection
+
+    async def _command(self, outlet, cmd, confirm=None):
+        self.control_outlet(outlet)
+        self.sendnl(cmd)
+        if confirm is not None:
+            await self.expect(confirm)
+        self.sendnl(APC_YES)
+        self.sendnl('')
+        await self.get_command_result()
+        self._escape_to_main()
+
+    def _check_delays(self):
+        if not hasattr(self.driver, 'configure_outlet'):
+            raise NotImplementedError()
+
+    async def set_power_delay(self, outlet, on, delay):
+        if not (delay == -1 or 0 <= delay <= 7200):
+            raise SystemExit("Power %s Delay Range: -1 to 7200 sec, where -1=Never"
+                             % ('On' if on else 'Off'))
+        self.configure_outlet(outlet)
+        await self.expect('Configure Outlet')
+        self.sendnl('2' if on else '3')  # Power On/Off Delay(sec)
+        self.sendnl(str(delay))
+        self.sendnl('5')  # Accept Changes
+        self._escape_to_main()
+
+    async def set_reboot_duration(self, outlet, duration):
+        if duration < 5 or duration > 60:
+            raise SystemExit("Reboot Duration Range: 5 to 60 sec")
+        self.configure_outlet(outlet)
+        self.sendnl('4')  # Reboot Duration
+        self.sendnl(str(duration))
+        self.sendnl('5')  # Accept Changes
+        self._escape_to_main()
+
+    async def on_off(self, outlet, on, delay=0):
+        (outlet, outlet_name) = await self.get_outlet(outlet)
+        str_cmd = 'On' if on else 'Off'
+        if delay == 0:
+            cmd = self.driver.APC_IMMEDIATE_ON if on else self.driver.APC_IMMEDIATE_OFF
+            await self._command(outlet, cmd)
+            self.notify(outlet_name, str_cmd)
+        else:
+            self._check_delays()
+            await self.set_power_delay(outlet, on, delay)
+            cmd = self.driver.APC_DELAYED_ON if on else self.driver.APC_DELAYED_OFF
+            await self._command(outlet, cmd)
+            self.notify(outlet_name, "Delayed %s (%d s)" % (str_cmd, delay))
+
+    async def on(self, outlet, delay=0):
+        await self.on_off(outlet, True, delay)
+
+    async def off(self, outlet, delay=0):
+        await self.on_off(outlet, False, delay)
+
+    async def reboot(self, outlet, delay=0, duration=5):
+        (outlet, outlet_name) = await self.get_outlet(outlet)
+        if delay == 0:
+            if hasattr(self.driver, 'configure_outlet'):
+                await self.set_reboot_duration(outlet, duration)
+            await self._command(outlet, self.driver.APC_IMMEDIATE_REBOOT, 'Immediate Reboot')
+            self.notify(outlet_name, 'Rebooted')
+        else:
+            self._check_delays()
+            await self.set_reboot_duration(outlet, duration)
+            await self.set_power_delay(outlet, False, delay)
+            await self.set_power_delay(outlet, True, delay)
+            await self._command(outlet, self.driver.APC_DELAYED_REBOOT, 'Delayed Reboot')
+            self.notify(outlet_name, "Delayed reboot (delay=%d duration=%d)" % (delay, duration))
+
+
+async def _status(host, user, password, **kwargs):
+    async with AsyncAPC(host, user, password, **kwargs) as apc:
+        return await apc.status()
+
+
+async def gather_status(hosts, user, password, **kwargs):
+    '''
+    Status of many PDUs at once
+
+    @return: dict host -> Outlets, or the exception raised for that host
+    '''
+    results = await asyncio.gather(*[_status(host, user, password, **kwargs) for host in hosts],
+                                   return_exceptions=True)
+    return dict(zip(hosts, results))
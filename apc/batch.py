@@ -0,0 +1,79 @@
+'''
+Batch outlet operations
+
+Runs several actions on lists of outlets over a single APC session:
+
+    off 1,3 ; reboot 5-8
+'''
+
+BATCH_ACTIONS = ('on', 'off', 'reboot')
+
+OUTLET_ALL_ALIASES = ('*', '+')
+
+
+class BatchParseException(Exception):
+    pass
+
+
+def parse_outlets(spec):
+    '''
+    Outlets of a list like '1,3,5-8', in order and without duplicates
+    '''
+    outlets = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item in OUTLET_ALL_ALIASES:
+            outlets.append(item)
+            continue
+        try:
+            if '-' in item:
+                first, last = [int(s) for s in item.split('-', 1)]
+                if first > last:
+                    raise ValueError()
+                outlets.extend(range(first, last + 1))
+            else:
+                outlets.append(int(item))
+        except ValueError:
+            raise BatchParseException('Bad outlet: [%s]' % item)
+    unique = []
+    for outlet in outlets:
+        if outlet not in unique:
+            unique.append(outlet)
+    return unique
+
+
+def parse_batch(s):
+    '''
+    Steps of a batch like 'off 1,3 ; reboot 5-8'
+
+    @return: list of (action, outlets)
+    '''
+    steps = []
+    for step in s.split(';'):
+        step = step.strip()
+        if not step:
+            continue
+        words = step.split(None, 1)
+        if len(words) != 2 or words[0].lower() not in BATCH_ACTIONS:
+            raise BatchParseException('Bad batch step: [%s]' % step)
+        steps.append((words[0].lower(), parse_outlets(words[1])))
+    if not steps:
+        raise BatchParseException('Empty batch')
+    return steps
+
+
+def run_batch(apc, steps, delay=0, duration=5):
+    '''
+    Run the steps in order on apc (a driver, an APCSession or an APCClient)
+
+    @return: list of the results of the commands, in order (the scheduled
+        jobs of the daemon for delayed commands through an APCClient)
+    '''
+    results = []
+    for action, outlets in steps:
+        for outlet in outlets:
+            if action == 'reboot':
+                results.append(apc.reboot(outlet, delay, duration))
+            else:
+                results.append(getattr(apc, action)(outlet, delay))
+    return results
@@ -0,0 +1,215 @@
+'''
+Benchmarks of the APC drivers
+
+Replays recorded sessions (see apc.transcript) to each firmware driver
+and reports, per operation, the wall time, the keystrokes and bytes sent,
+the bytes read and the time spent parsing the status table:
+
+    $ python -m apc.benchmark --speed 0            # as fast as possible
+    $ python -m apc.benchmark --speed 1 --json > baseline.json
+    $ python -m apc.benchmark --baseline baseline.json
+
+--record captures the transcripts again, from the emulator by default.
+With --baseline, the exit status is 1 if an operation got slower than
+the tolerance allows, or sends or reads more than before.
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from apc.outlet import OutletStreamParser
+from apc.transcript import ReplaySpawn, read_transcript
+from apc.utility import APCFactory, driver_class
+
+
+BENCHMARK_TRANSCRIPTS = os.path.join('benchmarks', 'transcripts')
+BENCHMARK_FIRMWARES   = ('2.7.0', '2.5.4', '3.7.4')
+BENCHMARK_REPEAT      = 5
+BENCHMARK_TOLERANCE   = 0.2
+
+BENCHMARK_OPERATIONS = [
+    ('status', lambda apc: apc.status()),
+    ('on', lambda apc: apc.on(3, 0)),
+    ('off', lambda apc: apc.off(3, 0)),
+    ('reboot', lambda apc: apc.reboot(3, 0, 5)),
+    ('delayed-reboot', lambda apc: apc.reboot(3, 10, 5)),
+]
+
+EMULATOR_CLI = '%s -m apc.emulator --stdio --firmware {firmware} --latency {latency}'
+
+
+def transcript_path(directory, firmware, operation):
+    return os.path.join(directory, '%s-%s.jsonl' % (firmware, operation))
+
+
+def record(directory, firmwares=BENCHMARK_FIRMWARES, cli=None, latency=0.05,
+           user='apc', password='apc', quiet=True):
+    '''
+    Record a session per firmware and operation, skipping the operations
+    a driver does not implement
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    lock_dir = tempfile.gettempdir()
+    for firmware in firmwares:
+        commandline = (cli or EMULATOR_CLI % sys.executable).format(
+            firmware=firmware, latency=latency, host='{host}', user='{user}',
+            password='{password}')
+        for name, operation in BENCHMARK_OPERATIONS:
+            path = transcript_path(directory, firmware, name)
+            apc = APCFactory().build('benchmark-%s' % firmware, user, password, False, True,
+                                     commandline, lock_dir, record=path)
+            apc.skip_unchanged = False  # the emulated outlets start on
+            try:
+                operation(apc)
+            except NotImplementedError:
+                apc.child.logfile_read = apc.child.logfile_send = None
+                os.unlink(path)
+                if not quiet:
+                    print('%s: %s not implemented' % (firmware, name))
+                continue
+            finally:
+                apc.disconnect()
+            if not quiet:
+                print('Recorded %s' % path)
+
+
+def _parse_time(firmware, events):
+    '''
+    Time to parse the status table received in events, chunk by chunk
+    '''
+    parser = OutletStreamParser(driver_class(firmware).APC_STATUS_HEADER)
+    start = time.time()
+    for (t, kind, data) in events:
+        if kind == 'recv':
+            parser.feed(data)
+    return time.time() - start
+
+
+def replay(events, operation, speed=None):
+    '''
+    Replay a session, timing operation alone (not the login and logout)
+
+    @return: dict of the measures
+    '''
+    child = ReplaySpawn(events, speed)
+    apc = APCFactory().build('replay', 'apc', 'apc', False, True, '', tempfile.gettempdir(),
+                             child=child)
+    apc.skip_unchanged = False  # as recorded
+    try:
+        keystrokes, bytes_sent, bytes_read = child.keystrokes, child.bytes_sent, child.bytes_read
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.time()
+            operation(apc)  # notifications to devnull
+            wall = time.time() - start
+        return {'driver': apc.__class__.__name__,
+                'wall': wall,
+                'keystrokes': child.keystrokes - keystrokes,
+                'bytes_sent': child.bytes_sent - bytes_sent,
+                'bytes_read': child.bytes_read - bytes_read}
+    finally:
+        apc.disconnect()
+
+
+def run(directory, firmwares=BENCHMARK_FIRMWARES, speed=None, repeat=BENCHMARK_REPEAT):
+    '''
+    @return: list of result dicts, the wall time being the best of repeat
+    '''
+    results = []
+    for firmware in firmwares:
+        for name, operation in BENCHMARK_OPERATIONS:
+            path = transcript_path(directory, firmware, name)
+            if not os.path.exists(path):
+                continue
+            events = read_transcript(path)
+            runs = [replay(events, operation, speed) for i in range(repeat)]
+            result = dict(runs[0])
+            result.update({'firmware': firmware, 'operation': name,
+                           'wall': min(r['wall'] for r in runs),
+                           'parse': _parse_time(firmware, events) if name == 'status' else 0})
+            results.append(result)
+    return results
+
+
+def format_results(results):
+    lines = ['%-8s %-7s %-15s %9s %5s %6s %7s %8s'
+             % ('firmware', 'driver', 'operation', 'wall ms', 'keys', 'sent', 'read', 'parse ms')]
+    for r in results:
+        lines.append('%-8s %-7s %-15s %9.2f %5d %6d %7d %8.3f'
+                     % (r['firmware'], r['driver'], r['operation'], r['wall'] * 1000,
+                        r['keystrokes'], r['bytes_sent'], r['bytes_read'], r['parse'] * 1000))
+    return '\n'.join(lines)
+
+
+def regressions(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    '''
+    @return: list of messages, one per measure worse than in baseline
+    '''
+    previous = dict(((r['firmware'], r['operation']), r) for r in baseline)
+    messages = []
+    for r in results:
+        old = previous.get((r['firmware'], r['operation']))
+        if old is None:
+            continue
+        name = '%s %s' % (r['firmware'], r['operation'])
+        if r['wall'] > old['wall'] * (1 + tolerance):
+            messages.append('%s: %.2f ms, was %.2f ms'
+                            % (name, r['wall'] * 1000, old['wall'] * 1000))
+        for key in ('keystrokes', 'bytes_sent', 'bytes_read'):
+            if r[key] > old[key]:
+                messages.append('%s: %d %s, was %d' % (name, r[key], key, old[key]))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='APC driver benchmarks')
+    parser.add_argument('--transcripts', action='store', default=BENCHMARK_TRANSCRIPTS,
+                        help='Directory of the recorded sessions')
+    parser.add_argument('--firmware', action='append',
+                        help='Firmware to benchmark (default: %s)' % ', '.join(BENCHMARK_FIRMWARES))
+    parser.add_argument('--speed', action='store', type=float, default=0,
+                        help='Replay speed: 1 = as recorded, 0 = no waiting')
+    parser.add_argument('--repeat', action='store', type=int, default=BENCHMARK_REPEAT,
+                        help='Runs of each operation, the best one is reported')
+    parser.add_argument('--json', action='store_true',
+                        help='JSON output')
+    parser.add_argument('--baseline', action='store', metavar='FILE',
+                        help='Compare with the JSON output of a previous run')
+    parser.add_argument('--tolerance', action='store', type=float, default=BENCHMARK_TOLERANCE,
+                        help='Allowed slowdown against the baseline (0.2 = 20%%)')
+    parser.add_argument('--record', action='store_true',
+                        help='Record the sessions again instead of replaying them')
+    parser.add_argument('--cli', action='store',
+                        help='With --record, command line of the PDU session '
+                             "(default: the emulator), e.g. 'telnet {host}'")
+    parser.add_argument('--latency', action='store', type=float, default=0.05,
+                        help='With --record, latency of the emulator')
+
+    args = parser.parse_args()
+    firmwares = args.firmware or BENCHMARK_FIRMWARES
+
+    if args.record:
+        record(args.transcripts, firmwares, args.cli, args.latency, quiet=False)
+        return
+
+    results = run(args.transcripts, firmwares, args.speed or None, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            messages = regressions(results, json.load(f), args.tolerance)
+        for message in messages:
+            sys.stderr.write('REGRESSION %s\n' % message)
+        if messages:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 
+# Only what the parser needs is imported here: each command imports its
+# modules, so that pexpect and the drivers are loaded only when a PDU is
+# connected to directly
 from argparse import ArgumentParser
-import pexpect
-from apc import APC
-from apc import APC_DEFAULT_HOST, APC_DEFAULT_USER, APC_DEFAULT_PASSWORD
+import contextlib
+import os
+import sys
+from apc import defaults
+from apc.defaults import APC_DEFAULT_HOST, APC_DEFAULT_USER, APC_DEFAULT_PASSWORD
+from apc.defaults import APC_DEFAULT_LOCK_DIR, APC_DEFAULT_SOCKET, APC_DEFAULT_TRANSPORT
+from apc.defaults import FLEET_WORKERS, SEQUENCE_GAP, TRANSPORTS, WAIT_TIMEOUT
+from apc.batch import BatchParseException, parse_batch, parse_outlets, run_batch
 
 
 def main():
     parser = ArgumentParser(description='APC Python CLI')
     parser.add_argument('--host', action='store', default=APC_DEFAULT_HOST,
-                        help='Override the host')
+                        help='Override the host (comma separated hosts for --status)')
     parser.add_argument('--user', action='store', default=APC_DEFAULT_USER,
                         help='Override the username')
     parser.add_argument('--password', action='store', default=APC_DEFAULT_PASSWORD,
@@ -22,55 +30,407 @@ def main():
     parser.add_argument('--debug', action='store_true',
                         help='Debug mode')
     parser.add_argument('--reboot', action='store',
-                        metavar='OUTLET',
-                        help='Reboot an outlet')
+                        metavar='OUTLETS',
+                        help='Reboot outlets (e.g. 4 or 1,3,5-8)')
     parser.add_argument('--off', action='store',
-                        metavar='OUTLET',
-                        help='Turn off an outlet')
+                        metavar='OUTLETS',
+                        help='Turn off outlets (e.g. 4 or 1,3,5-8)')
     parser.add_argument('--on', action='store',
-                        metavar='OUTLET',
-                        help='Turn on an outlet')
+                        metavar='OUTLETS',
+                        help='Turn on outlets (e.g. 4 or 1,3,5-8)')
     parser.add_argument('--cli', action='store', default='',
                         help="command line to execute 'ssh {user}@{host}' or 'telnet {host}")
+    parser.add_argument('--transport', action='store', choices=TRANSPORTS,
+                        default=APC_DEFAULT_TRANSPORT,
+                        help='In-process connection, unless --cli is given (HOST may be '
+                             'HOST:PORT, or TRANSPORT://HOST)')
+    parser.add_argument('--accept-new-host-keys', action='store_true',
+                        help='With --transport ssh, accept the host keys missing from '
+                             'known_hosts (rejected by default)')
     parser.add_argument('--delay', action='store', default=0,
                         help='delay before on/off (-1 to 7200 sec, where -1=Never)')
     parser.add_argument('--duration', action='store', default=5,
                         help='reboot duration (5 to 60 sec)')
     parser.add_argument('--status', action='store_true',
                         help='Status of outlets')
+    parser.add_argument('--wait', action='store', nargs='?', type=float, const=WAIT_TIMEOUT,
+                        metavar='SECONDS',
+                        help='After each action, wait until its outlets are settled '
+                             '(default at most %d seconds)' % WAIT_TIMEOUT)
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep the session open and print each outlet state change '
+                             'as a JSON line')
+    parser.add_argument('--max-interval', action='store', type=float,
+                        help='With --watch, longest time between two reads of a stable '
+                             'table (default 30 seconds)')
+    parser.add_argument('--lock-dir', action='store', default=APC_DEFAULT_LOCK_DIR,
+                        help='Directory of the per-host lock files')
+    parser.add_argument('--deadline', action='store', type=float, metavar='SECONDS',
+                        help='Give up a PDU after SECONDS, lock wait, connection, login '
+                             'and commands included')
+    parser.add_argument('--no-breaker', action='store_true',
+                        help='Try PDUs even when they were unreachable the last times '
+                             '(see apc.health)')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run the APC daemon, keeping PDU sessions open')
+    parser.add_argument('--status-ttl', action='store', type=float, default=0,
+                        help='With --serve, seconds a status is reused (0 = always read it)')
+    parser.add_argument('--history', action='store', metavar='DIR',
+                        help='With --serve, record the outlet states read in DIR')
+    parser.add_argument('--history-days', action='store', type=float, metavar='DAYS',
+                        help='With --history, forget the changes older than DAYS days '
+                             '(default: keep them all)')
+    parser.add_argument('--socket', action='store', nargs='?', const=APC_DEFAULT_SOCKET,
+                        help='Send commands through the APC daemon listening on SOCKET')
+    parser.add_argument('--schedule', action='store', metavar='FILE',
+                        help='With --serve, keep the delayed commands in FILE across restarts')
+    parser.add_argument('--jobs', action='store_true',
+                        help='List the delayed commands pending in the daemon (--socket)')
+    parser.add_argument('--cancel', action='store', type=int, metavar='JOB',
+                        help='Cancel a delayed command pending in the daemon (--socket)')
+    parser.add_argument('--batch', action='store',
+                        help="Several actions in one session, e.g. 'off 1,3 ; reboot 5-8'")
+    parser.add_argument('--inventory', action='store', metavar='FILE',
+                        help='Status of all the hosts listed in FILE')
+    parser.add_argument('--workers', action='store', type=int, default=FLEET_WORKERS,
+                        help='Number of hosts queried in parallel')
+    parser.add_argument('--json', action='store_true',
+                        help='JSON output for --status')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the time spent in each phase (lock, login, menus...)')
+    parser.add_argument('--metrics', action='store', metavar='FILE',
+                        help='Write the phase timings to FILE in Prometheus text format')
+    parser.add_argument('--record', action='store', metavar='FILE',
+                        help='Record the PDU session in FILE (see apc.benchmark)')
+    parser.add_argument('--sequence', action='store', metavar='PLAN',
+                        help='Run the staggered power plan in file PLAN (see apc.sequence)')
+    parser.add_argument('--gap', action='store', type=float, default=SEQUENCE_GAP,
+                        help='With --sequence, seconds between the commands on a circuit '
+                             'the plan does not declare')
 
     args = parser.parse_args()
 
-    is_command_specified = (args.reboot or args.debug or args.on or args.off or args.status)
+    is_command_specified = any([args.reboot, args.debug, args.on, args.off, args.status,
+                                args.serve, args.batch, args.sequence, args.jobs,
+                                args.cancel is not None, args.watch])
 
     if not is_command_specified:
         parser.print_usage()
         raise SystemExit(1)
 
+    if args.accept_new_host_keys:
+        defaults.APC_SSH_ACCEPT_NEW_HOST_KEYS = True
+
+    if args.serve:
+        from apc.daemon import serve
+        serve(args.socket or APC_DEFAULT_SOCKET, args.verbose, args.quiet, args.lock_dir,
+              args.status_ttl, args.history, args.metrics, args.schedule,
+              args.history_days * 24 * 3600 if args.history_days is not None else None)
+        return
+
+    if args.jobs or args.cancel is not None:
+        manage_jobs(args)
+        return
+
+    if args.sequence:
+        run_sequence(args)
+        return
+
+    if args.watch:
+        run_watch(args)
+        return
+
     try:
-        apc = APC(args.host, args.user, args.password, args.verbose, args.quiet, args.cli)
-    except pexpect.TIMEOUT as e:
-        raise SystemExit('ERROR: Timeout connecting to APC')
+        if args.batch:
+            steps = parse_batch(args.batch)
+        elif args.reboot:
+            steps = [('reboot', parse_outlets(args.reboot))]
+        elif args.on:
+            steps = [('on', parse_outlets(args.on))]
+        elif args.off:
+            steps = [('off', parse_outlets(args.off))]
+        else:
+            steps = []
+    except BatchParseException as e:
+        raise SystemExit('ERROR: %s' % e)
+
+    timings = None
+    if args.timings or args.metrics:
+        from apc.timing import Timings
+        timings = Timings()
+
+    hosts = args.host.split(',')
+    if args.inventory:
+        from apc.fleet import read_inventory
+        hosts = read_inventory(args.inventory)
+    if len(hosts) > 1 or args.inventory:
+        if not args.status:
+            raise SystemExit('ERROR: several hosts are only supported with --status')
+        status_fleet(args, hosts, timings)
+        return
 
     args.delay = int(args.delay)
     args.duration = int(args.duration)
 
+    if args.socket:
+        run_client(args, steps, timings)
+    else:
+        run_direct(args, steps, timings)
+
+
+def run_client(args, steps, timings=None):
+    '''
+    Run the command through the APC daemon
+    '''
+    from apc.client import APCClient, APCDaemonError
+    if args.debug:
+        raise SystemExit('ERROR: --debug needs a direct connection, not --socket')
+    if timings is not None:
+        raise SystemExit('ERROR: timings need a direct connection, not --socket')
+    apc = APCClient(args.host, args.user, args.password, args.cli, args.socket,
+                    args.transport)
+    try:
+        lines = run_steps(args, apc, steps)
+    except APCDaemonError as e:
+        raise SystemExit('APC daemon failed: %s' % e)
+    except OSError as e:
+        raise SystemExit('Cannot reach APC daemon on %s: %s' % (args.socket, e))
+    else:
+        # Outside the handlers: a broken stdout is not the daemon's fault
+        for line in lines:
+            print(line)
+    finally:
+        apc.disconnect()
+
+
+def format_job(job):
+    '''
+    Line of a delayed command of the daemon: id, due time, host, command
+    '''
+    import time
+    return '%5d %s %-20s %-6s %s' % (
+        job['id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['due'])),
+        job['host'], job['op'], job['args'][0])
+
+
+def scheduled_jobs(results):
+    '''
+    Lines of the jobs the daemon scheduled for delayed commands
+    '''
+    return [format_job(result) for result in results
+            if isinstance(result, dict) and 'due' in result]
+
+
+def manage_jobs(args):
+    '''
+    List or cancel the delayed commands of the daemon
+    '''
+    import json
+    from apc.client import APCClient, APCDaemonError
+    if not args.socket:
+        raise SystemExit('ERROR: delayed commands are kept by the daemon, use --socket')
+    client = APCClient(args.host, args.user, args.password, args.cli, args.socket,
+                       args.transport)
+    try:
+        if args.cancel is not None:
+            jobs = [client.cancel(args.cancel)]
+        else:
+            jobs = client.jobs()
+    except APCDaemonError as e:
+        raise SystemExit('APC daemon failed: %s' % e)
+    except OSError as e:
+        raise SystemExit('Cannot reach APC daemon on %s: %s' % (args.socket, e))
+    finally:
+        client.disconnect()
+    if args.json:
+        print(json.dumps(jobs, indent=2))
+        return
+    for job in jobs:
+        print(format_job(job) + (' (cancelled)' if args.cancel is not None else ''))
+
+
+def run_direct(args, steps, timings=None):
+    '''
+    Run the command in a session of our own
+    '''
+    import pexpect
+    from apc.transport import TransportError
+    from apc.utility import APC, APCDeadlineError
+    try:
+        apc = APC(args.host, args.user, args.password, args.verbose, args.quiet, args.cli,
+                  args.lock_dir, args.record, timings, args.transport, health_tracker(args),
+                  args.deadline)
+    except APCDeadlineError as e:
+        report_timings(args, timings)
+        raise SystemExit('ERROR: %s' % e)
+    except pexpect.TIMEOUT as e:
+        report_timings(args, timings)
+        raise SystemExit('ERROR: Timeout connecting to APC')
+    except TransportError as e:
+        report_timings(args, timings)
+        raise SystemExit('ERROR: %s' % e)
+
     if args.debug:
         apc.debug()
+        return
+    try:
+        lines = run_steps(args, apc, steps)
+    except pexpect.TIMEOUT as e:
+        raise SystemExit('APC failed!  Pexpect result:\n%s' % e)
+    except TransportError as e:
+        raise SystemExit('APC failed: %s' % e)
+    else:
+        for line in lines:
+            print(line)
+    finally:
+        apc.disconnect()
+        report_timings(args, timings)
+
+
+def run_steps(args, apc, steps):
+    '''
+    Run the steps on apc, or read its status
+
+    @return: list of the lines to print
+    '''
+    lines = []
+    if steps and args.wait:
+        from apc.watch import WaitTimeout, wait_settled
+        for (action, outlets) in steps:
+            lines += scheduled_jobs(run_batch(apc, [(action, outlets)], args.delay,
+                                              args.duration))
+            try:
+                wait_settled(apc, outlets, action != 'off', args.wait,
+                             rebooted=action == 'reboot',
+                             duration=args.duration + max(args.delay, 0))
+            except WaitTimeout as e:
+                raise SystemExit('ERROR: %s' % e)
+    elif steps:
+        lines += scheduled_jobs(run_batch(apc, steps, args.delay, args.duration))
+    elif args.status:
+        ols = apc.status()
+        if args.json:
+            from apc.fleet import format_json
+            lines.append(format_json({args.host: ols}))
+        else:
+            lines.append(str(ols))
+    return lines
+
+
+def run_sequence(args):
+    '''
+    Run a power plan, a session per PDU (through the daemon with --socket)
+    '''
+    from apc.sequence import (Sequencer, SequenceParseException, format_event,
+                              format_timeline_json, read_plan)
+    try:
+        steps, circuits = read_plan(args.sequence)
+    except (SequenceParseException, OSError) as e:
+        raise SystemExit('ERROR: %s' % e)
+
+    def connect(host):
+        if args.socket:
+            from apc.client import APCClient
+            return APCClient(host, args.user, args.password, args.cli, args.socket,
+                             args.transport)
+        from apc.session import APCSession
+        session = APCSession(host, args.user, args.password, args.verbose, True, args.cli,
+                             args.lock_dir, transport=args.transport,
+                             health=health_tracker(args), deadline=args.deadline)
+        session.connect()
+        return session
+
+    def progress(event):
+        if not args.quiet and not args.json:
+            print(format_event(event))
+            sys.stdout.flush()
+
+    sequencer = Sequencer(connect, circuits, gap=args.gap, duration=int(args.duration),
+                          progress=progress)
+    # The notifications of the drivers would garble the JSON timeline
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull if args.quiet or args.json else sys.stdout):
+            timeline = sequencer.run(steps)
+    if args.json:
+        print(format_timeline_json(timeline))
+    failed = [event for event in timeline if event['error']]
+    if len(timeline) < len(steps):
+        sys.stderr.write('%d steps not run after a failure\n' % (len(steps) - len(timeline)))
+    if failed or len(timeline) < len(steps):
+        raise SystemExit(1)
+
+
+def run_watch(args):
+    '''
+    Print the outlet state changes of the host until interrupted
+    '''
+    import pexpect
+    from apc.client import APCDaemonError
+    from apc.transport import TransportError
+    from apc.watch import WATCH_MAX_INTERVAL, Watcher, format_event
+    if ',' in args.host or args.inventory:
+        raise SystemExit('ERROR: --watch follows a single host')
+    if args.socket:
+        from apc.client import APCClient
+        session = APCClient(args.host, args.user, args.password, args.cli, args.socket,
+                            args.transport)
     else:
-        try:
-            if args.reboot:
-                apc.reboot(args.reboot, args.delay, args.duration)
-            elif args.on:
-                apc.on(args.on, args.delay)
-            elif args.off:
-                apc.off(args.off, args.delay)
-            elif args.status:
-                print(apc.status())
-        except pexpect.TIMEOUT as e:
-            raise SystemExit('APC failed!  Pexpect result:\n%s' % e)
-        finally:
-            apc.disconnect()
+        from apc.session import APCSession
+        session = APCSession(args.host, args.user, args.password, args.verbose, True,
+                             args.cli, args.lock_dir, transport=args.transport,
+                             health=health_tracker(args), deadline=args.deadline)
+    watcher = Watcher(session, args.host,
+                      max_interval=args.max_interval or WATCH_MAX_INTERVAL)
+    try:
+        for event in watcher:
+            print(format_event(event))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except pexpect.TIMEOUT:
+        raise SystemExit('ERROR: Timeout reading the status of %s' % args.host)
+    except pexpect.EOF:
+        raise SystemExit('ERROR: Connection to %s closed' % args.host)
+    except (TransportError, APCDaemonError, OSError) as e:
+        raise SystemExit('ERROR: %s' % e)
+    finally:
+        close = getattr(session, 'close', None) or session.disconnect
+        close()
+
+
+def status_fleet(args, hosts, timings=None):
+    from apc.fleet import FLEET_TIMEOUT, fleet_status, format_json, format_table
+    results = fleet_status(hosts, args.user, args.password, args.workers,
+                           args.deadline or FLEET_TIMEOUT, cli=args.cli,
+                           lock_dir=args.lock_dir, timings=timings, transport=args.transport,
+                           health=health_tracker(args))
+    if args.json:
+        print(format_json(results))
+    else:
+        print(format_table(results))
+    report_timings(args, timings)
+    if any(isinstance(result, BaseException) for result in results.values()):
+        raise SystemExit(1)
+
+
+def health_tracker(args):
+    '''
+    Circuit breaker of the PDUs, shared by the commands using the same
+    lock directory
+    '''
+    if args.no_breaker:
+        return None
+    from apc.health import HealthTracker, health_path
+    return HealthTracker(health_path(args.lock_dir))
+
+
+def report_timings(args, timings):
+    if timings is None:
+        return
+    if args.timings:
+        sys.stderr.write((timings.format_json() if args.json else timings.format_table()) + '\n')
+    if args.metrics:
+        timings.write_textfile(args.metrics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+'''
+Client of the APC daemon (see apc.daemon)
+
+Only needs the standard library: commands sent through the daemon load
+neither pexpect nor the drivers.
+'''
+
+import json
+import socket
+from apc.defaults import APC_DEFAULT_SOCKET, APC_DEFAULT_TRANSPORT
+from apc.outlet import Outlets, OutletStatus
+
+
+class APCDaemonError(Exception):
+    pass
+
+
+class APCClient:
+    '''
+    Client of the APC daemon, with the same interface as APCSession
+    '''
+    def __init__(self, host, user, password, cli='', socket_path=APC_DEFAULT_SOCKET,
+                 transport=APC_DEFAULT_TRANSPORT):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.cli = cli
+        self.transport = transport
+        self.socket_path = socket_path
+        self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def request(self, op, *args):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+            self.rfile = self.sock.makefile('rb')
+        request = {'host': self.host, 'user': self.user, 'password': self.password,
+                   'cli': self.cli, 'transport': self.transport, 'op': op,
+                   'args': list(args)}
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = self.rfile.readline()
+        if not line:
+            raise APCDaemonError('APC daemon closed the connection')
+        reply = json.loads(line.decode('utf-8'))
+        if not reply['ok']:
+            raise APCDaemonError(reply['error'])
+        return reply['result']
+
+    def status(self):
+        return Outlets.from_list(self.request('status'))
+
+    def read_status(self):
+        return Outlets.from_list(self.request('read_status'))
+
+    # The commands return the OutletStatus read once they are issued or,
+    # with a delay, the job the daemon keeps for them
+    def command(self, op, *args):
+        result = self.request(op, *args)
+        if isinstance(result, str):
+            return OutletStatus.parse(result)
+        return result
+
+    def on(self, outlet, delay=0):
+        return self.command('on', outlet, delay)
+
+    def off(self, outlet, delay=0):
+        return self.command('off', outlet, delay)
+
+    def reboot(self, outlet, delay=0, duration=5):
+        return self.command('reboot', outlet, delay, duration)
+
+    def jobs(self):
+        '''
+        Pending delayed commands of the daemon, all hosts together
+
+        @return: list of dicts (id, due, host, op, args)
+        '''
+        return self.request('jobs')
+
+    def cancel(self, job_id):
+        return self.request('cancel', job_id)
+
+    def disconnect(self):
+        # The PDU session belongs to the daemon, only drop our connection
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
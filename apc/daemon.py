@@ -0,0 +1,255 @@
+'''
+APC daemon
+
+Keeps one authenticated session per PDU and serves commands from local
+clients over a Unix socket, so that clients pay neither the lock, the
+telnet spawn nor the login on each command.
+
+The protocol is one JSON object per line in each direction:
+
+    {"host": "10.8.0.142", "user": "apc", "password": "apc",
+     "op": "reboot", "args": [8, 0, 5]}
+
+    {"ok": true, "result": null}
+    {"ok": false, "error": "Bad outlet: [42]"}
+
+Commands with a delay are not programmed into the PDU: the daemon keeps
+them as jobs (see apc.scheduler) and answers with the job, whose
+immediate command is sent when it is due.  The 'jobs' and 'cancel'
+operations list and cancel the pending jobs.
+'''
+
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import pexpect
+from apc.client import APCClient, APCDaemonError  # noqa
+from apc.defaults import APC_DEFAULT_LOCK_DIR, APC_DEFAULT_SOCKET, APC_DEFAULT_TRANSPORT
+from apc.history import HistoryStore
+from apc.outlet import Outlets, OutletStatus
+from apc.scheduler import Scheduler
+from apc.session import APCSession, SESSION_IDLE_TIMEOUT
+from apc.timing import Timings
+
+
+DAEMON_OPERATIONS = ('status', 'read_status', 'on', 'off', 'reboot')
+DAEMON_JOB_OPERATIONS = ('jobs', 'cancel')
+
+
+class _HostWorker(threading.Thread):
+    '''
+    Owns the session of one PDU and runs its requests in arrival order
+    '''
+    def __init__(self, session, idle_timeout, history=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.idle_timeout = idle_timeout
+        self.history = history
+        self.requests = queue.Queue()
+
+    def submit(self, op, args):
+        done = threading.Event()
+        reply = {}
+        self.requests.put((op, args, done.set, reply))
+        done.wait()
+        return reply
+
+    def post(self, op, args, callback):
+        '''
+        Queue a request without waiting: callback(reply) is called once
+        it has run
+        '''
+        reply = {}
+        self.requests.put((op, args, lambda: callback(reply), reply))
+
+    def run(self):
+        while True:
+            try:
+                op, args, done, reply = self.requests.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # Nobody needs this PDU: log out and let direct users in
+                self.session.close()
+                continue
+            if op is None:
+                self.session.close()
+                done()
+                return
+            reply.update(self.execute(op, args))
+            done()
+
+    def execute(self, op, args):
+        try:
+            result = getattr(self.session, op)(*args)
+        except pexpect.TIMEOUT as e:
+            # The menu position is unknown now: start over on next request
+            self.session.close()
+            return {'ok': False, 'error': 'Timeout talking to APC %s: %s' % (self.session.host, e)}
+        except (Exception, SystemExit) as e:
+            return {'ok': False, 'error': str(e)}
+        if isinstance(result, Outlets):
+            if self.history is not None:
+                self.history.append(self.session.host, result)
+            result = result.to_list()
+        elif isinstance(result, OutletStatus):
+            result = str(result)
+        return {'ok': True, 'result': result}
+
+    def stop(self):
+        self.requests.put((None, None, lambda: None, {}))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                reply = self.server.dispatch(request)
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'ok': False, 'error': 'Bad request: %s' % e}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class APCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path=APC_DEFAULT_SOCKET, verbose=False, quiet=True,
+                 lock_dir=APC_DEFAULT_LOCK_DIR, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 status_ttl=0, session_factory=APCSession, history=None, timings=None,
+                 metrics_path=None, jobs_path=None):
+        self.verbose = verbose
+        self.quiet = quiet
+        self.lock_dir = lock_dir
+        self.idle_timeout = idle_timeout
+        self.status_ttl = status_ttl
+        self.history = history
+        self.timings = timings
+        self.metrics_path = metrics_path
+        self.session_factory = session_factory
+        self.workers = {}
+        self.workers_lock = threading.Lock()
+        self.scheduler = Scheduler(self.run_job, jobs_path)
+        for job in self.scheduler.expired:
+            self.info('Dropped job %d, due at %s: %s' % (
+                job.id, time.ctime(job.due), describe_job(job)))
+        self.scheduler.start()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # stale socket of a previous daemon
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)  # requests carry PDU credentials
+
+    def worker(self, host, user, password, cli, transport):
+        key = (host, user, password, cli, transport)
+        with self.workers_lock:
+            worker = self.workers.get(key)
+            if worker is None:
+                session = self.session_factory(host, user, password, self.verbose,
+                                               self.quiet, cli, self.lock_dir,
+                                               self.idle_timeout, self.status_ttl,
+                                               self.timings, transport)
+                worker = _HostWorker(session, self.idle_timeout, self.history)
+                worker.start()
+                self.workers[key] = worker
+        return worker
+
+    def info(self, msg):
+        if not self.quiet:
+            print(msg)
+
+    def dispatch(self, request):
+        op = request['op']
+        if op in DAEMON_JOB_OPERATIONS:
+            return self.dispatch_job(op, request.get('args', []))
+        if op not in DAEMON_OPERATIONS:
+            return {'ok': False, 'error': 'Unknown operation: %s' % op}
+        args = request.get('args', [])
+        if op in ('on', 'off', 'reboot') and len(args) > 1 and args[1] > 0:
+            return self.schedule(request)
+        worker = self.worker(request['host'], request['user'],
+                             request['password'], request.get('cli', ''),
+                             request.get('transport', APC_DEFAULT_TRANSPORT))
+        reply = worker.submit(op, request.get('args', []))
+        if self.timings is not None and self.metrics_path:
+            self.timings.write_textfile(self.metrics_path)
+        return reply
+
+    def schedule(self, request):
+        '''
+        Keep a delayed command as a job of its immediate command
+        '''
+        args = list(request['args'])
+        due = time.time() + args[1]
+        args[1] = 0
+        job = self.scheduler.add(due, dict(request, args=args))
+        return {'ok': True, 'result': job_info(job)}
+
+    def dispatch_job(self, op, args):
+        if op == 'jobs':
+            return {'ok': True, 'result': [job_info(job) for job in self.scheduler.jobs()]}
+        job = self.scheduler.cancel(args[0]) if args else None
+        if job is None:
+            return {'ok': False, 'error': 'No pending job %s' % (args[0] if args else '')}
+        return {'ok': True, 'result': job_info(job)}
+
+    def run_job(self, job):
+        r = job.request
+        worker = self.worker(r['host'], r['user'], r['password'], r.get('cli', ''),
+                             r.get('transport', APC_DEFAULT_TRANSPORT))
+
+        def done(reply):
+            self.info('Job %d, %s: %s' % (job.id, describe_job(job),
+                                          'done' if reply['ok'] else reply['error']))
+        worker.post(r['op'], r['args'], done)
+
+    def server_close(self):
+        self.scheduler.stop()
+        socketserver.UnixStreamServer.server_close(self)
+        with self.workers_lock:
+            for worker in self.workers.values():
+                worker.stop()
+            for worker in self.workers.values():
+                worker.join()
+            self.workers = {}
+        if self.history is not None:
+            self.history.close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def job_info(job):
+    '''
+    What clients see of a job: not the credentials of its request
+    '''
+    r = job.request
+    return {'id': job.id, 'due': job.due, 'host': r['host'], 'op': r['op'],
+            'args': r['args']}
+
+
+def describe_job(job):
+    r = job.request
+    return '%s %s outlet %s' % (r['host'], r['op'], r['args'][0])
+
+
+def serve(socket_path=APC_DEFAULT_SOCKET, verbose=False, quiet=False,
+          lock_dir=APC_DEFAULT_LOCK_DIR, status_ttl=0, history_dir=None, metrics_path=None,
+          jobs_path=None, history_retention=None):
+    '''
+    @param history_retention: seconds the history is kept, None for ever
+    '''
+    history = HistoryStore(history_dir, retention=history_retention) if history_dir else None
+    timings = Timings() if metrics_path else None
+    server = APCServer(socket_path, verbose, quiet, lock_dir, status_ttl=status_ttl,
+                       history=history, timings=timings, metrics_path=metrics_path,
+                       jobs_path=jobs_path)
+    if not quiet:
+        print('APC daemon listening on %s' % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
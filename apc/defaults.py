@@ -0,0 +1,32 @@
+'''
+Default settings, from the environment
+
+Kept apart from the modules using them, so that the command line builds
+its parser without importing pexpect and the drivers.
+'''
+
+import os
+
+
+APC_DEFAULT_HOST     = os.environ.get('APC_HOST',     '192.168.1.2')
+APC_DEFAULT_USER     = os.environ.get('APC_USER',     'apc')
+APC_DEFAULT_PASSWORD = os.environ.get('APC_PASSWORD', 'apc')
+
+APC_DEFAULT_LOCK_DIR = os.environ.get('APC_LOCK_DIR', '/tmp')
+
+APC_DEFAULT_TRANSPORT = os.environ.get('APC_TRANSPORT', 'telnet')
+
+# SSH host keys not in known_hosts are rejected unless this is set
+APC_SSH_ACCEPT_NEW_HOST_KEYS = os.environ.get('APC_SSH_ACCEPT_NEW_HOST_KEYS', '') not in ('', '0')
+
+APC_DEFAULT_SOCKET = os.environ.get('APC_SOCKET', '/tmp/apc.sock')
+
+TRANSPORTS = ('telnet', 'ssh', 'snmp')
+
+FLEET_WORKERS = 16
+
+# Seconds between the commands on a circuit (see apc.sequence)
+SEQUENCE_GAP = 1.0
+
+# Seconds --wait waits for the outlets to settle (see apc.watch)
+WAIT_TIMEOUT = 120
@@ -0,0 +1,757 @@
+'''
+APC PDU emulator
+
+Speaks the telnet menus and login banners of the v2, v2.5.4 and v3
+firmware families, as the drivers of apc.utility expect them, so that
+the drivers, the daemon and the fleet tools can be exercised (and
+loaded) without hardware:
+
+    $ python -m apc.emulator --port 2323 --firmware 2.5.4 --latency 0.05
+    $ apc --host pdu --cli 'python -m apc.emulator --stdio' --status
+
+With --stdio the emulator talks over its terminal, so that the drivers
+spawn it through --cli; otherwise it is a telnet server, and with
+--snmp-port an SNMP agent of the same outlets as well.  Faults are
+injected on demand: latency of each key, connections dropped at random,
+the single telnet session of the real cards and their idle logout.
+'''
+
+import argparse
+import bisect
+import os
+import random
+import select
+import socket
+import socketserver
+import threading
+import time
+from apc import snmp
+from apc.telnet import TelnetParser, escape, IAC, WILL, ECHO, SGA
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+
+EMULATOR_FIRMWARE     = '3.7.4'
+EMULATOR_OUTLETS      = 8
+EMULATOR_PORT         = 2323
+EMULATOR_IDLE_TIMEOUT = 180
+EMULATOR_COMMUNITY    = 'private'
+
+ESC    = '\033'
+PROMPT = '\r\n> '
+
+# Static menus of each firmware family, by the keys leading to them
+_MENUS = {
+    'v2': {
+        (): ('Control Console', ['Device Manager', 'Network', 'System', 'Logout']),
+        ('1',): ('Device Manager', ['Outlet Control', 'Power Supply Status']),
+    },
+    'v2.5.4': {
+        (): ('Control Console', ['Outlet Manager', 'Network', 'System', 'Logout']),
+    },
+    'v3': {
+        (): ('Control Console', ['Device Manager', 'Network', 'System', 'Logout']),
+        ('1',): ('Device Manager', ['Phase Management', 'Outlet Management',
+                                    'Power Supply Status']),
+        ('1', '2'): ('Outlet Management', ['Outlet Control/Configuration',
+                                           'Outlet Restriction']),
+    },
+}
+
+# Keys and title of the outlet table
+_OUTLET_TABLES = {
+    'v2':     (('1', '1'), 'Outlet Control'),
+    'v2.5.4': (('1',), 'Outlet Manager'),
+    'v3':     (('1', '2', '1'), 'Outlet Control/Configuration'),
+}
+
+# Entries of the Control Outlet menu: (label, command)
+_COMMANDS = {
+    'v2': [('Immediate On', 'on'), ('Delayed On', 'delayed on'),
+           ('Immediate Off', 'off'), ('Immediate Reboot', 'reboot'),
+           ('Delayed Off', 'delayed off'), ('Delayed Reboot', 'delayed reboot'),
+           ('Cancel', 'cancel')],
+    'v3': [('Immediate On', 'on'), ('Immediate Off', 'off'),
+           ('Immediate Reboot', 'reboot'), ('Delayed On', 'delayed on'),
+           ('Delayed Off', 'delayed off'), ('Delayed Reboot', 'delayed reboot'),
+           ('Cancel', 'cancel')],
+}
+_COMMANDS['v2.5.4'] = _COMMANDS['v3']
+
+# Entries of the Configure Outlet menu (v3): (label, setting, minimum, maximum)
+_SETTINGS = [
+    ('Outlet Name', 'name', None, None),
+    ('Power On Delay(sec)', 'on_delay', -1, 7200),
+    ('Power Off Delay(sec)', 'off_delay', -1, 7200),
+    ('Reboot Duration(sec)', 'reboot_duration', 5, 60),
+]
+_ACCEPT_CHANGES = str(len(_SETTINGS) + 1)
+
+_LOGOUT = '4'
+
+
+def firmware_family(version):
+    if version.startswith('3'):
+        return 'v3'
+    elif version.startswith('2.5.4'):
+        return 'v2.5.4'
+    else:
+        return 'v2'
+
+
+class EmulatedOutlet:
+    def __init__(self, name=''):
+        self.name = name
+        self.on = True
+        # Scheduled state changes: list of (time, on)
+        self.events = []
+        self.on_delay = 0
+        self.off_delay = 0
+        self.reboot_duration = 5
+
+    def settle(self, now):
+        while self.events and self.events[0][0] <= now:
+            self.on = self.events.pop(0)[1]
+
+    def command(self, command, now):
+        if command == 'on':
+            self.events = [(now, True)]
+        elif command == 'off':
+            self.events = [(now, False)]
+        elif command == 'reboot':
+            self.events = [(now, False), (now + self.reboot_duration, True)]
+        elif command == 'delayed on':
+            self.events = [] if self.on_delay < 0 else [(now + self.on_delay, True)]
+        elif command == 'delayed off':
+            self.events = [] if self.off_delay < 0 else [(now + self.off_delay, False)]
+        elif command == 'delayed reboot':
+            off = now + max(self.off_delay, 0)
+            self.events = [(off, False), (off + self.reboot_duration, True)]
+        elif command == 'cancel':
+            self.events = []
+        self.settle(now)
+
+    def status(self):
+        return ('ON' if self.on else 'OFF') + ('*' if self.events else '')
+
+
+class EmulatedPDU:
+    '''
+    State of an emulated PDU, shared by its sessions
+
+    @param latency: seconds each key (menu choice, <ENTER>, <ESC>) takes
+        to be answered
+    @param drop_rate: probability that a key drops the connection instead
+    @param max_sessions: number of concurrent telnet sessions accepted
+    @param idle_timeout: seconds of silence before a session is logged out
+    '''
+    def __init__(self, firmware=EMULATOR_FIRMWARE, outlets=EMULATOR_OUTLETS, user='apc',
+                 password='apc', name='apc-emulator', latency=0, drop_rate=0,
+                 max_sessions=1, idle_timeout=EMULATOR_IDLE_TIMEOUT, seed=None):
+        self.firmware = firmware
+        self.family = firmware_family(firmware)
+        self.outlets = [EmulatedOutlet() for i in range(outlets)]
+        self.user = user
+        self.password = password
+        self.name = name
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.random = random.Random(seed)
+        self.sessions = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def master(self):
+        '''
+        Number of the master control entry, after the last outlet
+        '''
+        return len(self.outlets) + 1
+
+    def open_session(self):
+        with self.lock:
+            if self.sessions >= self.max_sessions:
+                return False
+            self.sessions += 1
+            return True
+
+    def close_session(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def keystroke(self):
+        '''
+        Wait for the latency of a key
+
+        @return: False if the connection must be dropped
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            return self.random.random() >= self.drop_rate
+
+    def targets(self, outlet):
+        if outlet == self.master:
+            return list(self.outlets)
+        return [self.outlets[outlet - 1]]
+
+    def status(self):
+        '''
+        @return: list of (number, name, status)
+        '''
+        with self.lock:
+            now = time.time()
+            for ol in self.outlets:
+                ol.settle(now)
+            return [(i, ol.name, ol.status()) for i, ol in enumerate(self.outlets, 1)]
+
+    def command(self, outlet, command):
+        '''
+        @return: status of the (first) outlet after the command
+        '''
+        with self.lock:
+            now = time.time()
+            targets = self.targets(outlet)
+            for ol in targets:
+                ol.command(command, now)
+            return targets[0].status()
+
+    def configure(self, outlet, settings):
+        with self.lock:
+            for ol in self.targets(outlet):
+                for setting, value in settings.items():
+                    setattr(ol, setting, value)
+
+
+class _Menu:
+    def __init__(self, kind, title, lines, outlet=None):
+        self.kind = kind
+        self.title = title
+        self.lines = lines
+        self.outlet = outlet
+
+
+def _items(labels):
+    return ['     %d- %s' % (i, label) for i, label in enumerate(labels, 1)]
+
+
+def _title(title):
+    return ('------- %s ' % title).ljust(79, '-')
+
+
+class EmulatorSession:
+    '''
+    One telnet session: the login, then the menus of the firmware family
+
+    feed() takes the characters typed by the client and the screens are
+    sent back through write().  closed tells that the session is over.
+    '''
+    def __init__(self, pdu, write, echo=True):
+        self.pdu = pdu
+        self.write = write
+        self.echo = echo
+        self.state = 'user'
+        self.user = None
+        self.line = ''
+        self.last = ''
+        self.path = ()
+        self.command = None
+        self.setting = None
+        self.changes = {}
+        self.closed = False
+        self.dropped = False
+        self.write('\r\nUser Name : ')
+
+    def feed(self, data):
+        for c in data:
+            if self.closed:
+                return
+            if c == '\n' and self.last == '\r':
+                pass
+            elif c == ESC:
+                self.line = ''
+                self.key(ESC)
+            elif c in '\r\n':
+                line, self.line = self.line, ''
+                if self.echo:
+                    self.write('\r\n')
+                self.key(line)
+            elif c in '\x08\x7f':
+                self.line = self.line[:-1]
+            elif c >= ' ':
+                self.line += c
+                if self.echo:
+                    self.write('*' if self.state == 'password' else c)
+            self.last = c
+
+    def key(self, key):
+        if not self.pdu.keystroke():
+            self.closed = self.dropped = True
+            return
+        getattr(self, '_key_' + self.state)(key)
+
+    def logout(self, message='Connection Closed - Bye'):
+        self.write('\r\n\r\n%s\r\n' % message)
+        self.closed = True
+
+    def _key_user(self, key):
+        if key == ESC:
+            return
+        self.user = key
+        self.state = 'password'
+        self.write('Password  : ')
+
+    def _key_password(self, key):
+        if key == ESC:
+            return
+        if (self.user, key) != (self.pdu.user, self.pdu.password):
+            self.state = 'user'
+            self.write('\r\nUser Name : ')
+            return
+        self.state = 'menu'
+        self.write(self.banner())
+        self.redraw()
+
+    def banner(self):
+        up = int(time.time() - self.pdu.started)
+        lines = [
+            '',
+            'American Power Conversion               '
+            'Network Management Card AOS      v%s' % self.pdu.firmware,
+            '(c) Copyright 2009 All Rights Reserved  '
+            'Rack PDU APP                     v%s' % self.pdu.firmware,
+            '-' * 79,
+            'Name      : %-40s Date : %s' % (self.pdu.name, time.strftime('%m/%d/%Y')),
+            'Contact   : %-40s Time : %s' % ('Unknown', time.strftime('%H:%M:%S')),
+            'Location  : %-40s User : Administrator' % 'Unknown',
+            'Up Time   : %-40s Stat : P+ N+ A+' % ('%d Days %d Hours %d Minutes'
+                                                   % (up // 86400, up // 3600 % 24,
+                                                      up // 60 % 60)),
+            '',
+            'Communication Established',
+        ]
+        return '\r\n'.join(lines) + '\r\n'
+
+    def menu(self, path):
+        '''
+        Menu reached by the keys of path, None if there is none
+        '''
+        family = self.pdu.family
+        static = _MENUS[family].get(path)
+        if static is not None:
+            title, labels = static
+            return _Menu('menu', title, _items(labels))
+        table_path, table_title = _OUTLET_TABLES[family]
+        if path == table_path:
+            master = ' %2d- Master Control/Configuration' % self.pdu.master
+            return _Menu('menu', table_title, self.table() + [master])
+        if path[:len(table_path)] != table_path:
+            return None
+        rest = path[len(table_path):]
+        if not rest[0].isdigit() or not 1 <= int(rest[0]) <= self.pdu.master:
+            return None
+        outlet = int(rest[0])
+        master = outlet == self.pdu.master
+        if family == 'v2.5.4' and master:
+            labels = ['Control MasterSwitch', 'Configuration of MasterSwitch']
+        elif family == 'v3':
+            labels = ['Control Outlet', 'Configure Outlet']
+        else:
+            labels = ['Control Outlet']
+        if master:
+            name = 'Master Control/Configuration'
+        else:
+            name = 'Outlet %d %s' % (outlet, self.pdu.outlets[outlet - 1].name)
+        if len(rest) == 1:
+            return _Menu('menu', name.strip(), _items(labels))
+        if len(rest) > 2 or not rest[1].isdigit() or not 1 <= int(rest[1]) <= len(labels):
+            return None
+        label = labels[int(rest[1]) - 1]
+        if label.startswith('Control'):
+            return _Menu('control', label, self.control_lines(outlet), outlet)
+        elif label == 'Configure Outlet':
+            return _Menu('configure', label, self.configure_lines(outlet), outlet)
+        else:
+            return _Menu('menu', label, self.table())
+
+    def table(self):
+        return [' %2d- %-27s %s' % (i, 'Outlet %d %s' % (i, name), status)
+                for (i, name, status) in self.pdu.status()]
+
+    def control_lines(self, outlet):
+        if outlet == self.pdu.master:
+            lines = ['        Outlet       : All']
+        else:
+            (i, name, status) = self.pdu.status()[outlet - 1]
+            lines = ['        Name         : %s' % name,
+                     '        Outlet       : %d' % outlet,
+                     '        State        : %s' % status]
+        return lines + [''] + _items([label for (label, command)
+                                      in _COMMANDS[self.pdu.family]])
+
+    def configure_lines(self, outlet):
+        ol = self.pdu.outlets[0 if outlet == self.pdu.master else outlet - 1]
+        lines = []
+        for (label, setting, minimum, maximum) in _SETTINGS:
+            value = self.changes.get(setting, getattr(ol, setting))
+            lines.append('        %-21s: %s' % (label, value))
+        return lines + [''] + _items([label for (label, setting, minimum, maximum)
+                                      in _SETTINGS] + ['Accept Changes'])
+
+    def redraw(self):
+        menu = self.menu(self.path)
+        footer = '<ESC>- Main Menu' if self.path == () else '<ESC>- Back'
+        self.write('\r\n%s\r\n\r\n%s\r\n\r\n     %s, <ENTER>- Refresh, <CTRL-L>- Event Log%s'
+                   % (_title(menu.title), '\r\n'.join(menu.lines), footer, PROMPT))
+
+    def _key_menu(self, key):
+        menu = self.menu(self.path)
+        if key == ESC:
+            self.path = self.path[:-1]
+            self.changes = {}
+        elif self.path == () and key == _LOGOUT:
+            self.logout()
+            return
+        elif menu.kind == 'control' and key.isdigit() and \
+                1 <= int(key) <= len(_COMMANDS[self.pdu.family]):
+            self.confirm(menu.outlet, _COMMANDS[self.pdu.family][int(key) - 1])
+            return
+        elif menu.kind == 'configure' and key == _ACCEPT_CHANGES:
+            self.pdu.configure(menu.outlet, self.changes)
+            self.changes = {}
+        elif menu.kind == 'configure' and key.isdigit() and 1 <= int(key) <= len(_SETTINGS):
+            self.setting = _SETTINGS[int(key) - 1]
+            self.state = 'value'
+            self.write('\r\n        %s : ' % self.setting[0])
+            return
+        elif key and self.menu(self.path + (key,)) is not None:
+            self.path += (key,)
+        self.redraw()
+
+    def confirm(self, outlet, command):
+        (label, self.command) = command
+        if outlet == self.pdu.master:
+            target = 'all outlets'
+        else:
+            target = 'Outlet %d' % outlet
+        self.state = 'confirm'
+        self.write("\r\n        -----%s%s\r\n\r\n        %s of %s\r\n\r\n"
+                   "        Enter 'YES' to continue or <ENTER> to cancel : "
+                   % (label, '-' * (60 - len(label)), label, target))
+
+    def _key_confirm(self, key):
+        self.state = 'menu'
+        if key != 'YES':
+            self.redraw()
+            return
+        status = self.pdu.command(self.menu(self.path).outlet, self.command)
+        if self.pdu.family == 'v3':
+            result = 'Command successfully issued.'
+        else:
+            result = 'Outlet State : %s' % status
+        self.state = 'continue'
+        self.write('\r\n        %s\r\n\r\n        Press <ENTER> to continue...' % result)
+
+    def _key_continue(self, key):
+        self.state = 'menu'
+        self.redraw()
+
+    def _key_value(self, key):
+        self.state = 'menu'
+        (label, setting, minimum, maximum) = self.setting
+        if minimum is None:
+            self.changes[setting] = key[:20]
+        else:
+            try:
+                value = int(key)
+                if not minimum <= value <= maximum:
+                    raise ValueError()
+                self.changes[setting] = value
+            except ValueError:
+                self.write('\r\n        Invalid value, range: %d to %d\r\n' % (minimum, maximum))
+        self.redraw()
+
+
+class _TelnetHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        pdu = self.server.pdu
+        sock = self.request
+        if not pdu.open_session():
+            sock.sendall(b'\r\nToo many telnet sessions, try again later\r\n')
+            return
+        try:
+            sock.settimeout(pdu.idle_timeout)
+            sock.sendall(bytes(bytearray([IAC, WILL, ECHO, IAC, WILL, SGA])))
+            session = EmulatorSession(pdu, lambda s: sock.sendall(escape(s.encode('utf-8'))))
+            # Only used to strip the client's commands: our options were
+            # offered above, its answers need no reply
+            telnet = TelnetParser()
+            while not session.closed:
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    session.logout('Session timed out - Bye')
+                    break
+                if not data:
+                    break
+                payload, reply = telnet.feed(data)
+                session.feed(payload.decode('latin-1'))
+        except (OSError, ValueError):
+            pass  # client gone
+        finally:
+            pdu.close_session()
+
+
+class EmulatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    Telnet server of an emulated PDU
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, pdu):
+        self.pdu = pdu
+        socketserver.TCPServer.__init__(self, address, _TelnetHandler)
+
+
+class _SNMPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        (data, sock) = self.request
+        reply = self.server.answer(data)
+        if reply is not None:
+            sock.sendto(reply, self.client_address)
+
+
+class SNMPAgent(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    '''
+    SNMPv2c agent of an emulated PDU: sysDescr and the outlet tables of
+    the PowerNet MIB (rPDU or sPDU, after the firmware)
+
+    Each request takes the latency of a key and may be dropped, as keys
+    are.  Requests with another community are not answered.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pdu, community=EMULATOR_COMMUNITY):
+        self.pdu = pdu
+        self.community = community.encode('utf-8')
+        self.mib = snmp.mib_class(pdu.firmware)
+        self.settings = {self.mib.ON_DELAY: 'on_delay', self.mib.OFF_DELAY: 'off_delay',
+                         self.mib.REBOOT_DURATION: 'reboot_duration'}
+        socketserver.UDPServer.__init__(self, address, _SNMPHandler)
+
+    def sys_descr(self):
+        return ('APC Web/SNMP Management Card (MB:v3.9.2 PF:v%s PN:apc_hw02_aos.bin '
+                'AF1:v%s AN1:apc_hw02_rpdu.bin MN:AP7900 HR:B2 SN: EMULATOR MD:01/01/2009)'
+                % (self.pdu.firmware, self.pdu.firmware))
+
+    def view(self):
+        '''
+        @return: the variables of the agent, sorted list of (OID, value)
+        '''
+        mib = self.mib
+        (name_column, state_column, pending_column) = mib.STATUS_COLUMNS
+        variables = {snmp.SYS_DESCR: self.sys_descr(),
+                     mib.DEVICE_COMMAND: mib.NO_DEVICE_COMMAND}
+        with self.pdu.lock:
+            now = time.time()
+            for i, ol in enumerate(self.pdu.outlets, 1):
+                ol.settle(now)
+                state = mib.STATE_ON if ol.on else mib.STATE_ON + 1
+                variables.update({
+                    mib.OUTLET_COMMAND + (i,): state,
+                    name_column + (i,): ol.name,
+                    state_column + (i,): state,
+                    pending_column + (i,): mib.PENDING if ol.events else mib.NOT_PENDING,
+                    mib.ON_DELAY + (i,): ol.on_delay,
+                    mib.OFF_DELAY + (i,): ol.off_delay,
+                    mib.REBOOT_DURATION + (i,): ol.reboot_duration,
+                })
+        return sorted(variables.items())
+
+    def answer(self, data):
+        '''
+        @return: the response to the request in data, None to drop it
+        '''
+        try:
+            (version, community, kind, request_id, status, index,
+             varbinds) = snmp.decode_message(data)
+        except snmp.SNMPError:
+            return None
+        if community != self.community or not self.pdu.keystroke():
+            return None
+        view = self.view()
+        names = [name for (name, value) in view]
+        values = dict(view)
+
+        def next_variable(name):
+            i = bisect.bisect_right(names, name)
+            return view[i] if i < len(view) else (name, snmp.END_OF_MIB_VIEW)
+
+        if kind == snmp.GET_REQUEST:
+            bindings = [(name, values.get(name, snmp.NO_SUCH_OBJECT))
+                        for (name, value) in varbinds]
+        elif kind == snmp.GET_NEXT_REQUEST:
+            bindings = [next_variable(name) for (name, value) in varbinds]
+        elif kind == snmp.GET_BULK_REQUEST:
+            # status and index are the non-repeaters and max-repetitions
+            bindings = [next_variable(name) for (name, value) in varbinds[:status]]
+            last = [name for (name, value) in varbinds[status:]]
+            for repetition in range(index):
+                row = [next_variable(name) for name in last]
+                bindings += row
+                last = [name for (name, value) in row]
+            status = index = 0
+        elif kind == snmp.SET_REQUEST:
+            bindings = varbinds
+            (status, index) = self.set(varbinds)
+        else:
+            return None
+        return snmp.encode_message(community, snmp.GET_RESPONSE, request_id, bindings,
+                                   status, index)
+
+    def set(self, varbinds):
+        '''
+        Apply the SETs of varbinds, all of them or none
+
+        @return: (error status, error index)
+        '''
+        mib = self.mib
+        device_commands = dict((v, k) for (k, v) in mib.DEVICE_COMMANDS.items())
+        outlet_commands = dict((v, k) for (k, v) in mib.OUTLET_COMMANDS.items())
+        ranges = dict((setting, (minimum, maximum))
+                      for (label, setting, minimum, maximum) in _SETTINGS)
+        actions = []
+        for i, (name, value) in enumerate(varbinds, 1):
+            (column, outlet) = (name[:-1], name[-1])
+            if name == mib.DEVICE_COMMAND:
+                if value not in device_commands:
+                    return 10, i  # wrongValue
+                actions.append((self.pdu.master, None, device_commands[value]))
+            elif not 1 <= outlet <= len(self.pdu.outlets):
+                return 17, i  # notWritable
+            elif column == mib.OUTLET_COMMAND:
+                if value not in outlet_commands:
+                    return 10, i
+                actions.append((outlet, None, outlet_commands[value]))
+            elif column in self.settings:
+                setting = self.settings[column]
+                (minimum, maximum) = ranges[setting]
+                if not isinstance(value, int) or not minimum <= value <= maximum:
+                    return 10, i
+                actions.append((outlet, setting, value))
+            else:
+                return 17, i
+        for (outlet, setting, value) in actions:
+            if setting is None:
+                self.pdu.command(outlet, value)
+            else:
+                self.pdu.configure(outlet, {setting: value})
+        return 0, 0
+
+
+def serve_stdio(pdu, stdin=0, stdout=1):
+    '''
+    Run a single session over the terminal (or pipes) of the process
+    '''
+    saved = None
+    if termios is not None and os.isatty(stdin):
+        # Keys must be seen as typed: <ESC> is not followed by <ENTER>
+        saved = termios.tcgetattr(stdin)
+        tty.setraw(stdin)
+    try:
+        session = EmulatorSession(pdu, lambda s: os.write(stdout, s.encode('utf-8')))
+        while not session.closed:
+            ready, _, _ = select.select([stdin], [], [], pdu.idle_timeout)
+            if not ready:
+                session.logout('Session timed out - Bye')
+                break
+            data = os.read(stdin, 4096)
+            if not data:
+                break
+            session.feed(data.decode('latin-1'))
+    finally:
+        if saved is not None:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, saved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='APC PDU emulator')
+    parser.add_argument('--firmware', action='store', default=EMULATOR_FIRMWARE,
+                        help='Firmware version, e.g. 2.7.0, 2.5.4 or 3.7.4')
+    parser.add_argument('--outlets', action='store', type=int, default=EMULATOR_OUTLETS,
+                        help='Number of outlets')
+    parser.add_argument('--user', action='store', default='apc',
+                        help='User name')
+    parser.add_argument('--password', action='store', default='apc',
+                        help='Password')
+    parser.add_argument('--latency', action='store', type=float, default=0,
+                        help='Seconds each key takes to be answered')
+    parser.add_argument('--drop-rate', action='store', type=float, default=0,
+                        help='Probability that a key drops the connection')
+    parser.add_argument('--max-sessions', action='store', type=int, default=1,
+                        help='Number of concurrent telnet sessions accepted')
+    parser.add_argument('--idle-timeout', action='store', type=float,
+                        default=EMULATOR_IDLE_TIMEOUT,
+                        help='Seconds of inactivity before logging a session out')
+    parser.add_argument('--seed', action='store', type=int,
+                        help='Seed of the dropped connections')
+    parser.add_argument('--stdio', action='store_true',
+                        help='Run one session on the terminal instead of a telnet server')
+    parser.add_argument('--bind', action='store', default='127.0.0.1',
+                        help='Address of the telnet server')
+    parser.add_argument('--port', action='store', type=int, default=EMULATOR_PORT,
+                        help='Port of the telnet server')
+    parser.add_argument('--count', action='store', type=int, default=1,
+                        help='Number of PDUs, on consecutive ports')
+    parser.add_argument('--snmp-port', action='store', type=int,
+                        help='Also serve SNMP, on this (UDP) port and the next ones')
+    parser.add_argument('--community', action='store', default=EMULATOR_COMMUNITY,
+                        help='SNMP community')
+
+    args = parser.parse_args()
+
+    def pdu(i=0):
+        return EmulatedPDU(args.firmware, args.outlets, args.user, args.password,
+                           'apc-emulator-%d' % i, args.latency, args.drop_rate,
+                           args.max_sessions, args.idle_timeout,
+                           None if args.seed is None else args.seed + i)
+
+    if args.stdio:
+        serve_stdio(pdu())
+        return
+
+    servers = []
+    for i in range(args.count):
+        emulated = pdu(i)
+        servers.append(EmulatorServer((args.bind, args.port + i), emulated))
+        if args.snmp_port is not None:
+            servers.append(SNMPAgent((args.bind, args.snmp_port + i), emulated,
+                                     args.community))
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        (host, port) = server.server_address[:2]
+        print('APC v%s emulator %s on %s:%d'
+              % (args.firmware, 'SNMP agent' if isinstance(server, SNMPAgent) else 'telnet',
+                 host, port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
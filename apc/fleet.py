@@ -0,0 +1,130 @@
+'''
+Fleet-wide APC status
+
+Reads the status of many PDUs in a bounded pool of worker threads.  A
+host which fails or hangs only affects its own entry in the results.
+
+The drivers are only imported by fleet_status(): the formatters serve
+the single host and daemon paths of the command line as well.
+'''
+
+import json
+import time
+from apc.defaults import APC_DEFAULT_LOCK_DIR, APC_DEFAULT_TRANSPORT, FLEET_WORKERS
+
+
+FLEET_TIMEOUT = 120
+
+
+class FleetTimeout(Exception):
+    pass
+
+
+def read_inventory(path):
+    '''
+    Hosts listed in an inventory file: one per line, '#' starts a comment
+    '''
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hosts.append(line.split()[0])
+    return hosts
+
+
+def _status(host, user, password, cli, lock_dir, timings, transport, health, deadline):
+    from apc.utility import APC
+    apc = APC(host, user, password, False, True, cli, lock_dir, timings=timings,
+              transport=transport, health=health, deadline=deadline)
+    try:
+        return apc.status()
+    finally:
+        apc.disconnect()
+
+
+def fleet_status(hosts, user, password, workers=FLEET_WORKERS, timeout=FLEET_TIMEOUT,
+                 cli='', lock_dir=APC_DEFAULT_LOCK_DIR, timings=None,
+                 transport=APC_DEFAULT_TRANSPORT, health=None):
+    '''
+    Status of all hosts
+
+    @param timeout: seconds each host is given, from when a worker starts
+        on it
+    @param timings: apc.timing.Timings collecting the phase timings
+    @param health: apc.health.HealthTracker skipping the hosts found
+        unreachable time after time
+
+    @return: dict host -> Outlets, or the exception raised for that host,
+        in the order of hosts
+    '''
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    pool = ThreadPoolExecutor(max_workers=workers)
+    # Start time of the hosts, which may wait for a worker
+    started = {}
+
+    def status(host):
+        started[host] = time.time()
+        # Within timeout of its start (lock wait included), rather than
+        # lingering on after the results are in
+        return _status(host, user, password, cli, lock_dir, timings, transport, health,
+                       timeout)
+
+    futures = [(host, pool.submit(status, host)) for host in hosts]
+    # Wait for each started host until timeout after its own start
+    pending = dict((future, host) for (host, future) in futures)
+    while pending:
+        now = time.time()
+        for future, host in list(pending.items()):
+            if future.done() or host in started and now >= started[host] + timeout:
+                del pending[future]
+        if not pending:
+            break
+        limits = [started[host] + timeout for host in pending.values() if host in started]
+        if limits:
+            wait(pending, min(limits) - now, return_when=FIRST_COMPLETED)
+            continue
+        # None of them started: the workers are held by hosts given up
+        done, not_done = wait(pending, timeout, return_when=FIRST_COMPLETED)
+        if not done and not [host for host in pending.values() if host in started]:
+            break
+    # Do not wait for hung hosts: their deadline will end them
+    pool.shutdown(wait=False)
+
+    results = {}
+    for host, future in futures:
+        if not future.done():
+            future.cancel()
+            if host in started:
+                results[host] = FleetTimeout('No answer from %s within %s s' % (host, timeout))
+            else:
+                results[host] = FleetTimeout('No worker for %s within %s s' % (host, timeout))
+        elif future.exception() is not None:
+            results[host] = future.exception()
+        else:
+            results[host] = future.result()
+    return results
+
+
+def _error(e):
+    return str(e) or e.__class__.__name__
+
+
+def format_table(results):
+    blocks = []
+    for host, result in results.items():
+        if isinstance(result, BaseException):
+            blocks.append('%s\nERROR: %s' % (host, _error(result)))
+        else:
+            blocks.append('%s\n%s' % (host, result))
+    return '\n\n'.join(blocks)
+
+
+def format_json(results):
+    d = {}
+    for host, result in results.items():
+        if isinstance(result, BaseException):
+            d[host] = {'error': _error(result)}
+        else:
+            d[host] = {'outlets': result.to_list()}
+    return json.dumps(d, indent=2)
@@ -0,0 +1,131 @@
+'''
+Per-host circuit breaker
+
+A PDU which cannot be connected to, or logged in to, ties each attempt
+up for the lock wait and the connection timeouts.  After HEALTH_FAILURES
+failures in a row its circuit opens: the next attempts fail at once with
+CircuitOpen, without taking the lock.  HEALTH_COOLDOWN seconds later a
+single attempt, the half-open probe, is let through; it closes the
+circuit if it succeeds, reopens it for another cooldown otherwise.
+
+The state is shared by all the processes using the same file (in the
+lock directory by default), a small JSON object per host:
+
+    {"pdu-12": {"failures": 3, "opened": 1700000000.0, "probe": null,
+                "error": "Cannot connect to pdu-12:23: timed out"}}
+'''
+
+import json
+import os
+import time
+from apc.lockfile import FlockLock, fcntl
+from apc.transport import TransportError
+
+
+HEALTH_FAILURES  = 3
+HEALTH_COOLDOWN  = 60
+HEALTH_FILE_NAME = 'apc-health.json'
+
+
+class CircuitOpen(TransportError):
+    pass
+
+
+def health_path(lock_dir):
+    return os.path.join(lock_dir, HEALTH_FILE_NAME)
+
+
+class HealthTracker:
+    '''
+    Connection health of the hosts, in the state file path
+
+    >>> health = HealthTracker(health_path(lock_dir))
+    >>> health.check(host)  # raises CircuitOpen
+    >>> ... connect and log in ...
+    >>> health.success(host)  # or health.failure(host, e)
+    '''
+    def __init__(self, path, failures=HEALTH_FAILURES, cooldown=HEALTH_COOLDOWN):
+        self.path = path
+        self.failures = failures
+        self.cooldown = cooldown
+
+    def _update(self, update):
+        '''
+        Read the states, let update(states) change them and write them
+        back, under a lock so that processes do not lose each other's
+        '''
+        lock = None
+        if fcntl is not None:
+            lock = FlockLock(self.path + '.lock')
+            lock.lock(timeout=None)
+        try:
+            try:
+                with open(self.path) as f:
+                    states = json.load(f)
+            except (OSError, ValueError):
+                states = {}
+            before = json.dumps(states, sort_keys=True)
+            result = update(states)
+            if json.dumps(states, sort_keys=True) == before:
+                return result  # healthy hosts cost no write
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(states, f)
+            os.rename(tmp, self.path)
+            return result
+        finally:
+            if lock is not None:
+                lock.unlock()
+
+    def state(self, host):
+        '''
+        @return: 'closed', 'open' or 'half-open' (a probe is running)
+        '''
+        try:
+            with open(self.path) as f:
+                state = json.load(f).get(host)
+        except (OSError, ValueError):
+            return 'closed'
+        if state is None or state['opened'] is None:
+            return 'closed'
+        if state['probe'] is not None and time.time() - state['probe'] < self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def check(self, host):
+        '''
+        Let an attempt on host through, or raise CircuitOpen
+        '''
+        def update(states):
+            state = states.get(host)
+            if state is None or state['opened'] is None:
+                return None
+            now = time.time()
+            if now - state['opened'] < self.cooldown:
+                when = 'for %d s more' % (self.cooldown - (now - state['opened']))
+            elif state['probe'] is not None and now - state['probe'] < self.cooldown:
+                when = 'while another attempt probes it'
+            else:
+                state['probe'] = now  # the other processes wait for our result
+                return None
+            return '%s is unreachable, not retried %s (last error: %s)' % (
+                host, when, state['error'])
+        refused = self._update(update)
+        if refused is not None:
+            raise CircuitOpen(refused)
+
+    def success(self, host):
+        def update(states):
+            states.pop(host, None)
+        self._update(update)
+
+    def failure(self, host, error):
+        def update(states):
+            state = states.setdefault(host, {'failures': 0, 'opened': None, 'probe': None,
+                                             'error': None})
+            state['failures'] += 1
+            state['error'] = str(error) or error.__class__.__name__
+            state['probe'] = None
+            if state['failures'] >= self.failures:
+                state['opened'] = time.time()
+        self._update(update)
@@ -0,0 +1,294 @@
+'''
+On-disk history of outlet snapshots
+
+Each PDU gets two files in the history directory:
+
+- <host>.hist: a header followed by fixed size records
+  (time, on mask, pending mask, layout number), one per change of the
+  outlet states.  Records are appended in time order, so time ranges
+  are found by bisection in a memory map of the file.
+- <host>.layouts: the outlet layouts (ids and names) referenced by the
+  records, one JSON object per line.
+
+Records are buffered and flushed every flush_interval seconds, not
+synced record by record.  A history directory has a single writer
+process, a HistoryStore can be shared by its threads.
+'''
+
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from apc.outlet import OutletsSnapshot
+
+
+HISTORY_MAGIC = b'APCH\x00\x00\x00\x01'
+HISTORY_RECORD = struct.Struct('<dQQI')  # time, on mask, pending mask, layout
+
+HISTORY_FLUSH_INTERVAL = 5
+HISTORY_COMPACT_INTERVAL = 24 * 3600
+HISTORY_COMPACT_CHUNK = 1024 * HISTORY_RECORD.size
+
+_UNSAFE_CHARS = re.compile('[^A-Za-z0-9._-]')
+
+
+class HistoryException(Exception):
+    pass
+
+
+class _HostHistory:
+    def __init__(self, directory, host):
+        self.path = os.path.join(directory, host + '.hist')
+        self.layouts_path = os.path.join(directory, host + '.layouts')
+        self.layouts = []
+        self.layout_index = {}
+        if os.path.exists(self.layouts_path):
+            with open(self.layouts_path) as f:
+                for line in f:
+                    d = json.loads(line)
+                    self._add_layout(tuple(d['ids']), tuple(d['names']))
+        self.last = self._last_record()
+        self.f = None
+
+    def _add_layout(self, ids, names):
+        self.layout_index[(ids, names)] = len(self.layouts)
+        self.layouts.append((ids, names))
+
+    def layout(self, snapshot):
+        key = (snapshot.ids, snapshot.names)
+        if key not in self.layout_index:
+            with open(self.layouts_path, 'a') as f:
+                f.write(json.dumps({'ids': list(snapshot.ids), 'names': list(snapshot.names)}) + '\n')
+            self._add_layout(*key)
+        return self.layout_index[key]
+
+    def _records_size(self):
+        '''
+        Size of the file up to its last complete record
+        '''
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+        if size < len(HISTORY_MAGIC):
+            return 0
+        return size - (size - len(HISTORY_MAGIC)) % HISTORY_RECORD.size
+
+    def _last_record(self):
+        size = self._records_size()
+        if size < len(HISTORY_MAGIC) + HISTORY_RECORD.size:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(size - HISTORY_RECORD.size)
+            return HISTORY_RECORD.unpack(f.read(HISTORY_RECORD.size))
+
+    def open(self):
+        if self.f is None:
+            size = self._records_size()
+            self.f = open(self.path, 'ab')
+            # Drop a record cut short by a crash, it would shift the next ones
+            self.f.truncate(size)
+            if size == 0:
+                self.f.write(HISTORY_MAGIC)
+        return self.f
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def snapshot(self, record):
+        (t, on_mask, pending_mask, layout) = record
+        ids, names = self.layouts[layout]
+        return OutletsSnapshot(ids, names, on_mask, pending_mask)
+
+
+def _records(mm):
+    return (len(mm) - len(HISTORY_MAGIC)) // HISTORY_RECORD.size
+
+
+def _record(mm, i):
+    return HISTORY_RECORD.unpack_from(mm, len(HISTORY_MAGIC) + i * HISTORY_RECORD.size)
+
+
+def _bisect(mm, t):
+    '''
+    Index of the first record at or after time t
+    '''
+    lo, hi = 0, _records(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _record(mm, mid)[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class HistoryStore:
+    '''
+    Timestamped outlet snapshots of many PDUs
+
+    >>> history = HistoryStore('/var/lib/apc/history')
+    >>> history.append('pdu-12', apc.status())
+    >>> for t, snapshot in history.query('pdu-12', start, end): ...
+
+    Only changes are stored: appending the same states again is a no-op.
+    With retention, compact() (run every compact_interval seconds by
+    append) forgets the changes older than retention seconds.
+    '''
+    def __init__(self, directory, flush_interval=HISTORY_FLUSH_INTERVAL,
+                 retention=None, compact_interval=HISTORY_COMPACT_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.hosts = {}
+        self.lock = threading.RLock()
+        self.last_flush = time.time()
+        self.last_compact = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _host(self, host):
+        key = _UNSAFE_CHARS.sub('_', host)
+        if key not in self.hosts:
+            self.hosts[key] = _HostHistory(self.directory, key)
+        return self.hosts[key]
+
+    def append(self, host, outlets, t=None):
+        '''
+        Record the outlets (Outlets or OutletsSnapshot) of host at time t
+
+        @return: True if the states changed since the last record
+        '''
+        with self.lock:
+            if t is None:
+                t = time.time()
+            snapshot = outlets if isinstance(outlets, OutletsSnapshot) else outlets.snapshot()
+            if snapshot.on_mask >> 64 or snapshot.pending_mask >> 64:
+                raise HistoryException('More than 64 outlets on %s' % host)
+            h = self._host(host)
+            layout = h.layout(snapshot)
+            record = (t, snapshot.on_mask, snapshot.pending_mask, layout)
+            if h.last is not None and h.last[1:] == record[1:]:
+                changed = False
+            else:
+                h.open().write(HISTORY_RECORD.pack(*record))
+                h.last = record
+                changed = True
+            now = time.time()
+            if now - self.last_flush >= self.flush_interval:
+                self.flush()
+            if self.retention is not None and now - self.last_compact >= self.compact_interval:
+                self.compact_all()
+            return changed
+
+    def flush(self):
+        with self.lock:
+            for h in self.hosts.values():
+                h.flush()
+            self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            for h in self.hosts.values():
+                h.close()
+
+    def _read(self, host, start, end, last_only=False):
+        with self.lock:
+            h = self._host(host)
+            h.flush()
+            if h._records_size() <= len(HISTORY_MAGIC):
+                return []
+            with open(h.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), h._records_size(), access=mmap.ACCESS_READ)
+                try:
+                    if mm[:len(HISTORY_MAGIC)] != HISTORY_MAGIC:
+                        raise HistoryException('%s is not an APC history file' % h.path)
+                    first = 0 if start is None else _bisect(mm, start)
+                    last = _records(mm) if end is None else _bisect(mm, end)
+                    if last_only:
+                        first = max(first, last - 1)
+                    return [(record[0], h.snapshot(record))
+                            for record in (_record(mm, i) for i in range(first, last))]
+                finally:
+                    mm.close()
+
+    def query(self, host, start=None, end=None):
+        '''
+        Records of host from start (included) to end (excluded)
+
+        @return: list of (time, OutletsSnapshot)
+        '''
+        return self._read(host, start, end)
+
+    def before(self, host, t):
+        '''
+        Outlet states of host just before time t, None if unknown
+        '''
+        records = self._read(host, None, t, last_only=True)
+        return records[0][1] if records else None
+
+    def outlet_changes(self, host, outlet, start=None, end=None):
+        '''
+        State changes of an outlet: list of (time, old status, new status)
+        '''
+        changes = []
+        previous = self.before(host, start) if start is not None else None
+        for t, snapshot in self.query(host, start, end):
+            if previous is not None:
+                for (id, old, new) in previous.diff(snapshot):
+                    if id == outlet:
+                        changes.append((t, old, new))
+            previous = snapshot
+        return changes
+
+    def compact(self, host, before=None):
+        '''
+        Forget the changes of host older than before, keeping the state
+        in effect at that time
+
+        The records kept are copied from a memory map of the file, chunk
+        by chunk: the history is never loaded whole.
+        '''
+        with self.lock:
+            if before is None:
+                before = time.time() - (self.retention or 0)
+            h = self._host(host)
+            h.flush()
+            size = h._records_size()
+            if size <= len(HISTORY_MAGIC):
+                return
+            with open(h.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    if mm[:len(HISTORY_MAGIC)] != HISTORY_MAGIC:
+                        raise HistoryException('%s is not an APC history file' % h.path)
+                    # The last older record is the state in effect at before
+                    first = _bisect(mm, before) - 1
+                    if first <= 0:
+                        return
+                    h.close()
+                    tmp = h.path + '.tmp'
+                    with open(tmp, 'wb') as out:
+                        out.write(HISTORY_MAGIC)
+                        offset = len(HISTORY_MAGIC) + first * HISTORY_RECORD.size
+                        while offset < size:
+                            out.write(mm[offset:offset + HISTORY_COMPACT_CHUNK])
+                            offset += HISTORY_COMPACT_CHUNK
+                finally:
+                    mm.close()
+            os.rename(tmp, h.path)
+
+    def compact_all(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.hist'):
+                self.compact(name[:-len('.hist')])
+        self.last_compact = time.time()
@@ -11,9 +11,17 @@ __metaclass__ = type
 
 import errno
 import os
+import signal
+import threading
+import time
 
 from time import time as _uniquefloat
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from os import rename
 try:
     from os import kill
@@ -207,4 +215,220 @@ def isLocked(name):
     return not result
 
 
-__all__ = ['FilesystemLock', 'isLocked']
+class _LockTimeout(Exception):
+    pass
+
+
+def _raise_lock_timeout(signum, frame):
+    raise _LockTimeout()
+
+
+class FlockLock:
+    """
+    A mutex based on flock(2), granted in the order it was asked for.
+
+    Waiters block in the kernel and are woken up as soon as the owner
+    releases the lock, or dies: the lock goes away with its file
+    descriptor, so there is no stale lock to clean up.  The lock file
+    itself is left in place, removing it would let two processes lock
+    two different files of the same name.
+
+    flock(2) wakes up its waiters in no particular order: a ticket queue
+    on top of it serves them first come, first served.  Each waiter
+    takes the next ticket, a file of the C{name + '.queue'} directory
+    which it keeps locked until it releases the lock, and waits for the
+    ticket before it to go away.  The ticket of a waiter which gave up
+    goes away at once, the one of a dead process is unlocked by the
+    kernel and removed by its successor.
+
+    @ivar name: The name of the file associated with this lock.
+
+    @ivar clean: Always True, a flock(2) lock cannot be left behind.
+
+    @ivar locked: Indicates whether the lock is currently held by this
+        object.
+    """
+
+    clean = True
+    locked = False
+
+    # Polling interval bounds (seconds) when the kernel wait cannot be
+    # interrupted by a timer (outside the main thread)
+    POLL_MIN = 0.001
+    POLL_MAX = 0.05
+
+    def __init__(self, name):
+        self.name = name
+        self.queue = name + '.queue'
+        self._fd = None
+        self._ticket = None
+
+    def lock(self, timeout=0):
+        """
+        Acquire this lock.
+
+        @type timeout: C{float} or C{None}
+        @param timeout: Seconds to wait for the lock.  0 (the default)
+            does not wait, like L{FilesystemLock.lock}, and None waits
+            forever.
+
+        @rtype: C{bool}
+        @return: True if the lock is acquired, false otherwise.
+        """
+        deadline = None if timeout is None else time.time() + max(timeout, 0)
+        ticket = self._take_ticket()
+        try:
+            acquired = self._wait_turn(ticket, deadline)
+            if acquired:
+                flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+                fd = os.open(self.name, flags, 0o644)
+                try:
+                    acquired = self._flock(fd, fcntl.LOCK_EX, deadline)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                if not acquired:
+                    os.close(fd)
+        except BaseException:
+            self._drop_ticket(ticket)
+            raise
+        if not acquired:
+            self._drop_ticket(ticket)
+            return False
+        self._fd = fd
+        self._ticket = ticket
+        self.locked = True
+        return True
+
+    def _take_ticket(self):
+        # The counter is read and bumped, and the ticket created and
+        # locked, under the lock of the counter file: a waiter scanning
+        # the queue sees the tickets before its own already locked
+        try:
+            os.mkdir(self.queue)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        nofollow = getattr(os, 'O_NOFOLLOW', 0)
+        counter = os.open(os.path.join(self.queue, 'next'), os.O_RDWR | os.O_CREAT | nofollow,
+                          0o644)
+        try:
+            fcntl.flock(counter, fcntl.LOCK_EX)
+            number = int(os.read(counter, 32) or 0)
+            os.lseek(counter, 0, os.SEEK_SET)
+            os.ftruncate(counter, 0)
+            os.write(counter, b'%d' % (number + 1))
+            path = os.path.join(self.queue, '%020d' % number)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | nofollow, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        finally:
+            os.close(counter)
+        return (path, fd)
+
+    def _drop_ticket(self, ticket):
+        (path, fd) = ticket
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.close(fd)
+
+    def _wait_turn(self, ticket, deadline):
+        # Wait for the tickets before ours, the last one first
+        mine = os.path.basename(ticket[0])
+        while True:
+            before = sorted(entry for entry in os.listdir(self.queue)
+                            if entry.isdigit() and entry < mine)
+            if not before:
+                return True
+            path = os.path.join(self.queue, before[-1])
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue  # it just went away
+                raise
+            try:
+                if not self._flock(fd, fcntl.LOCK_SH, deadline):
+                    return False
+                # Released: its owner removes it first, unless it died
+                try:
+                    if os.path.samestat(os.stat(path), os.fstat(fd)):
+                        os.remove(path)
+                except OSError:
+                    pass
+            finally:
+                os.close(fd)
+
+    def _flock(self, fd, operation, deadline):
+        if deadline is None:
+            fcntl.flock(fd, operation)
+            return True
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            return self._try_lock(fd, operation)
+        elif self._can_use_timer():
+            return self._lock_timer(fd, timeout, operation)
+        return self._lock_poll(fd, timeout, operation)
+
+    def _try_lock(self, fd, operation):
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def _can_use_timer(self):
+        if not hasattr(signal, 'setitimer'):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        return signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+    def _lock_timer(self, fd, timeout, operation):
+        # Block in flock(2) and let SIGALRM break the wait at the deadline.
+        # If the timer fires right after flock returned, the caller closes
+        # fd, which releases the lock we were about to report as missed.
+        previous = signal.signal(signal.SIGALRM, _raise_lock_timeout)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                fcntl.flock(fd, operation)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except _LockTimeout:
+            return False
+        finally:
+            signal.signal(signal.SIGALRM, previous)
+        return True
+
+    def _lock_poll(self, fd, timeout, operation):
+        deadline = time.time() + timeout
+        interval = self.POLL_MIN
+        while not self._try_lock(fd, operation):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.POLL_MAX)
+        return True
+
+    def unlock(self):
+        """
+        Release this lock, and hand it over to the next waiter.
+
+        @raise: ValueError if the lock is not held by this object.
+        """
+        if self._fd is None:
+            raise ValueError("Lock %r not owned by this object" % self.name)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        self._drop_ticket(self._ticket)
+        self._ticket = None
+        self.locked = False
+
+
+__all__ = ['FilesystemLock', 'FlockLock', 'isLocked']
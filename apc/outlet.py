@@ -2,8 +2,9 @@
 
 from collections import OrderedDict
 import re
-APC_OUTLET_STATUS_PATTERN = re.compile('(OFF|ON)(\*?)')
-APC_OUTLET_ROW_PATTERN = re.compile('Outlet (\d) (.*) (OFF\*?|ON\*?)')
+import sys
+APC_OUTLET_STATUS_PATTERN = re.compile(r'(OFF|ON)(\*?)')
+APC_OUTLET_ROW_PATTERN = re.compile(r'Outlet (\d+) (.*?) *(OFF\*?|ON\*?)\s*$')
 
 
 class OutletStatusParseException(Exception):
@@ -61,6 +62,13 @@ class Outlet:
         name = self.name[0:n].ljust(n)
         return "Outlet %d %s %s" % (self.id, name, self.status)
 
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'status': str(self.status)}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], d['name'], d['status'])
+
     @classmethod
     def parse(cls, s):
         match = APC_OUTLET_ROW_PATTERN.search(s)
@@ -95,3 +103,189 @@ class Outlets:
 
     def __iter__(self):
         return iter(self._d.values())
+
+    @classmethod
+    def parse_table(cls, s):
+        '''
+        Parse the outlet table screen, up to (excluding) its last row
+        '''
+        rows = s.strip().split("\n")
+        lst_outlets = []
+        for row in rows[:-1]:
+            row = row.strip()[3:]
+            ol = Outlet.parse(row)
+            lst_outlets.append(ol)
+        return cls(lst_outlets)
+
+    def to_list(self):
+        return [outlet.to_dict() for outlet in self]
+
+    def snapshot(self):
+        return OutletsSnapshot.from_outlets(self)
+
+    @classmethod
+    def from_list(cls, lst):
+        return cls([Outlet.from_dict(d) for d in lst])
+
+
+class OutletStreamParser:
+    '''
+    Incremental parser of an outlet table screen
+
+    feed() takes the bytes of the screen as they arrive and returns the
+    outlets of the rows completed so far.  Rows are found by pattern
+    rather than by column, so outlet numbers of any width and wide names
+    are fine.  Parsing starts after the header line (if given) and stops
+    at the end marker; the bytes after the marker are kept in remainder.
+    '''
+    def __init__(self, header=None, end='<ESC>'):
+        self.header = re.compile(header) if header is not None else None
+        self.end = end.encode('utf-8')
+        self.started = header is None
+        self.done = False
+        self.buffer = b''
+        self.remainder = b''
+
+    def feed(self, data):
+        if self.done:
+            self.remainder += data
+            return []
+        self.buffer += data
+        lst_outlets = []
+        while not self.done:
+            newline = self.buffer.find(b'\n')
+            if newline < 0:
+                break
+            line, self.buffer = self.buffer[:newline], self.buffer[newline + 1:]
+            self._parse_line(line, lst_outlets)
+        if not self.done and self.started:
+            # The end marker line is usually not terminated before the prompt
+            end = self.buffer.find(self.end)
+            if end >= 0:
+                self.done = True
+                self.buffer = self.buffer[end + len(self.end):]
+        if self.done:
+            self.remainder, self.buffer = self.buffer, b''
+        return lst_outlets
+
+    def _parse_line(self, line, lst_outlets):
+        if not self.started:
+            self.started = bool(self.header.search(line.decode('utf-8', 'replace')))
+            return
+        end = line.find(self.end)
+        if end >= 0:
+            self.done = True
+            self.buffer = line[end + len(self.end):] + b'\n' + self.buffer
+            return
+        try:
+            lst_outlets.append(Outlet.parse(line.decode('utf-8', 'replace')))
+        except OutletParseException:
+            pass  # blank lines, master control...
+
+
+# Outlet layouts (ids, names) shared by all the snapshots using them
+_IDS = {}
+_LAYOUTS = {}
+
+
+def _intern_layout(ids, names):
+    ids = _IDS.setdefault(ids, ids)
+    key = (ids, names)
+    layout = _LAYOUTS.get(key)
+    if layout is None:
+        names = tuple(sys.intern(name) for name in names)
+        index = dict((id, i) for i, id in enumerate(ids))
+        layout = _LAYOUTS[key] = (ids, names, index)
+    return layout
+
+
+class OutletsSnapshot(object):
+    '''
+    Compact, immutable Outlets
+
+    The outlet states are two bitmasks (bit i for the i-th outlet) and
+    the outlet ids and names are an interned layout shared by every
+    snapshot of the same PDU, so that comparing two snapshots does not
+    depend on the number of outlets.
+    '''
+    __slots__ = ('ids', 'names', '_index', 'on_mask', 'pending_mask', '_hash')
+
+    def __init__(self, ids, names, on_mask=0, pending_mask=0):
+        self.ids, self.names, self._index = _intern_layout(tuple(ids), tuple(names))
+        self.on_mask = on_mask
+        self.pending_mask = pending_mask
+        self._hash = hash((id(self.ids), id(self.names), on_mask, pending_mask))
+
+    @classmethod
+    def from_outlets(cls, outlets):
+        ids, names = [], []
+        on_mask = pending_mask = 0
+        for i, outlet in enumerate(outlets):
+            ids.append(outlet.id)
+            names.append(outlet.name)
+            if outlet.status.on:
+                on_mask |= 1 << i
+            if outlet.status.pending:
+                pending_mask |= 1 << i
+        return cls(ids, names, on_mask, pending_mask)
+
+    def __eq__(self, other):
+        if not isinstance(other, OutletsSnapshot):
+            return NotImplemented
+        masks = (self.on_mask, self.pending_mask) == (other.on_mask, other.pending_mask)
+        return self.ids is other.ids and self.names is other.names and masks
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return self._hash
+
+    def _status(self, i):
+        return OutletStatus(bool(self.on_mask >> i & 1), bool(self.pending_mask >> i & 1))
+
+    def _outlet(self, i):
+        return Outlet(self.ids[i], self.names[i], str(self._status(i)))
+
+    def status(self, key):
+        return self._status(self._index[key])
+
+    def __getitem__(self, key):
+        return self._outlet(self._index[key])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (self._outlet(i) for i in range(len(self.ids)))
+
+    def __str__(self):
+        return "\n".join(map(str, self))
+
+    def to_list(self):
+        return [outlet.to_dict() for outlet in self]
+
+    def diff(self, other):
+        '''
+        Outlets whose state changed from this snapshot to other
+
+        @return: list of (outlet id, old OutletStatus, new OutletStatus),
+            a status is None for an outlet missing from a snapshot
+        '''
+        if self.ids is other.ids:
+            changed = (self.on_mask ^ other.on_mask) | (self.pending_mask ^ other.pending_mask)
+            changes = []
+            while changed:
+                low = changed & -changed
+                i = low.bit_length() - 1
+                changes.append((self.ids[i], self._status(i), other._status(i)))
+                changed ^= low
+            return changes
+        changes = []
+        for id in self.ids + tuple(i for i in other.ids if i not in self._index):
+            old = self.status(id) if id in self._index else None
+            new = other.status(id) if id in other._index else None
+            if str(old) != str(new):
+                changes.append((id, old, new))
+        return changes
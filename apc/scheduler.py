@@ -0,0 +1,186 @@
+'''
+Delayed commands, kept and timed locally
+
+Instead of programming the Power On/Off Delay and Reboot Duration of the
+outlet (which takes several configuration menus, changes the outlet
+settings for good and only works with v3 firmwares), the daemon keeps
+delayed commands as jobs and sends a plain immediate command when each
+is due, which every driver supports.
+
+Jobs are in a heap by due time, so that thousands of them cost nothing
+while they wait.  With a path, they survive restarts: the journal file
+has one JSON object per line,
+
+    {"add": {"id": 12, "due": 1700000000.0, "request": {...}}}
+    {"cancel": 12}
+    {"done": 13}
+
+replayed and compacted on start.  The requests of the jobs carry the
+PDU credentials: the file is only readable by its owner.
+'''
+
+import heapq
+import json
+import os
+import threading
+import time
+
+
+SCHEDULER_MAX_LATENESS = 3600  # jobs due longer ago when loaded are dropped
+SCHEDULER_COMPACT_MIN  = 1000  # dead journal records tolerated before compaction
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, id, due, request):
+        self.id = id
+        self.due = due
+        self.request = request
+
+    def to_dict(self):
+        return {'id': self.id, 'due': self.due, 'request': self.request}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], d['due'], d['request'])
+
+    def __lt__(self, other):
+        return (self.due, self.id) < (other.due, other.id)
+
+
+class Scheduler(threading.Thread):
+    '''
+    Runs execute(job) for each job when it is due, in its own thread:
+    execute must hand the command over rather than wait for it
+
+    >>> scheduler = Scheduler(execute, 'jobs.journal')
+    >>> scheduler.start()
+    >>> job = scheduler.add(time.time() + 30, {'host': ..., 'op': 'reboot', ...})
+    >>> scheduler.cancel(job.id)
+    '''
+    def __init__(self, execute, path=None, max_lateness=SCHEDULER_MAX_LATENESS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.execute = execute
+        self.path = path
+        self.max_lateness = max_lateness
+        self.pending = {}
+        self.heap = []
+        self.next_id = 1
+        self.expired = []
+        self.dead = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.f = None
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # line cut short by a crash
+                    if 'add' in record:
+                        job = Job.from_dict(record['add'])
+                        jobs[job.id] = job
+                        self.next_id = max(self.next_id, job.id + 1)
+                    else:
+                        jobs.pop(record.get('cancel', record.get('done')), None)
+        now = time.time()
+        for job in jobs.values():
+            if job.due < now - self.max_lateness:
+                self.expired.append(job)
+            else:
+                self.pending[job.id] = job
+                self.heap.append(job)
+        heapq.heapify(self.heap)
+        self._compact()
+
+    def _compact(self):
+        # Rewrite the journal with the pending jobs only
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            for job in sorted(self.pending.values()):
+                f.write(json.dumps({'add': job.to_dict()}) + '\n')
+        os.rename(tmp, self.path)
+        if self.f is not None:
+            self.f.close()
+        self.f = open(self.path, 'a')
+        self.dead = 0
+
+    def _journal(self, record):
+        if self.f is None:
+            return
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        if 'add' not in record:
+            self.dead += 2  # the record and the job it ends
+            if self.dead > max(SCHEDULER_COMPACT_MIN, len(self.pending)):
+                self._compact()
+
+    def add(self, due, request):
+        '''
+        @return: the new Job
+        '''
+        with self.condition:
+            if self.stopped:
+                raise SchedulerException('Scheduler stopped')
+            job = Job(self.next_id, due, request)
+            self.next_id += 1
+            self._journal({'add': job.to_dict()})
+            self.pending[job.id] = job
+            heapq.heappush(self.heap, job)
+            if self.heap[0] is job:
+                self.condition.notify()
+            return job
+
+    def cancel(self, job_id):
+        '''
+        @return: the cancelled Job, None if there is no such pending job
+        '''
+        with self.condition:
+            job = self.pending.pop(job_id, None)
+            if job is not None:
+                # Left in the heap, skipped when it comes out
+                self._journal({'cancel': job_id})
+            return job
+
+    def jobs(self):
+        '''
+        Pending jobs, by due time
+        '''
+        with self.condition:
+            return sorted(self.pending.values())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    while self.heap and self.heap[0].id not in self.pending:
+                        heapq.heappop(self.heap)  # cancelled
+                    if self.heap and self.heap[0].due <= time.time():
+                        break
+                    timeout = self.heap[0].due - time.time() if self.heap else None
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                job = heapq.heappop(self.heap)
+                del self.pending[job.id]
+                self._journal({'done': job.id})
+            self.execute(job)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
@@ -0,0 +1,233 @@
+'''
+Staggered power sequencing
+
+Powers many outlets of many PDUs on (or off) without tripping breakers.
+A plan lists steps in groups, each outlet being on a circuit (a breaker
+or a feed).  The groups run one after the other; within a group the
+PDUs work in parallel, one session each, while each circuit limits the
+commands in flight on it and spaces their starts by its gap, so that
+the inrush currents do not add up.
+
+Plan files list the circuits and the steps, '#' starts a comment:
+
+    # circuit NAME LIMIT GAP (seconds between starts)
+    circuit   A    2     0.5
+    circuit   B    1     1
+    # GROUP ACTION HOST OUTLETS [CIRCUIT]
+    1       on     pdu1 1-8     A
+    1       on     pdu2 1-4     B
+    2       on     pdu2 5-8     B
+
+Outlets without a circuit are on the circuit of their PDU, named after
+the host, as are the circuits the plan does not declare.
+'''
+
+import collections
+import json
+import threading
+import time
+from apc.batch import BATCH_ACTIONS, BatchParseException, parse_outlets
+from apc.defaults import SEQUENCE_GAP
+
+
+SEQUENCE_LIMIT     = 1
+SEQUENCE_GROUP_GAP = 0
+
+
+class SequenceParseException(Exception):
+    pass
+
+
+class SequenceStep:
+    def __init__(self, group, action, host, outlet, circuit=None):
+        self.group = group
+        self.action = action
+        self.host = host
+        self.outlet = outlet
+        self.circuit = circuit or host
+
+    def __str__(self):
+        return 'group %d: %s %s outlet %s' % (self.group, self.action, self.host, self.outlet)
+
+
+class Circuit:
+    '''
+    Number of commands in flight on a circuit, and the time between
+    their starts
+    '''
+    def __init__(self, name, limit=SEQUENCE_LIMIT, gap=SEQUENCE_GAP):
+        self.name = name
+        self.limit = limit
+        self.gap = gap
+        self.slots = threading.Semaphore(limit)
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def acquire(self):
+        self.slots.acquire()
+        # Reserve a start time: the waiters are served in turn
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.gap
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self):
+        self.slots.release()
+
+
+def parse_plan(lines):
+    '''
+    @return: (list of SequenceStep, dict circuit name -> Circuit)
+    '''
+    steps = []
+    circuits = {}
+    for number, line in enumerate(lines, 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == 'circuit':
+                if len(words) not in (3, 4):
+                    raise ValueError()
+                gap = float(words[3]) if len(words) == 4 else SEQUENCE_GAP
+                circuits[words[1]] = Circuit(words[1], int(words[2]), gap)
+                continue
+            if len(words) not in (4, 5) or words[1].lower() not in BATCH_ACTIONS:
+                raise ValueError()
+            group = int(words[0])
+            circuit = words[4] if len(words) == 5 else None
+            for outlet in parse_outlets(words[3]):
+                steps.append(SequenceStep(group, words[1].lower(), words[2], outlet, circuit))
+        except (ValueError, BatchParseException):
+            raise SequenceParseException('Bad plan line %d: [%s]' % (number, line.strip()))
+    if not steps:
+        raise SequenceParseException('Empty plan')
+    return steps, circuits
+
+
+def read_plan(path):
+    with open(path) as f:
+        return parse_plan(f)
+
+
+class Sequencer:
+    '''
+    Runs the steps of a plan
+
+    >>> sequencer = Sequencer(lambda host: APCSession(host, user, password))
+    >>> timeline = sequencer.run(steps)
+
+    @param connect: function returning the session (APCSession, APCClient
+        or driver) of a host; it is closed (or disconnected) at the end
+    @param circuits: dict name -> Circuit; the others get limit and gap
+    @param group_gap: seconds between the end of a group and the next one
+    @param keep_going: run the next groups even if a step failed
+    @param progress: function called with each event of the timeline
+    '''
+    def __init__(self, connect, circuits=None, limit=SEQUENCE_LIMIT, gap=SEQUENCE_GAP,
+                 group_gap=SEQUENCE_GROUP_GAP, duration=5, keep_going=False, progress=None):
+        self.connect = connect
+        self.circuits = dict(circuits or {})
+        self.limit = limit
+        self.gap = gap
+        self.group_gap = group_gap
+        self.duration = duration
+        self.keep_going = keep_going
+        self.progress = progress
+        self.lock = threading.Lock()
+
+    def circuit(self, name):
+        with self.lock:
+            if name not in self.circuits:
+                self.circuits[name] = Circuit(name, self.limit, self.gap)
+            return self.circuits[name]
+
+    def run(self, steps):
+        '''
+        @return: the timeline, one dict per step run (group, action,
+            host, outlet, circuit, start and end in seconds since the
+            start of the run, error or None), in the order they ended
+        '''
+        self.start = time.time()
+        self.timeline = []
+        sessions = {}
+        # Hosts which could not be connected to: their steps fail at once
+        self.unreachable = {}
+        groups = collections.OrderedDict()
+        for step in sorted(steps, key=lambda step: step.group):
+            groups.setdefault(step.group, collections.OrderedDict()).setdefault(
+                step.host, []).append(step)
+        try:
+            for i, hosts in enumerate(groups.values()):
+                if i and self.group_gap:
+                    time.sleep(self.group_gap)
+                # One thread per PDU: its steps share its single session
+                threads = [threading.Thread(target=self._run_host,
+                                            args=(host, host_steps, sessions))
+                           for (host, host_steps) in hosts.items()]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                if not self.keep_going and any(e['error'] for e in self.timeline):
+                    break
+        finally:
+            for session in sessions.values():
+                close = getattr(session, 'close', None) or session.disconnect
+                try:
+                    close()
+                except Exception:
+                    pass  # the session of a failed PDU
+        return self.timeline
+
+    def _run_host(self, host, steps, sessions):
+        for step in steps:
+            if host not in sessions and host not in self.unreachable:
+                # Logins take their own time: only the commands take a slot
+                try:
+                    sessions[host] = self.connect(host)
+                except (Exception, SystemExit) as e:
+                    self.unreachable[host] = 'Cannot connect: %s' % (
+                        str(e) or e.__class__.__name__)
+            if host in self.unreachable:
+                now = time.time()
+                self._record(step, now, now, self.unreachable[host])
+                continue
+            session = sessions[host]
+            circuit = self.circuit(step.circuit)
+            circuit.acquire()
+            start = time.time()
+            error = None
+            try:
+                if step.action == 'reboot':
+                    session.reboot(step.outlet, 0, self.duration)
+                else:
+                    getattr(session, step.action)(step.outlet, 0)
+            except (Exception, SystemExit) as e:
+                error = str(e) or e.__class__.__name__
+            finally:
+                circuit.release()
+            self._record(step, start, time.time(), error)
+
+    def _record(self, step, start, end, error):
+        event = {'group': step.group, 'action': step.action, 'host': step.host,
+                 'outlet': step.outlet, 'circuit': step.circuit,
+                 'start': round(start - self.start, 3), 'end': round(end - self.start, 3),
+                 'error': error}
+        with self.lock:
+            self.timeline.append(event)
+        if self.progress is not None:
+            self.progress(event)
+
+
+def format_event(event):
+    return '%8.2fs %8.2fs  group %-3d %-6s %s outlet %s (circuit %s)%s' % (
+        event['start'], event['end'], event['group'], event['action'], event['host'],
+        event['outlet'], event['circuit'],
+        '' if event['error'] is None else '  FAILED: %s' % event['error'])
+
+
+def format_timeline_json(timeline):
+    return '\n'.join(json.dumps(event) for event in timeline)
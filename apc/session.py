@@ -0,0 +1,131 @@
+'''
+Persistent APC session
+
+Logs in once and serves any number of commands over the same telnet
+session, reconnecting transparently when the PDU drops it (between two
+operations, or before an operation sent its outlet command).
+'''
+
+import time
+import pexpect
+from apc.utility import APC, APC_DEFAULT_LOCK_DIR, APC_DEFAULT_TRANSPORT, Deadline
+
+
+# APC management cards log telnet users out after 3 minutes of
+# inactivity by default: reconnect proactively a bit before that.
+SESSION_IDLE_TIMEOUT = 170
+
+
+class APCSession:
+    '''
+    Long-lived APC connection
+
+    >>> with APCSession(host, user, password) as session:
+    ...     session.off(1)
+    ...     session.on(2)
+    ...     print(session.status())
+
+    The host lock is held for the whole life of the session since the
+    PDU only accepts a single telnet session.  With status_ttl, status()
+    results are reused for that many seconds; commands sent through the
+    session update them.  With timings (an apc.timing.Timings), the
+    phases of each connection and operation are timed.  With health (an
+    apc.health.HealthTracker), connecting to a host found unreachable time
+    after time fails fast.  With deadline, each operation, including the
+    reconnection it may need, is given up after that many seconds.
+    '''
+    def __init__(self, host, user, password, verbose=False, quiet=False, cli='',
+                 lock_dir=APC_DEFAULT_LOCK_DIR, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 status_ttl=0, timings=None, transport=APC_DEFAULT_TRANSPORT,
+                 health=None, deadline=None):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.verbose = verbose
+        self.quiet = quiet
+        self.cli = cli
+        self.lock_dir = lock_dir
+        self.idle_timeout = idle_timeout
+        self.status_ttl = status_ttl
+        self.timings = timings
+        self.transport = transport
+        self.health = health
+        self.deadline = deadline
+        self.apc = None
+        self.last_used = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def connected(self):
+        return self.apc is not None
+
+    def connect(self, deadline=None):
+        self.apc = APC(self.host, self.user, self.password, self.verbose,
+                       self.quiet, self.cli, self.lock_dir, timings=self.timings,
+                       transport=self.transport, health=self.health,
+                       deadline=deadline if deadline is not None else self.deadline)
+        self.apc.status_ttl = self.status_ttl
+        self.last_used = time.time()
+
+    def close(self):
+        if self.apc is None:
+            return
+        apc, self.apc = self.apc, None
+        try:
+            apc.disconnect()
+        except (pexpect.EOF, pexpect.TIMEOUT, OSError):
+            pass  # session already gone: disconnect() hung up and unlocked
+
+    def reconnect(self, deadline=None):
+        self.close()
+        self.connect(deadline)
+
+    def _expired(self):
+        if self.apc is None or not self.apc.child.isalive():
+            return True
+        return time.time() - self.last_used >= self.idle_timeout
+
+    def _call(self, name, *args):
+        deadline = Deadline(self.deadline)
+        if self._expired():
+            self.reconnect(deadline)
+        try:
+            self.apc.deadline = deadline
+            self.apc.command_sent = False
+            try:
+                result = getattr(self.apc, name)(*args)
+            except pexpect.EOF:
+                # The PDU closed the session under us (idle timeout).  Once
+                # a command is sent it may have run: a reboot is not retried
+                if self.apc.command_sent:
+                    self.close()
+                    raise
+                self.reconnect(deadline)
+                result = getattr(self.apc, name)(*args)
+        finally:
+            if self.apc is not None:
+                self.apc.deadline = Deadline()  # none between the operations
+        self.last_used = time.time()
+        return result
+
+    def status(self):
+        return self._call('status')
+
+    def read_status(self):
+        # Bypasses the status cache
+        return self._call('read_status')
+
+    def on(self, outlet, delay=0):
+        return self._call('on', outlet, delay)
+
+    def off(self, outlet, delay=0):
+        return self._call('off', outlet, delay)
+
+    def reboot(self, outlet, delay=0, duration=5):
+        return self._call('reboot', outlet, delay, duration)
@@ -0,0 +1,431 @@
+'''
+SNMP access to the PDUs
+
+The network management cards also serve the PowerNet MIB over SNMP:
+all the outlet states come in a single GETBULK request, and a command
+is a single SET, with no login nor menus.  This module has what the
+SNMP driver (apc.utility.SNMPAPC) and the emulator's agent need:
+
+- a minimal BER codec of SNMPv2c messages
+- SNMPClient, a blocking UDP client with retries
+- the outlet tables of the PowerNet MIB: rPDU (Rack PDUs, firmware v3)
+  and sPDU (MasterSwitch, earlier firmware)
+
+OIDs are tuples of integers.
+'''
+
+import os
+import random
+import re
+import select
+import socket
+import time
+from apc.transport import TransportError, split_host
+
+
+SNMP_PORT            = 161
+SNMP_TIMEOUT         = 2
+SNMP_RETRIES         = 2
+SNMP_MAX_REPETITIONS = 24  # outlets of the largest Rack PDUs, in one GETBULK
+
+SNMP_DEFAULT_COMMUNITY = os.environ.get('APC_SNMP_COMMUNITY', 'private')
+
+SNMP_VERSION_2C = 1
+
+# BER tags
+INTEGER      = 0x02
+OCTET_STRING = 0x04
+NULL         = 0x05
+OID          = 0x06
+SEQUENCE     = 0x30
+IP_ADDRESS   = 0x40
+COUNTER32    = 0x41
+GAUGE32      = 0x42
+TIMETICKS    = 0x43
+COUNTER64    = 0x46
+
+# PDU types
+GET_REQUEST      = 0xa0
+GET_NEXT_REQUEST = 0xa1
+GET_RESPONSE     = 0xa2
+SET_REQUEST      = 0xa3
+GET_BULK_REQUEST = 0xa5
+
+SNMP_ERRORS = {
+    1: 'tooBig', 2: 'noSuchName', 3: 'badValue', 4: 'readOnly', 5: 'genErr',
+    6: 'noAccess', 7: 'wrongType', 10: 'wrongValue', 16: 'authorizationError',
+    17: 'notWritable',
+}
+
+SYS_DESCR = (1, 3, 6, 1, 2, 1, 1, 1, 0)
+
+# The application firmware in sysDescr, e.g. '(MB:v3.9.2 PF:v3.7.3 ... AF1:v3.7.4 ...)'
+SNMP_VERSION_PATTERN = re.compile(r'AF1:v(\d+\.\d+\.\d+)')
+SNMP_ANY_VERSION_PATTERN = re.compile(r'v(\d+\.\d+\.\d+)')
+
+
+class SNMPError(TransportError):
+    pass
+
+
+class SNMPTimeout(SNMPError):
+    pass
+
+
+class _Missing(object):
+    '''
+    Value of a variable the agent does not have (SNMPv2 exceptions)
+    '''
+    def __init__(self, tag, name):
+        self.tag = tag
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+NO_SUCH_OBJECT   = _Missing(0x80, 'noSuchObject')
+NO_SUCH_INSTANCE = _Missing(0x81, 'noSuchInstance')
+END_OF_MIB_VIEW  = _Missing(0x82, 'endOfMibView')
+
+_MISSING = dict((m.tag, m) for m in (NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW))
+
+
+def oid(s):
+    '''
+    OID tuple of a dotted string
+    '''
+    return tuple(int(n) for n in s.strip('.').split('.'))
+
+
+def _length(n):
+    if n < 0x80:
+        return bytes([n])
+    b = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(b)]) + b
+
+
+def _in_column(binding, column, index):
+    # Whether a binding of a GETBULK row is the cell of column at index
+    (name, value) = binding
+    if isinstance(value, _Missing):
+        return False
+    return name[:len(column)] == column and name[len(column):] == index
+
+
+def _tlv(tag, payload):
+    return bytes([tag]) + _length(len(payload)) + payload
+
+
+def _encode_integer(n):
+    return n.to_bytes(((n + (n < 0)).bit_length() + 8) // 8, 'big', signed=True)
+
+
+def _encode_oid(o):
+    values = [o[0] * 40 + o[1]] + list(o[2:])
+    payload = b''
+    for n in values:
+        chunk = [n & 0x7f]
+        n >>= 7
+        while n:
+            chunk.append(0x80 | (n & 0x7f))
+            n >>= 7
+        payload += bytes(reversed(chunk))
+    return payload
+
+
+def encode(value):
+    '''
+    BER encoding of an int, bytes (or str), None, OID tuple or missing value
+    '''
+    if isinstance(value, _Missing):
+        return _tlv(value.tag, b'')
+    elif value is None:
+        return _tlv(NULL, b'')
+    elif isinstance(value, int):
+        return _tlv(INTEGER, _encode_integer(value))
+    elif isinstance(value, str):
+        return _tlv(OCTET_STRING, value.encode('utf-8'))
+    elif isinstance(value, bytes):
+        return _tlv(OCTET_STRING, value)
+    elif isinstance(value, tuple):
+        return _tlv(OID, _encode_oid(value))
+    raise SNMPError('Cannot encode %r' % (value,))
+
+
+def _decode_oid(payload):
+    values = []
+    n = 0
+    for byte in bytearray(payload):
+        n = (n << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            values.append(n)
+            n = 0
+    if not values:
+        return ()
+    first = min(values[0] // 40, 2)
+    return (first, values[0] - first * 40) + tuple(values[1:])
+
+
+def decode(data, offset=0):
+    '''
+    Decode the BER element at offset
+
+    @return: (tag, value, offset after the element); the value of a
+        SEQUENCE or PDU is the list of (tag, value) of its elements
+    '''
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+        end = offset + length
+        if end > len(data):
+            raise SNMPError('Truncated BER element')
+        payload = data[offset:end]
+    except IndexError:
+        raise SNMPError('Truncated BER element')
+    if tag == SEQUENCE or 0xa0 <= tag <= 0xa8:
+        elements = []
+        while offset < end:
+            (t, v, offset) = decode(data, offset)
+            elements.append((t, v))
+        return tag, elements, end
+    if tag == INTEGER:
+        value = int.from_bytes(payload, 'big', signed=True)
+    elif tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64):
+        value = int.from_bytes(payload, 'big')
+    elif tag == NULL:
+        value = None
+    elif tag == OID:
+        value = _decode_oid(payload)
+    elif tag in _MISSING:
+        value = _MISSING[tag]
+    else:
+        value = bytes(payload)  # OCTET STRING, IpAddress, Opaque...
+    return tag, value, end
+
+
+def encode_message(community, pdu_type, request_id, varbinds, error_status=0,
+                   error_index=0):
+    '''
+    SNMPv2c message; for GETBULK, error_status and error_index are the
+    non-repeaters and max-repetitions
+
+    @param varbinds: list of (OID, value)
+    '''
+    if isinstance(community, str):
+        community = community.encode('utf-8')
+    bindings = b''.join(_tlv(SEQUENCE, encode(name) + encode(value))
+                        for (name, value) in varbinds)
+    header = encode(request_id) + encode(error_status) + encode(error_index)
+    pdu = _tlv(pdu_type, header + _tlv(SEQUENCE, bindings))
+    return _tlv(SEQUENCE, encode(SNMP_VERSION_2C) + encode(community) + pdu)
+
+
+def decode_message(data):
+    '''
+    @return: (version, community, PDU type, request id, error status,
+        error index, list of (OID, value))
+    '''
+    (tag, message, end) = decode(data)
+    try:
+        (_, version), (_, community), (pdu_type, pdu) = message
+        (_, request_id), (_, error_status), (_, error_index), (_, bindings) = pdu
+        varbinds = [(name, value) for ((_, name), (_, value)) in
+                    (binding for (_, binding) in bindings)]
+    except (TypeError, ValueError):
+        raise SNMPError('Malformed SNMP message')
+    return version, community, pdu_type, request_id, error_status, error_index, varbinds
+
+
+class SNMPClient:
+    '''
+    SNMPv2c client of one agent
+
+    Requests are retried on timeout; answers to earlier requests are
+    ignored.
+    '''
+    def __init__(self, host, community=SNMP_DEFAULT_COMMUNITY, port=SNMP_PORT,
+                 timeout=SNMP_TIMEOUT, retries=SNMP_RETRIES):
+        self.host = host
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+        try:
+            (family, kind, proto, _, address) = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_DGRAM)[0]
+            self.sock = socket.socket(family, kind, proto)
+            self.sock.connect(address)
+        except (OSError, socket.gaierror) as e:
+            raise SNMPError('Cannot reach %s:%d: %s' % (host, port, e))
+        self.request_id = random.randint(1, 0x7fffffff)
+
+    def isalive(self):
+        return self.sock.fileno() >= 0
+
+    def close(self, force=False):
+        self.sock.close()
+
+    def request(self, pdu_type, varbinds, error_status=0, error_index=0):
+        '''
+        @return: the list of (OID, value) of the response
+        '''
+        self.request_id = self.request_id % 0x7fffffff + 1
+        message = encode_message(self.community, pdu_type, self.request_id, varbinds,
+                                 error_status, error_index)
+        for attempt in range(self.retries + 1):
+            try:
+                self.sock.send(message)
+            except OSError as e:
+                raise SNMPError('Cannot reach %s: %s' % (self.host, e))
+            deadline = time.time() + self.timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                ready, _, _ = select.select([self.sock], [], [], remaining)
+                if not ready:
+                    break
+                try:
+                    answer = decode_message(self.sock.recv(65535))
+                except (OSError, SNMPError):
+                    continue  # ICMP unreachable, garbage: wait for the next
+                (_, _, kind, request_id, status, index, bindings) = answer
+                if kind != GET_RESPONSE or request_id != self.request_id:
+                    continue
+                if status:
+                    name = bindings[index - 1][0] if 0 < index <= len(bindings) else ()
+                    raise SNMPError('%s: %s on %s' % (self.host,
+                                                      SNMP_ERRORS.get(status, status),
+                                                      '.'.join(map(str, name))))
+                return bindings
+        raise SNMPTimeout('%s: no SNMP answer' % self.host)
+
+    def get(self, oids):
+        '''
+        @return: the values of oids
+        '''
+        return [value for (name, value) in
+                self.request(GET_REQUEST, [(o, None) for o in oids])]
+
+    def set(self, varbinds):
+        self.request(SET_REQUEST, varbinds)
+
+    def walk_columns(self, columns, max_repetitions=SNMP_MAX_REPETITIONS):
+        '''
+        Rows of a table, by GETBULK of the columns side by side
+
+        @return: list of (row index, list of the column values)
+        '''
+        rows = []
+        last = list(columns)
+        while True:
+            bindings = self.request(GET_BULK_REQUEST, [(o, None) for o in last],
+                                    0, max_repetitions)
+            for start in range(0, len(bindings) - len(columns) + 1, len(columns)):
+                row = bindings[start:start + len(columns)]
+                index = row[0][0][len(columns[0]):]
+                if not all(_in_column(binding, column, index)
+                           for (binding, column) in zip(row, columns)):
+                    return rows
+                rows.append((index, [value for (name, value) in row]))
+                last = [name for (name, value) in row]
+            if len(bindings) < len(columns):
+                return rows
+
+
+def split_community(host):
+    '''
+    Community and host of 'community@host', or of 'host' with the
+    default community
+    '''
+    community, _, host = host.rpartition('@')
+    return community or SNMP_DEFAULT_COMMUNITY, host
+
+
+def connect(host, timeout=SNMP_TIMEOUT):
+    '''
+    SNMPClient of host, given as [community@]host[:port]
+    '''
+    community, host = split_community(host)
+    address, port = split_host(host, SNMP_PORT)
+    return SNMPClient(address, community, port, timeout)
+
+
+def firmware_version(client):
+    '''
+    Firmware version of the agent, from its sysDescr
+    '''
+    descr = client.get([SYS_DESCR])[0]
+    if isinstance(descr, bytes):
+        descr = descr.decode('utf-8', 'replace')
+    descr = str(descr)
+    match = SNMP_VERSION_PATTERN.search(descr) or SNMP_ANY_VERSION_PATTERN.search(descr)
+    if not match:
+        raise SNMPError('Could not parse APC version')
+    return match.group(1)
+
+
+class RackPDUMIB:
+    '''
+    PowerNet MIB, rPDU outlet tables (Rack PDUs, firmware v3)
+    '''
+    # Outlets: name, state, pending command
+    STATUS_COLUMNS  = (oid('1.3.6.1.4.1.318.1.1.12.3.5.1.1.2'),
+                       oid('1.3.6.1.4.1.318.1.1.12.3.5.1.1.4'),
+                       oid('1.3.6.1.4.1.318.1.1.12.3.5.1.1.5'))
+    STATE_ON        = 1
+    PENDING         = 1
+    NOT_PENDING     = 2
+
+    OUTLET_COMMAND  = oid('1.3.6.1.4.1.318.1.1.12.3.3.1.1.4')
+    OUTLET_COMMANDS = {'on': 1, 'off': 2, 'reboot': 3, 'delayed on': 4,
+                       'delayed off': 5, 'delayed reboot': 6, 'cancel': 7}
+    # All the outlets at once
+    DEVICE_COMMAND  = oid('1.3.6.1.4.1.318.1.1.12.3.1.1.0')
+    DEVICE_COMMANDS = {'on': 2, 'off': 3, 'reboot': 4, 'delayed on': 5,
+                       'delayed off': 6, 'delayed reboot': 8, 'cancel': 10}
+    NO_DEVICE_COMMAND = 1
+
+    ON_DELAY        = oid('1.3.6.1.4.1.318.1.1.12.3.4.1.1.4')
+    OFF_DELAY       = oid('1.3.6.1.4.1.318.1.1.12.3.4.1.1.5')
+    REBOOT_DURATION = oid('1.3.6.1.4.1.318.1.1.12.3.4.1.1.6')
+
+
+class MasterSwitchMIB:
+    '''
+    PowerNet MIB, sPDU outlet tables (MasterSwitch, firmware v2)
+    '''
+    # sPDUOutletCtlName, sPDUOutletCtl (reads outletOn/outletOff), sPDUOutletPending
+    STATUS_COLUMNS  = (oid('1.3.6.1.4.1.318.1.1.4.4.2.1.4'),
+                       oid('1.3.6.1.4.1.318.1.1.4.4.2.1.3'),
+                       oid('1.3.6.1.4.1.318.1.1.4.4.2.1.2'))
+    STATE_ON        = 1
+    PENDING         = 1
+    NOT_PENDING     = 2
+
+    OUTLET_COMMAND  = oid('1.3.6.1.4.1.318.1.1.4.4.2.1.3')
+    OUTLET_COMMANDS = {'on': 1, 'off': 2, 'reboot': 3, 'delayed on': 5,
+                       'delayed off': 6, 'delayed reboot': 7}
+    # sPDUMasterControlSwitch: the delayed commands are its sequences
+    DEVICE_COMMAND  = oid('1.3.6.1.4.1.318.1.1.4.2.1.0')
+    DEVICE_COMMANDS = {'on': 1, 'off': 3, 'reboot': 4, 'delayed on': 2,
+                       'delayed off': 7, 'delayed reboot': 5}
+    NO_DEVICE_COMMAND = 6
+
+    ON_DELAY        = oid('1.3.6.1.4.1.318.1.1.4.5.2.1.2')
+    OFF_DELAY       = oid('1.3.6.1.4.1.318.1.1.4.5.2.1.4')
+    REBOOT_DURATION = oid('1.3.6.1.4.1.318.1.1.4.5.2.1.5')
+
+
+def mib_class(version):
+    '''
+    Outlet tables of the firmware version, as driver_class() for the menus
+    '''
+    if version[0] == '3':
+        return RackPDUMIB
+    return MasterSwitchMIB
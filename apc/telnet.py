@@ -0,0 +1,92 @@
+'''
+Minimal telnet protocol (RFC 854) handling for in-process clients
+
+The APC only needs the server to echo and to suppress go-ahead; every
+other option is refused.
+'''
+
+IAC  = 255
+DONT = 254
+DO   = 253
+WONT = 252
+WILL = 251
+SB   = 250
+SE   = 240
+
+ECHO = 1
+SGA  = 3  # suppress go-ahead
+
+# Options we let the server enable on its side / enable on ours
+ACCEPTED_REMOTE = (ECHO, SGA)
+ACCEPTED_LOCAL  = (SGA,)
+
+_DATA, _IAC, _OPTION, _SB, _SB_IAC = range(5)
+
+
+def escape(data):
+    '''
+    Double the IAC bytes of outgoing data
+    '''
+    return data.replace(bytes(bytearray([IAC])), bytes(bytearray([IAC, IAC])))
+
+
+class TelnetParser:
+    '''
+    Incremental telnet decoder
+
+    feed() splits the received bytes in payload and the negotiation
+    answers to send back to the server.
+    '''
+    def __init__(self):
+        self.state = _DATA
+        self.command = None
+        self.remote = set()
+        self.local = set()
+
+    def feed(self, data):
+        payload = bytearray()
+        reply = bytearray()
+        for byte in bytearray(data):
+            if self.state == _DATA:
+                if byte == IAC:
+                    self.state = _IAC
+                else:
+                    payload.append(byte)
+            elif self.state == _IAC:
+                if byte == IAC:
+                    payload.append(IAC)
+                    self.state = _DATA
+                elif byte in (DO, DONT, WILL, WONT):
+                    self.command = byte
+                    self.state = _OPTION
+                elif byte == SB:
+                    self.state = _SB
+                else:  # NOP, GA, ...
+                    self.state = _DATA
+            elif self.state == _OPTION:
+                reply += self.negotiate(self.command, byte)
+                self.state = _DATA
+            elif self.state == _SB:
+                if byte == IAC:
+                    self.state = _SB_IAC
+            elif self.state == _SB_IAC:
+                self.state = _DATA if byte == SE else _SB
+        return bytes(payload), bytes(reply)
+
+    def negotiate(self, command, option):
+        # Only answer requests that change an option state, to avoid loops
+        if command in (WILL, WONT):
+            enabled = command == WILL and option in ACCEPTED_REMOTE
+            options, answer = self.remote, (DO if enabled else DONT)
+        else:
+            enabled = command == DO and option in ACCEPTED_LOCAL
+            options, answer = self.local, (WILL if enabled else WONT)
+        if enabled:
+            if option in options:
+                return b''
+            options.add(option)
+        else:
+            if command in (WONT, DONT) and option not in options:
+                return b''
+            options.discard(option)
+        return bytes(bytearray([IAC, answer, option]))
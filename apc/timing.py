@@ -0,0 +1,135 @@
+'''
+Per-phase timing of APC operations
+
+A session goes through these phases, each timed per host and operation:
+
+- lock: waiting for the host lock
+- spawn: opening the connection (or starting the cli command)
+- login: from the user name prompt to the main menu
+- navigate: walking the menus to the outlet (or status) screen
+- read: reading the status table
+- configure: changing the delays of an outlet (delayed commands, reboots)
+- confirm: confirming a command and checking its acknowledgement
+- logout: leaving the menus and closing the session
+
+Timings keeps the events and aggregates them into histograms, written
+in the Prometheus text format for node_exporter's textfile collector.
+'''
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+TIMING_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TIMING_EVENTS  = 1000  # recent events kept
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(TIMING_BUCKETS)
+        self.sum = 0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, ok):
+        for i, bound in enumerate(TIMING_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+        if not ok:
+            self.errors += 1
+
+
+def _labels(host, operation, phase):
+    return 'host="%s",operation="%s",phase="%s"' % tuple(
+        s.replace('\\', '\\\\').replace('"', '\\"') for s in (host, operation, phase))
+
+
+class Timings:
+    '''
+    Collector of phase timings, shared by any number of sessions
+
+    >>> timings = Timings()
+    >>> apc = APC(host, user, password, timings=timings)
+    >>> timings.events[-1]
+    {'host': ..., 'operation': 'connect', 'phase': 'login', 'seconds': 1.2, ...}
+
+    Listeners are called with each event as it is recorded.
+    '''
+    def __init__(self):
+        self.events = collections.deque(maxlen=TIMING_EVENTS)
+        self.histograms = collections.OrderedDict()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, host, operation, phase):
+        '''
+        Time the enclosed block; it is recorded as failed if it raises
+        '''
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(host, operation, phase, time.time() - start, ok)
+
+    def record(self, host, operation, phase, seconds, ok=True):
+        event = {'time': time.time(), 'host': host, 'operation': operation, 'phase': phase,
+                 'seconds': seconds, 'ok': ok}
+        with self.lock:
+            self.events.append(event)
+            key = (host, operation, phase)
+            if key not in self.histograms:
+                self.histograms[key] = _Histogram()
+            self.histograms[key].observe(seconds, ok)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(event)
+
+    def prometheus(self):
+        '''
+        Histograms in the Prometheus text exposition format
+        '''
+        lines = ['# HELP apc_phase_seconds Duration of the phases of APC operations',
+                 '# TYPE apc_phase_seconds histogram']
+        errors = ['# HELP apc_phase_errors_total APC operation phases which failed',
+                  '# TYPE apc_phase_errors_total counter']
+        with self.lock:
+            for (host, operation, phase), h in self.histograms.items():
+                labels = _labels(host, operation, phase)
+                for bound, count in zip(TIMING_BUCKETS, h.counts):
+                    lines.append('apc_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+                lines.append('apc_phase_seconds_bucket{%s,le="+Inf"} %d' % (labels, h.count))
+                lines.append('apc_phase_seconds_sum{%s} %f' % (labels, h.sum))
+                lines.append('apc_phase_seconds_count{%s} %d' % (labels, h.count))
+                errors.append('apc_phase_errors_total{%s} %d' % (labels, h.errors))
+        return '\n'.join(lines + errors) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Write the histograms to path atomically, for a textfile collector
+        '''
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp, path)
+
+    def format_table(self):
+        with self.lock:
+            events = list(self.events)
+        lines = ['%-20s %-12s %-9s %9s' % ('host', 'operation', 'phase', 'seconds')]
+        for e in events:
+            lines.append('%-20s %-12s %-9s %9.3f%s' % (e['host'], e['operation'], e['phase'],
+                                                       e['seconds'], '' if e['ok'] else ' FAILED'))
+        return '\n'.join(lines)
+
+    def format_json(self):
+        with self.lock:
+            return '\n'.join(json.dumps(e) for e in self.events)
@@ -0,0 +1,202 @@
+'''
+Session transcripts
+
+A transcript is the byte stream of a PDU session, one JSON object per
+line with the time (seconds since the session started) and the bytes
+sent or received, as latin-1 text:
+
+    {"t": 0.0123, "recv": "User Name : "}
+    {"t": 0.0131, "send": "apc\r\n"}
+
+The password sent at login, and its echo, are recorded as <password>,
+in a file only its owner may read.
+
+TranscriptRecorder captures one from a live pexpect child, ReplaySpawn
+plays it back to a driver in place of the PDU.
+'''
+
+import json
+import os
+import time
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+
+# Recorded in place of the password
+TRANSCRIPT_REDACTED = b'<password>'
+
+
+class TranscriptMismatch(Exception):
+    '''
+    The driver sent something else than the recorded session
+    '''
+    pass
+
+
+def read_transcript(path):
+    '''
+    @return: list of (time, 'send' or 'recv', bytes)
+    '''
+    events = []
+    with open(path) as f:
+        for line in f:
+            d = json.loads(line)
+            kind = 'send' if 'send' in d else 'recv'
+            events.append((d['t'], kind, d[kind].encode('latin-1')))
+    return events
+
+
+class _TranscriptLog:
+    # pexpect logfile_read / logfile_send adapter
+    def __init__(self, recorder, kind):
+        self.recorder = recorder
+        self.kind = kind
+
+    def write(self, data):
+        self.recorder.record(self.kind, data)
+
+    def flush(self):
+        pass
+
+
+class TranscriptRecorder:
+    '''
+    Record everything child (a pexpect spawn) reads and sends into path,
+    but password
+    '''
+    def __init__(self, child, path, password=None):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # the file may have been there
+        self.f = os.fdopen(fd, 'w', buffering=1)
+        self.start = time.time()
+        self.password = password.encode('utf-8') if password else None
+        # Redacted from what is received until the next send, once sent
+        self.echo = None
+        child.logfile_read = _TranscriptLog(self, 'recv')
+        child.logfile_send = _TranscriptLog(self, 'send')
+
+    def record(self, kind, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if kind == 'send':
+            self.echo = None
+            if self.password is not None and data.rstrip(b'\r\n') == self.password:
+                data = TRANSCRIPT_REDACTED + data[len(self.password):]
+                self.echo = self.password
+        elif self.echo is not None:
+            data = data.replace(self.echo, TRANSCRIPT_REDACTED)
+        if data:
+            self.f.write(json.dumps({'t': round(time.time() - self.start, 6),
+                                     kind: data.decode('latin-1')}) + '\n')
+
+
+class ReplaySpawn(SpawnBase):
+    '''
+    pexpect child replaying a transcript
+
+    The received bytes are released in order, each once the driver has
+    sent what preceded it in the transcript, after the recorded delay
+    divided by speed; with speed None nothing is waited for.  A redacted
+    password matches any line sent.  Counters of keystrokes (send calls)
+    and bytes are kept for benchmarks.
+    '''
+    def __init__(self, events, speed=None, timeout=10):
+        SpawnBase.__init__(self, timeout=timeout)
+        self.speed = speed
+        self.sends = []
+        self.recvs = []
+        for (t, kind, data) in events:
+            if kind == 'send':
+                self.sends.append((t, data))
+            else:
+                # Released once all the sends recorded before it are matched
+                self.recvs.append((t, len(self.sends), data))
+        self.matched = 0
+        self.unmatched = b''
+        self.cursor = 0
+        self.pending = b''
+        # Wall time and transcript time of the last matched send
+        self.origin = (time.time(), 0)
+        self.keystrokes = 0
+        self.bytes_sent = 0
+        self.bytes_read = 0
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        if not self.pending:
+            if self.cursor >= len(self.recvs):
+                self.flag_eof = True
+                raise pexpect.EOF('End of transcript')
+            (t, sends, data) = self.recvs[self.cursor]
+            if sends > self.matched:
+                if self.speed and timeout:
+                    time.sleep(timeout)
+                raise pexpect.TIMEOUT('Transcript waits for %r' % self.sends[self.matched][1])
+            wait = 0
+            if self.speed:
+                (wall, start) = self.origin
+                wait = wall + (t - start) / self.speed - time.time()
+            if timeout is not None and wait > timeout:
+                time.sleep(timeout)
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            if wait > 0:
+                time.sleep(wait)
+            self.cursor += 1
+            self.pending = data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.bytes_read += len(data)
+        self._log(data, 'read')
+        return data
+
+    def send(self, s):
+        if isinstance(s, str):
+            s = s.encode('utf-8')
+        self._log(s, 'send')
+        self.keystrokes += 1
+        self.bytes_sent += len(s)
+        self.unmatched += s
+        while self.matched < len(self.sends):
+            (t, data) = self.sends[self.matched]
+            if data.startswith(TRANSCRIPT_REDACTED):
+                end = self.unmatched.find(b'\r\n')
+                if end < 0:
+                    break
+                data = self.unmatched[:end] + data[len(TRANSCRIPT_REDACTED):]
+            if not self.unmatched.startswith(data):
+                break
+            self.unmatched = self.unmatched[len(data):]
+            self.matched += 1
+            self.origin = (time.time(), t)
+        mismatch = self.matched >= len(self.sends) or not self._expects(self.unmatched)
+        if self.unmatched and mismatch:
+            expected = self.sends[self.matched][1] if self.matched < len(self.sends) else b''
+            raise TranscriptMismatch('Sent %r, the transcript has %r' % (self.unmatched, expected))
+        return len(s)
+
+    def _expects(self, unmatched):
+        # Whether unmatched may be the start of the next recorded send
+        data = self.sends[self.matched][1]
+        if data.startswith(TRANSCRIPT_REDACTED):
+            return b'\r\n' not in unmatched
+        return data.startswith(unmatched)
+
+    def sendline(self, s=''):
+        return self.send(s + '\r\n')
+
+    def sendeof(self):
+        pass
+
+    def setecho(self, state):
+        pass
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self, force=True):
+        self.closed = True
+
+    def terminate(self, force=False):
+        self.close()
+        return True
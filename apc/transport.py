@@ -0,0 +1,250 @@
+'''
+In-process transports
+
+Connections to the PDUs without a telnet (or ssh) child process and its
+pty: the socket is read and written in the calling thread, behind the
+pexpect interface (expect, send, before, buffer...) the drivers use.
+
+- telnet: a TCP socket with the telnet option negotiation of apc.telnet
+- ssh: a paramiko shell channel, if paramiko is installed
+
+The snmp transport has no terminal session: it is served by its own
+driver (see apc.snmp).  Hosts may name their transport, as in
+'ssh://pdu1' or 'snmp://community@pdu2:1161'.
+'''
+
+import select
+import socket
+import sys
+import time
+import pexpect
+from pexpect.spawnbase import SpawnBase
+from apc import defaults
+from apc.defaults import TRANSPORTS
+from apc.telnet import TelnetParser, escape
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+
+TRANSPORT_PORTS = {'telnet': 23, 'ssh': 22, 'snmp': 161}
+
+TRANSPORT_TIMEOUT = 10
+
+# Leaves interact(), like telnet's escape character
+INTERACT_ESCAPE = b'\x1d'  # ^]
+
+
+class TransportError(Exception):
+    pass
+
+
+def split_host(host, default_port):
+    '''
+    Host and port of 'host', 'host:port' or '[ipv6]:port'
+    '''
+    if host.startswith('['):
+        address, _, port = host[1:].partition(']')
+        port = port[1:]
+    elif host.count(':') == 1:
+        address, port = host.split(':')
+    else:
+        address, port = host, ''
+    try:
+        return address, int(port) if port else default_port
+    except ValueError:
+        raise TransportError('Bad port in %s' % host)
+
+
+def split_transport(host, transport):
+    '''
+    Transport and host of 'transport://host', or of host with the
+    default transport
+    '''
+    scheme, sep, rest = host.partition('://')
+    if not sep:
+        return transport, host
+    if scheme not in TRANSPORTS:
+        raise TransportError('Unknown transport: %s' % scheme)
+    return scheme, rest
+
+
+class _ChannelSpawn(SpawnBase):
+    '''
+    pexpect child reading and writing a socket-like channel (recv,
+    sendall, fileno and close)
+    '''
+    def __init__(self, host, channel, timeout=TRANSPORT_TIMEOUT):
+        SpawnBase.__init__(self, timeout=timeout)
+        self.host = host
+        self.channel = channel
+
+    def _filter(self, data):
+        '''
+        @return: (payload, bytes to send back)
+        '''
+        return data, b''
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        if self.channel is None or self.flag_eof:
+            raise pexpect.EOF('Connection to %s closed' % self.host)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            ready, _, _ = select.select([self.channel], [], [], remaining)
+            if not ready:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            try:
+                data = self.channel.recv(size)
+            except (OSError, EOFError):
+                data = b''
+            if not data:
+                self.flag_eof = True
+                raise pexpect.EOF('Connection closed by %s' % self.host)
+            payload, reply = self._filter(data)
+            if reply:
+                self.channel.sendall(reply)
+            if payload:
+                self._log(payload, 'read')
+                return payload
+
+    def send(self, s):
+        if isinstance(s, str):
+            s = s.encode('utf-8')
+        self._log(s, 'send')
+        self.channel.sendall(self._escape(s))
+        return len(s)
+
+    def _escape(self, data):
+        return data
+
+    def sendline(self, s=''):
+        return self.send(s + '\r\n')
+
+    def sendeof(self):
+        pass  # the PDU session ends with its logout entry
+
+    def setecho(self, state):
+        pass  # the PDU echoes
+
+    def isalive(self):
+        return self.channel is not None and not self.flag_eof
+
+    def close(self, force=True):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def terminate(self, force=False):
+        self.close()
+        return True
+
+    def interact(self):
+        '''
+        Hand the session over to the terminal until ^] or the end of the
+        connection
+        '''
+        stdin = sys.stdin.fileno()
+        saved = None
+        if termios is not None and sys.stdin.isatty():
+            saved = termios.tcgetattr(stdin)
+            tty.setraw(stdin)
+        try:
+            while self.isalive():
+                ready, _, _ = select.select([self.channel, stdin], [], [])
+                if stdin in ready:
+                    data = sys.stdin.buffer.read1(4096)
+                    if not data or INTERACT_ESCAPE in data:
+                        break
+                    self.send(data)
+                if self.channel in ready:
+                    try:
+                        data = self.read_nonblocking(4096, 0)
+                    except pexpect.TIMEOUT:
+                        continue
+                    except pexpect.EOF:
+                        break
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+        finally:
+            if saved is not None:
+                termios.tcsetattr(stdin, termios.TCSADRAIN, saved)
+
+
+class TelnetSpawn(_ChannelSpawn):
+    '''
+    In-process telnet client
+    '''
+    def __init__(self, host, port=TRANSPORT_PORTS['telnet'], timeout=TRANSPORT_TIMEOUT):
+        try:
+            sock = socket.create_connection((host, port), timeout)
+        except (OSError, socket.timeout) as e:
+            raise TransportError('Cannot connect to %s:%d: %s' % (host, port, e))
+        sock.settimeout(None)  # reads wait in select()
+        _ChannelSpawn.__init__(self, host, sock, timeout)
+        self.telnet = TelnetParser()
+
+    def _filter(self, data):
+        return self.telnet.feed(data)
+
+    def _escape(self, data):
+        return escape(data)
+
+
+class SSHSpawn(_ChannelSpawn):
+    '''
+    In-process SSH client (paramiko), on an interactive shell channel
+
+    The user is authenticated by SSH: the PDU skips its login prompts.
+    Host keys are checked against the system known_hosts, unknown ones
+    are rejected unless accept_new_host_keys (by default
+    $APC_SSH_ACCEPT_NEW_HOST_KEYS) is set, then accepted with a warning.
+    '''
+    authenticated = True
+
+    def __init__(self, host, user, password, port=TRANSPORT_PORTS['ssh'],
+                 timeout=TRANSPORT_TIMEOUT, accept_new_host_keys=None):
+        if paramiko is None:
+            raise TransportError('The ssh transport needs paramiko')
+        if accept_new_host_keys is None:
+            accept_new_host_keys = defaults.APC_SSH_ACCEPT_NEW_HOST_KEYS
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        if accept_new_host_keys:
+            self.client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        else:
+            self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        try:
+            self.client.connect(host, port, user, password, timeout=timeout,
+                                allow_agent=False, look_for_keys=False)
+            channel = self.client.invoke_shell()
+        except (paramiko.SSHException, OSError) as e:
+            self.client.close()
+            raise TransportError('Cannot connect to %s:%d: %s' % (host, port, e))
+        _ChannelSpawn.__init__(self, host, channel, timeout)
+
+    def close(self, force=True):
+        _ChannelSpawn.close(self, force)
+        self.client.close()
+
+
+def connect(transport, host, user, password, timeout=TRANSPORT_TIMEOUT):
+    '''
+    Open a transport ('telnet' or 'ssh') to host, which may be 'host:port'
+    '''
+    if transport not in TRANSPORTS:
+        raise TransportError('Unknown transport: %s' % transport)
+    if transport == 'snmp':
+        raise TransportError('The snmp transport has no terminal session')
+    address, port = split_host(host, TRANSPORT_PORTS[transport])
+    if transport == 'ssh':
+        return SSHSpawn(address, user, password, port, timeout)
+    return TelnetSpawn(address, port, timeout)
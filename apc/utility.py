@@ -7,12 +7,17 @@ Modified by Sebastien Celles
 Tested with AP7900, but should work with similar models.
 '''
 
+import contextlib
+import functools
 import os
 import re
 import time
 import pexpect
-from apc.lockfile import FilesystemLock
-from apc.outlet import Outlet, Outlets
+from apc.lockfile import FilesystemLock, FlockLock, fcntl
+from apc.defaults import APC_DEFAULT_HOST, APC_DEFAULT_USER, APC_DEFAULT_PASSWORD  # noqa
+from apc.defaults import APC_DEFAULT_LOCK_DIR, APC_DEFAULT_TRANSPORT
+from apc.outlet import Outlet, Outlets, OutletStatus, OutletStreamParser
+from apc.transport import TRANSPORT_TIMEOUT, connect, split_transport
 
 
 APC_ESCAPE = '\033'
@@ -20,40 +25,95 @@ APC_ESCAPE = '\033'
 APC_YES    = 'YES'
 APC_LOGOUT = '4'
 
-APC_VERSION_PATTERN = re.compile(' v(\d+\.\d+\.\d+)')
+# Outlet number of the master control (all outlets) on 8 outlet PDUs
+APC_ALL_OUTLETS = 9
+# Outlet aliases of the master control, whatever the number of outlets
+APC_ALL_ALIASES = ('*', '+')
+
+# Prompts ending each step of a menu dialog
+APC_PROMPT          = '\n> '
+APC_CONFIRM_PROMPT  = "Enter 'YES' to continue or <ENTER> to cancel"
+APC_CONTINUE_PROMPT = 'Press <ENTER> to continue'
+APC_VALUE_PROMPT    = ' : '
+
+# Bounds (seconds) of the adaptive timeout of a dialog step
+APC_STEP_TIMEOUT_MIN = 2
+APC_STEP_TIMEOUT_MAX = 10
+# Quiet time (seconds) telling that a burst of menu redraws is over
+APC_SETTLE_TIME = 0.5
+
+APC_VERSION_PATTERN = re.compile(r' v(\d+\.\d+\.\d+)')
+# State of the outlet on its Control Outlet screen (and v2 command results)
+APC_OUTLET_STATE_PATTERN = re.compile(r'State\s*:\s*(ON\*?|OFF\*?)')
+# Entries of the outlet list: the master control follows the last outlet
+APC_MASTER_PATTERN       = re.compile(r'(\d+)- Master')
+APC_OUTLET_ENTRY_PATTERN = re.compile(r'(\d+)- ')
 
-APC_DEFAULT_HOST     = os.environ.get('APC_HOST',     '192.168.1.2')
-APC_DEFAULT_USER     = os.environ.get('APC_USER',     'apc')
-APC_DEFAULT_PASSWORD = os.environ.get('APC_PASSWORD', 'apc')
-
-LOCK_PATH = '/tmp/apc.lock'
 LOCK_TIMEOUT = 60
 
+LOCK_UNSAFE_CHARS = re.compile('[^A-Za-z0-9._-]')
+
+_NO_TIMING = contextlib.nullcontext()
 
-def APC(host, user, password, verbose=False, quiet=False, cli=''):
+
+def APC(host, user, password, verbose=False, quiet=False, cli='',
+        lock_dir=APC_DEFAULT_LOCK_DIR, record=None, timings=None,
+        transport=APC_DEFAULT_TRANSPORT, health=None, deadline=None):
     factory = APCFactory()
-    apc = factory.build(host, user, password, verbose, quiet, cli)
+    apc = factory.build(host, user, password, verbose, quiet, cli, lock_dir, record=record,
+                        timings=timings, transport=transport, health=health,
+                        deadline=deadline)
     return apc
 
 
-class APCLock:
-    def __init__(self, quiet):
-        self.quiet = quiet
+def lock_path(host, lock_dir=APC_DEFAULT_LOCK_DIR):
+    '''
+    Path of the lock file guarding the (single) telnet session of host
+    '''
+    return os.path.join(lock_dir, 'apc-%s.lock' % LOCK_UNSAFE_CHARS.sub('_', host))
 
-    def lock(self):
-        self.info('Acquiring lock %s' % (LOCK_PATH))
 
-        self.lock = FilesystemLock(LOCK_PATH)
+class APCLock:
+    def __init__(self, quiet, host, lock_dir=APC_DEFAULT_LOCK_DIR):
+        self.quiet = quiet
+        self.path = lock_path(host, lock_dir)
+
+    def lock(self, timeout=LOCK_TIMEOUT, deadline=None):
+        '''
+        @param deadline: Deadline the wait is cut down to
+        @raise APCDeadlineError: if the deadline passed while waiting
+        '''
+        self.info('Acquiring lock %s' % (self.path))
+        self.deadline = deadline
+        if deadline is not None:
+            timeout = deadline.timeout(timeout, 'lock')
+
+        if fcntl is None:
+            self._lock_fallback(timeout)
+            return
+
+        self._lock = FlockLock(self.path)
+        if not self._lock.lock(timeout=timeout):
+            self._failed()
+
+    def _failed(self):
+        if self.deadline is not None and self.deadline.expired():
+            raise APCDeadlineError('Deadline of %s s passed during lock' % self.deadline.seconds)
+        raise SystemError('Cannot acquire %s\n' % (self.path))
+
+    def _lock_fallback(self, timeout):
+        # No flock(2) on this platform: poll the symlink based lock
+        self._lock = FilesystemLock(self.path)
 
         count = 0
-        while not self.lock.lock():
+        while not self._lock.lock():
             time.sleep(1)
             count += 1
-            if count >= LOCK_TIMEOUT:
-                raise SystemError('Cannot acquire %s\n' % (LOCK_PATH))
+            if count >= timeout:
+                self._failed()
 
     def unlock(self):
-        self.lock.unlock()
+        self._lock.unlock()
 
     def info(self, msg):
         if not self.quiet:
@@ -61,34 +121,152 @@ class APCLock:
 
 
 class APCFactory:
-    def build(self, host, user, password, verbose, quiet, cli):
+    def build(self, host, user, password, verbose, quiet, cli,
+              lock_dir=APC_DEFAULT_LOCK_DIR, child=None, record=None, timings=None,
+              transport=APC_DEFAULT_TRANSPORT, health=None, deadline=None):
+        '''
+        Lock host, log in and return the driver of its firmware
+
+        @param cli: command line to spawn, '' to connect in-process over
+            transport ('telnet', 'ssh' or 'snmp', see apc.transport), which
+            host may override as in 'snmp://pdu1'
+        @param child: pexpect-like object to talk to instead of connecting,
+            e.g. an apc.transcript.ReplaySpawn
+        @param record: path of a transcript file recording the session
+        @param timings: apc.timing.Timings collecting the phase timings
+        @param health: apc.health.HealthTracker, failing fast (CircuitOpen)
+            on the hosts found unreachable time after time
+        @param deadline: seconds (or Deadline) the lock wait, the
+            connection, the login and the operations of the driver may
+            take in all, None for no limit
+        '''
         self.quiet = quiet
+        if not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        self.deadline = deadline
+        transport, host = split_transport(host, transport)
+
+        if health is not None:
+            health.check(host)
+
+        if transport == 'snmp' and cli == '' and child is None:
+            return self.build_snmp(host, verbose, quiet, timings, health)
+
+        def timed(phase):
+            if timings is None:
+                return _NO_TIMING
+            return timings.phase(host, 'connect', phase)
+
+        self.lock = APCLock(quiet, host, lock_dir)
+        with timed('lock'):
+            self.lock.lock(LOCK_TIMEOUT, deadline)
+
+        try:
+            if child is None:
+                with timed('spawn'):
+                    child = self.spawn(host, user, password, verbose, cli, transport)
+            if record is not None:
+                from apc.transcript import TranscriptRecorder  # only to record sessions
+                TranscriptRecorder(child, record, password)
+
+            with timed('login'):
+                version = self.login(child, user, password)
+        except BaseException as e:
+            # Do not keep the PDU locked for nothing
+            if child is not None:
+                child.close(force=True)
+            self.lock.unlock()
+            # Running out of time says nothing of the health of the host
+            failed = isinstance(e, Exception) and not isinstance(e, APCDeadlineError)
+            if health is not None and failed:
+                health.failure(host, e)
+            raise
+        if health is not None:
+            health.success(host)
+
+        apc = driver_class(version)(host, verbose, quiet)
+
+        apc.child = child
+        apc.version = version
+        apc.lock = self.lock
+        apc.timings = timings
+        apc.deadline = deadline
+
+        return apc
 
-        self.lock = APCLock(quiet)
-        self.lock.lock()
+    def build_snmp(self, host, verbose, quiet, timings=None, health=None):
+        '''
+        SNMP driver of host ([community@]host[:port]); SNMP needs no lock
+        '''
+        from apc import snmp  # only for SNMP hosts
+        community, host = snmp.split_community(host)
+
+        def timed(phase):
+            if timings is None:
+                return _NO_TIMING
+            return timings.phase(host, 'connect', phase)
+
+        self.info('Connecting to APC @ %s over SNMP' % host)
+        client = None
+        try:
+            with timed('spawn'):
+                client = snmp.connect('%s@%s' % (community, host))
+                client.timeout = self.deadline.timeout(client.timeout, 'connect')
+            with timed('login'):
+                version = snmp.firmware_version(client)
+        except BaseException as e:
+            if client is not None:
+                client.close()
+            if health is not None and isinstance(e, Exception):
+                health.failure(host, e)
+            raise
+        if health is not None:
+            health.success(host)
+        self.info('APC version %s' % version)
+
+        apc = SNMPAPC(host, verbose, quiet)
+        apc.child = client
+        apc.mib = snmp.mib_class(version)
+        apc.version = version
+        apc.timings = timings
+        apc.deadline = self.deadline
+        return apc
 
+    def spawn(self, host, user, password, verbose, cli, transport=APC_DEFAULT_TRANSPORT):
         self.info('Connecting to APC @ %s' % host)
+        timeout = self.deadline.timeout(TRANSPORT_TIMEOUT, 'connect')
         if cli == '':
-            commandline = 'telnet %s' % host
-        else:
-            commandline = cli.format(host=host, user=user, password=password)
+            if verbose:
+                print('Connecting over %s' % transport)
+            return connect(transport, host, user, password, timeout)
+        commandline = cli.format(host=host, user=user, password=password)
         if verbose:
             print("Running '%s'" % commandline)
         child = pexpect.spawn(commandline)
 
-        child.timeout = 10
+        child.timeout = timeout
         child.setecho(True)
+        return child
 
-        child.expect('User Name : ')
-        child.send(user + '\r\n')
-        child.before
-        child.expect('Password  : ')
-        child.send(password + '\r\n')
+    def login(self, child, user, password):
+        '''
+        @return: the firmware version
+        '''
+        def timeout():
+            return self.deadline.timeout(child.timeout, 'login')
 
-        child.expect('Communication Established')
+        if not getattr(child, 'authenticated', False):  # ssh already did
+            child.expect('User Name : ', timeout=timeout())
+            child.send(user + '\r\n')
+            child.expect('Password  : ', timeout=timeout())
+            child.send(password + '\r\n')
+
+        child.expect('Communication Established', timeout=timeout())
 
         header = child.before
 
+        child.expect(APC_PROMPT, timeout=timeout())  # main menu
+
         match = APC_VERSION_PATTERN.search(str(header))
 
         if not match:
@@ -98,29 +276,164 @@ class APCFactory:
 
         self.info('Logged in as user %s, version %s'
                   % (user, version))
-
-        if version[0] == '3':
-            apc = APC3(host, verbose, quiet)
-        else if version[0] == '2' and version[1] == '5' and version [2] == '4':
-            apc = MyAPC(host, verbose, quiet)
-        else:
-            apc = APC2(host, verbose, quiet)
-
-        apc.child = child
-        apc.version = version
-        apc.lock = self.lock
-
-        return apc
+        return version
 
     def info(self, msg):
         if not self.quiet:
             print(msg)
 
+
+def driver_class(version):
+    '''
+    Driver class whose menu layout matches the firmware version
+    '''
+    if version[0] == '3':
+        return APC3
+    elif version.startswith('2.5.4'):
+        return MyAPC
+    else:
+        return APC2
+
+
+def menu_operation(method):
+    '''
+    Forget the menu position (and the outlet states) when an operation
+    fails half-way
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.operation = method.__name__  # for the timings
+        try:
+            return method(self, *args, **kwargs)
+        except BaseException:
+            self.menu = None
+            self.invalidate_status()
+            raise
+    return wrapper
+
+
+class APCStepError(pexpect.TIMEOUT):
+    '''
+    A step of a menu dialog did not get its expected answer
+    '''
+    def __init__(self, host, step, sent, pattern, timeout, received):
+        self.host = host
+        self.step = step
+        self.sent = sent
+        self.pattern = pattern
+        self.timeout = timeout
+        self.received = received
+        pexpect.TIMEOUT.__init__(
+            self, 'APC %s: step %s: sent %r, expected %r; last output:\n%s'
+            % (host, step, sent, pattern, received))
+
+
+class APCDeadlineError(pexpect.TIMEOUT):
+    '''
+    The deadline of an operation passed before its step
+    '''
+    pass
+
+
+class Deadline:
+    '''
+    Time left to an operation (lock wait, connection, login and
+    commands), that the timeouts of its steps are cut down to
+    '''
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.end = None if seconds is None else time.time() + seconds
+
+    def expired(self):
+        return self.end is not None and time.time() >= self.end
+
+    def timeout(self, timeout, step='operation'):
+        '''
+        @return: timeout, or the time left if it is shorter
+        @raise APCDeadlineError: if no time is left
+        '''
+        if self.end is None:
+            return timeout
+        left = self.end - time.time()
+        if left <= 0:
+            raise APCDeadlineError('Deadline of %s s passed before %s' % (self.seconds, step))
+        return left if timeout is None else min(timeout, left)
+
+
+class StepTimeout:
+    '''
+    Adaptive timeout of a dialog step, from the observed response times
+
+    Same estimator as the TCP retransmission timeout (RFC 6298): the
+    timeout is the smoothed response time plus four deviations, kept
+    within [minimum, maximum].  It stays at maximum until a response
+    has been observed.
+    '''
+    def __init__(self, minimum=APC_STEP_TIMEOUT_MIN, maximum=APC_STEP_TIMEOUT_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.maximum
+        return min(self.maximum, max(self.minimum, self.srtt + 4 * self.rttvar))
+
+    def observe(self, elapsed):
+        if self.srtt is None:
+            self.srtt = elapsed
+            self.rttvar = elapsed / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - elapsed)
+            self.srtt = 0.875 * self.srtt + 0.125 * elapsed
+
+
 class AbstractAPC:
+    # Keys selecting the outlet list from the main menu
+    APC_OUTLET_MENU    = ()
+    # Keys showing the outlet status table, and the title above it
+    APC_STATUS_MENU    = None
+    APC_STATUS_HEADER  = None
+    # Text acknowledging an outlet command
+    APC_COMMAND_RESULT = None
+
     def __init__(self, host, verbose, quiet):
         self.host = host
         self.verbose = verbose
         self.quiet = quiet
+        # Keys leading from the main menu to the current menu, None if unknown
+        self.menu = ()
+        # Output of the last dialog step, up to its prompt
+        self.screen = ''
+        # Adaptive timeout of each kind of step (menu, command, confirm...):
+        # a command takes longer to be acknowledged than a menu to redraw
+        self.step_timeouts = {}
+        # Seconds a status() result is served from cache, 0 to disable
+        self.status_ttl = 0
+        self._status_cache = None
+        self._status_time = 0
+        # Master control entry, right after the last outlet, None until
+        # read from the outlet list (see master_outlet())
+        self.all_outlets = None
+        # Phase timings (apc.timing.Timings), and the operation timed
+        self.timings = None
+        self.operation = None
+        # Skip on/off commands on outlets already (and steadily) in that state
+        self.skip_unchanged = True
+        # Set once an outlet command is sent: a session dropped after that
+        # must not run the operation again (see APCSession)
+        self.command_sent = False
+        self.deadline = Deadline()
+
+    def timed(self, phase):
+        '''
+        Context timing a phase of the current operation, if timings are on
+        '''
+        if self.timings is None:
+            return _NO_TIMING
+        return self.timings.phase(self.host, self.operation, phase)
 
     def notify(self, outlet_name, state):
         print('APC %s: %s %s' % (self.host, outlet_name, state))
@@ -130,20 +443,170 @@ class AbstractAPC:
         if self.verbose:
             print(self.child.before)
 
+    def step_timeout(self, step):
+        '''
+        @return: StepTimeout of the kind of step, its first word
+        '''
+        kind = step.split()[0]
+        if kind not in self.step_timeouts:
+            self.step_timeouts[kind] = StepTimeout()
+        return self.step_timeouts[kind]
+
+    def expect_step(self, step, sent, pattern):
+        '''
+        Wait for the prompt ending a dialog step, as soon as it arrives
+
+        @return: the output of the step, before the prompt
+        '''
+        step_timeout = self.step_timeout(step)
+        timeout = self.deadline.timeout(step_timeout.timeout, step)
+        start = time.time()
+        try:
+            self.child.expect(pattern, timeout=timeout)
+        except pexpect.TIMEOUT:
+            if self.deadline.expired():
+                raise APCDeadlineError('Deadline of %s s passed during %s' % (
+                    self.deadline.seconds, step))
+            received = self.child.before
+            if isinstance(received, bytes):
+                received = received.decode('utf-8', 'replace')
+            raise APCStepError(self.host, step, sent, pattern, timeout, received[-200:])
+        step_timeout.observe(time.time() - start)
+        screen = self.child.before
+        if isinstance(screen, bytes):
+            screen = screen.decode('utf-8', 'replace')
+        self.screen = screen
+        return screen
+
+    def send_expect(self, step, keys, pattern=APC_PROMPT):
+        '''
+        Send a line and wait for the prompt that follows it
+        '''
+        self.sendnl(keys)
+        return self.expect_step(step, keys, pattern)
+
+    def master_outlet(self):
+        '''
+        Number of the master control entry, read from the outlet list on
+        first use: it is 9 on 8 outlet PDUs only
+
+        Commands go through the outlet list anyway, so reading it first
+        costs no extra step.
+        '''
+        if self.all_outlets is None:
+            self._navigate(self.APC_OUTLET_MENU, refresh=True)
+            match = APC_MASTER_PATTERN.search(self.screen)
+            entries = [int(entry) for entry in APC_OUTLET_ENTRY_PATTERN.findall(self.screen)]
+            if match:
+                self.all_outlets = int(match.group(1))
+            elif entries:
+                self.all_outlets = max(entries) + 1
+            else:
+                self.all_outlets = APC_ALL_OUTLETS
+        return self.all_outlets
+
     def get_outlet(self, outlet):
-        if str(outlet) in ['*', '+', '9']:
-            return (9, 'ALL outlets')
-        else:
-            # Assume integer outlet
-            try:
-                outlet = int(outlet)
-                return (outlet, 'Outlet #%d' % outlet)
-            except:
-                raise SystemExit('Bad outlet: [%s]' % outlet)
+        if str(outlet) in APC_ALL_ALIASES:
+            return (self.master_outlet(), 'ALL outlets')
+        # Assume integer outlet
+        try:
+            outlet = int(outlet)
+        except (TypeError, ValueError):
+            raise SystemExit('Bad outlet: [%s]' % outlet)
+        if outlet == self.master_outlet():
+            return (outlet, 'ALL outlets')
+        return (outlet, 'Outlet #%d' % outlet)
 
     def _escape_to_main(self, depth=6):
         for i in range(depth):
             self.child.send(APC_ESCAPE)
+        self.menu = ()
+        # The number of menus redrawn is unknown: wait for the output to
+        # settle so that no stale prompt is taken for the next step's
+        self.sendnl('')
+        while True:
+            try:
+                self.child.expect(APC_PROMPT, timeout=APC_SETTLE_TIME)
+            except pexpect.TIMEOUT:
+                break
+
+    def _navigate(self, path, refresh=False, stream=False):
+        '''
+        Go to the menu reached by the keys of path from the main menu
+
+        Only the part of the path not shared with the current menu is
+        walked: <ESC> up to the common parent menu, then down.  With
+        refresh, the menu is redrawn even if we already are there.  With
+        stream, the last key is sent without waiting for its screen, which
+        the caller reads.
+        '''
+        with self.timed('navigate'):
+            self._walk(path, refresh, stream)
+
+    def _walk(self, path, refresh, stream):
+        if self.menu is None:
+            self._escape_to_main()
+        common = 0
+        for current, key in zip(self.menu, path):
+            if current != key:
+                break
+            common += 1
+        up = len(self.menu) - common
+        keys = list(path[common:])
+        for i in range(up):
+            self.child.send(APC_ESCAPE)
+            self.menu = self.menu[:-1]
+            if stream and not keys and i == up - 1:
+                break  # the caller reads the screen of the parent menu
+            self.expect_step('menu %s' % '-'.join(self.menu or ('main',)), '<ESC>', APC_PROMPT)
+        if refresh and up == 0 and not keys:
+            keys = ['']  # <ENTER> redraws the current menu
+        for i, key in enumerate(keys):
+            self.menu = tuple(path[:common + i + 1])
+            if stream and i == len(keys) - 1:
+                self.sendnl(key)
+            else:
+                self.send_expect('menu %s' % '-'.join(self.menu or ('main',)), key)
+        self.menu = tuple(path)
+
+    def confirm_command(self, cmd, confirmation=None):
+        '''
+        Select a command of the Control Outlet menu, confirm it and check
+        its acknowledgement
+
+        @param confirmation: title expected on the confirmation screen
+        @return: the screens shown once the command is issued
+        '''
+        with self.timed('confirm'):
+            self.command_sent = True
+            screen = self.send_expect('command', cmd, APC_CONFIRM_PROMPT)
+            if confirmation is not None and confirmation not in screen:
+                raise APCStepError(self.host, 'command', cmd, confirmation, 0, screen[-200:])
+            result = self.send_expect('confirm', APC_YES, APC_CONTINUE_PROMPT)
+            result += self.send_expect('continue', '')
+            self.get_command_result(result)
+        return result
+
+    def outlet_state(self, outlet, screen=None):
+        '''
+        State of outlet on its Control Outlet screen (the last screen by
+        default), or on a command result
+
+        @return: OutletStatus, None for the master control or if the
+            screen shows no state
+        '''
+        states = APC_OUTLET_STATE_PATTERN.findall(self.screen if screen is None else screen)
+        if outlet == self.all_outlets or not states:
+            return None
+        return OutletStatus.parse(states[-1])
+
+    def unchanged(self, status, on):
+        '''
+        Whether a command turning the outlet on (or off) can be skipped
+        '''
+        if not self.skip_unchanged or status is None:
+            return False
+        return not status.pending and status.on == on
 
     def set_reboot_duration(self, outlet, duration):
         pass
@@ -153,35 +616,35 @@ class AbstractAPC:
 
         self.set_reboot_duration(outlet, duration)
 
-        self._escape_to_main()
-
         self.control_outlet(outlet)
 
-        self.sendnl(self.APC_IMMEDIATE_REBOOT)
-
-        self.child.expect('Immediate Reboot')
-        self.sendnl(APC_YES)
-        self.sendnl('')
-
-        self.get_command_result()
+        result = self.confirm_command(self.APC_IMMEDIATE_REBOOT, 'Immediate Reboot')
 
         self.notify(outlet_name, 'Rebooted')
+        return self.outlet_state(outlet, result)
 
-        self._escape_to_main()
-
-    def reboot_delayed(self, outlet, delay):
+    def reboot_delayed(self, outlet, delay, duration):
         raise NotImplementedError()
 
+    @menu_operation
     def reboot(self, outlet, delay, duration):
+        '''
+        @return: the OutletStatus read once the command is issued, None
+            for the master control
+        '''
         if delay == 0:
-            self.reboot_immediate(outlet, duration)
+            status = self.reboot_immediate(outlet, duration)
         else:
-            self.reboot_delayed(outlet, delay, duration)
+            status = self.reboot_delayed(outlet, delay, duration)
+        self.update_status(outlet, None)
+        return status
 
     def on_off_immediate(self, outlet, on):
         (outlet, outlet_name) = self.get_outlet(outlet)
 
-        self.control_outlet(outlet)
+        # Redrawn if already there: the outlet may have been switched
+        # since, from the web interface, SNMP or its button
+        self.control_outlet(outlet, refresh=True)
 
         if on:
             cmd = self.APC_IMMEDIATE_ON
@@ -190,56 +653,149 @@ class AbstractAPC:
             cmd = self.APC_IMMEDIATE_OFF
             str_cmd = 'Off'
 
-        self.sendnl(cmd)
-        self.sendnl(APC_YES)
-        self.sendnl('')
+        status = self.outlet_state(outlet)
+        if self.unchanged(status, on):
+            self.notify(outlet_name, 'already %s' % str_cmd)
+            return status
 
-        self.get_command_result()
+        result = self.confirm_command(cmd)
 
         self.notify(outlet_name, str_cmd)
-
-        self._escape_to_main()
+        return self.outlet_state(outlet, result)
 
     def on_off_delayed(self, outlet, on, delay):
         raise NotImplementedError()
 
+    # on() and off() return the OutletStatus read once the command is
+    # issued (or found unneeded), None for the master control
+    @menu_operation
     def on(self, outlet, delay):
         if delay == 0:
-            self.on_off_immediate(outlet, True)
+            status = self.on_off_immediate(outlet, True)
+            self.update_status(outlet, True)
         else:
-            self.on_off_delayed(outlet, True, delay)
+            status = self.on_off_delayed(outlet, True, delay)
+            self.update_status(outlet, None)
+        return status
 
+    @menu_operation
     def off(self, outlet, delay):
         if delay == 0:
-            self.on_off_immediate(outlet, False)
+            status = self.on_off_immediate(outlet, False)
+            self.update_status(outlet, False)
         else:
-            self.on_off_delayed(outlet, False, delay)
+            status = self.on_off_delayed(outlet, False, delay)
+            self.update_status(outlet, None)
+        return status
 
     def debug(self):
         self.child.interact()
 
     def disconnect(self):
-        # self._escape_to_main()
-
-        self.sendnl(APC_LOGOUT)
-        self.child.sendeof()
-        if not self.quiet:
-            print('DISCONNECTED from %s' % self.host)
-
-        if self.verbose:
-            print('[%s]' % ''.join(self.child.readlines()))
-
-        self.child.close()
-        self.lock.unlock()
-
-    def control_outlet(self, outlet):
-        raise NotImplementedError()
-
-    def get_command_result(self):
-        raise NotImplementedError()
+        self.operation = 'disconnect'
+        try:
+            # With no time left for the logout dialog, just hang up
+            if not self.deadline.expired():
+                self._navigate(())
+
+                with self.timed('logout'):
+                    self.sendnl(APC_LOGOUT)
+                    self.child.sendeof()
+                    if self.verbose:
+                        print('[%s]' % ''.join(self.child.readlines()))
+        finally:
+            # Even if the deadline passes during the logout
+            self.child.close(force=True)
+            self.lock.unlock()
+            if not self.quiet:
+                print('DISCONNECTED from %s' % self.host)
+
+    def control_outlet(self, outlet, refresh=False):
+        self._navigate(self.APC_OUTLET_MENU + (str(outlet), '1'), refresh)
+
+    def get_command_result(self, result):
+        if self.APC_COMMAND_RESULT not in result:
+            raise APCStepError(self.host, 'command result', APC_YES, self.APC_COMMAND_RESULT,
+                               0, result[-200:])
+
+    def invalidate_status(self):
+        self._status_cache = None
+
+    def update_status(self, outlet, on):
+        '''
+        Patch the cached status after a command on outlet
+
+        @param on: new state of the outlet, None if it is not known yet
+            (delayed commands, reboot): the cache is then dropped
+        '''
+        if self._status_cache is None:
+            return
+        (outlet, outlet_name) = self.get_outlet(outlet)
+        if on is None:
+            self.invalidate_status()
+            return
+        lst_outlets = []
+        for ol in self._status_cache:
+            if outlet in (ol.id, self.master_outlet()):
+                ol = Outlet(ol.id, ol.name, str(OutletStatus(on)))
+            lst_outlets.append(ol)
+        self._status_cache = Outlets(lst_outlets)
 
     def status(self):
-        raise NotImplementedError()
+        '''
+        Outlets status, served from cache for status_ttl seconds
+        '''
+        fresh = time.time() - self._status_time < self.status_ttl
+        if self._status_cache is not None and fresh:
+            return self._status_cache
+        return self.read_status()
+
+    @menu_operation
+    def read_status(self):
+        '''
+        Outlets status read from the PDU, refreshing the cache
+        '''
+        ol_collection = Outlets(list(self.iter_status()))
+        if ol_collection:
+            self.all_outlets = max(ol.id for ol in ol_collection) + 1
+        if self.status_ttl > 0:
+            self._status_cache = ol_collection
+            self._status_time = time.time()
+        return ol_collection
+
+    def status_menu(self):
+        return self.APC_STATUS_MENU
+
+    def iter_status(self):
+        '''
+        Yield the outlets of the status table as their rows arrive
+        '''
+        if self.APC_STATUS_MENU is None:
+            raise NotImplementedError()
+        try:
+            self._navigate(self.status_menu(), refresh=True, stream=True)
+            with self.timed('read'):
+                parser = OutletStreamParser(self.APC_STATUS_HEADER)
+                # Start with what pexpect already read past its last match
+                data, self.child.buffer = self.child.buffer, self.child.buffer[:0]
+                while True:
+                    for ol in parser.feed(data):
+                        yield ol
+                    if parser.done:
+                        break
+                    timeout = self.deadline.timeout(self.step_timeout('status').timeout, 'status')
+                    try:
+                        data = self.child.read_nonblocking(4096, timeout)
+                    except pexpect.TIMEOUT:
+                        raise APCStepError(self.host, 'status', '', self.APC_STATUS_HEADER,
+                                           timeout,
+                                           parser.buffer[-200:].decode('utf-8', 'replace'))
+                self.child.buffer = parser.remainder
+                self.expect_step('status', '', APC_PROMPT)
+        except BaseException:
+            # Including GeneratorExit: the rest of the screen is unread
+            self.menu = None
+            raise
 
 
 class APC2(AbstractAPC):
@@ -247,15 +803,8 @@ class APC2(AbstractAPC):
     APC_IMMEDIATE_OFF    = '3'
     APC_IMMEDIATE_REBOOT = '4'
 
-    def control_outlet(self, outlet):
-        self.sendnl('1')
-        self.sendnl('1')
-        self.sendnl(str(outlet))
-        self.sendnl('1')
-        self.child.before
-
-    def get_command_result(self):
-        self.child.expect('Outlet State')
+    APC_OUTLET_MENU    = ('1', '1')
+    APC_COMMAND_RESULT = 'Outlet State'
 
 
 class APC3(AbstractAPC):
@@ -266,50 +815,48 @@ class APC3(AbstractAPC):
     APC_DELAYED_OFF      = '5'
     APC_DELAYED_REBOOT   = '6'
 
-    def control_outlet(self, outlet):
-        self.sendnl('1')
-        self.sendnl('2')
-        self.sendnl('1')
-        self.sendnl(str(outlet))
-        self.sendnl('1')
-        self.child.before
-
-    def configure_outlet(self, outlet):
-        self.sendnl('1')
-        self.sendnl('2')
-        self.sendnl('1')
-        self.sendnl(str(outlet))
-        self.sendnl('2')
-        self.child.before
-
-    def get_command_result(self):
-        self.child.expect('Command successfully issued')
+    APC_OUTLET_MENU    = ('1', '2', '1')
+    APC_STATUS_MENU    = APC_OUTLET_MENU
+    APC_STATUS_HEADER  = "-+ Outlet Control/Configuration -+"
+    APC_COMMAND_RESULT = 'Command successfully issued'
+
+    def configure_outlet(self, outlet, refresh=False):
+        self._navigate(self.APC_OUTLET_MENU + (str(outlet), '2'), refresh)
+
+    def set_setting(self, key, value):
+        '''
+        Change a setting of the Configure Outlet menu
+        '''
+        with self.timed('configure'):
+            self.send_expect('setting %s' % key, key, APC_VALUE_PROMPT)
+            self.send_expect('setting %s value' % key, value)
+
+    def accept_changes(self):
+        with self.timed('configure'):
+            self.send_expect('accept changes', '5')
 
     def set_power_delay(self, outlet, on, delay):
-        self.configure_outlet(outlet)
-        self.child.expect("Configure Outlet")
+        self.configure_outlet(outlet, refresh=True)
+        if "Configure Outlet" not in self.screen:
+            raise APCStepError(self.host, 'configure outlet', '', 'Configure Outlet', 0,
+                               self.screen[-200:])
         if on:
             str_cmd = "On"
-            self.sendnl('2')  # Power On Delay(sec)
+            key = '2'  # Power On Delay(sec)
         else:
             str_cmd = "Off"
-            self.sendnl('3')  # Power Off Delay(sec)
-        if delay == -1 or delay >= 0 and delay <= 7200:
-            self.sendnl(str(delay))
-        else:
+            key = '3'  # Power Off Delay(sec)
+        if not (delay == -1 or delay >= 0 and delay <= 7200):
             raise SystemExit("Power %s Delay Range: -1 to 7200 sec, where -1=Never" % str_cmd)
-        self.sendnl('5')  # Accept Changes
-        self.child.before
+        self.set_setting(key, str(delay))
+        self.accept_changes()
 
     def on_off_delayed(self, outlet, on, delay):
         (outlet, outlet_name) = self.get_outlet(outlet)
 
         self.set_power_delay(outlet, on, delay)
 
-        self._escape_to_main()
-
         self.control_outlet(outlet)
-        self.child.expect("Control Outlet")
 
         if on:
             cmd = self.APC_DELAYED_ON
@@ -318,63 +865,31 @@ class APC3(AbstractAPC):
             cmd = self.APC_DELAYED_OFF
             str_cmd = 'Off'
 
-        self.sendnl(cmd)
-        self.sendnl(APC_YES)
-        self.sendnl('')
-
-        self.get_command_result()
+        result = self.confirm_command(cmd)
 
         self.notify(outlet_name, "Delayed %s (%d s)" % (str_cmd, delay))
-
-        self._escape_to_main()
-
-    def status(self):
-        self.sendnl('1')
-        self.sendnl('2')
-        self.sendnl('1')
-        self.child.expect("-+ Outlet Control/Configuration -+")
-        self.child.expect("<ESC>")
-        s = self.child.before
-        s = s.decode("utf-8")  # b'' -> string
-        s = s.strip()
-        rows = s.split("\n")
-        lst_outlets = []
-        for row in rows[:-1]:
-            row = row.strip()[3:]
-            ol = Outlet.parse(row)
-            lst_outlets.append(ol)
-        ol_collection = Outlets(lst_outlets)
-        return ol_collection
+        return self.outlet_state(outlet, result)
 
     def set_reboot_duration(self, outlet, duration):
-        self.configure_outlet(outlet)
-        self.sendnl('4')  # Reboot Duration
         if duration < 5 or duration > 60:
             raise SystemExit("Reboot Duration Range: 5 to 60 sec")
-        self.sendnl(str(duration))
-        self.sendnl('5')  # Accept Changes
+        self.configure_outlet(outlet)
+        self.set_setting('4', str(duration))  # Reboot Duration
+        self.accept_changes()
 
     def reboot_delayed(self, outlet, delay, duration):
         (outlet, outlet_name) = self.get_outlet(outlet)
         str_cmd = 'reboot'
         self.set_reboot_duration(outlet, duration)
-        self._escape_to_main()
         self.set_power_delay(outlet, False, delay)  # power off delay
-        self._escape_to_main()
         self.set_power_delay(outlet, True, delay)  # power on delay
-        self._escape_to_main()
         self.control_outlet(outlet)
 
-        self.sendnl(self.APC_DELAYED_REBOOT)
-        self.child.expect('Delayed Reboot')
-        self.sendnl(APC_YES)
-        self.sendnl('')
-
-        self.get_command_result()
+        result = self.confirm_command(self.APC_DELAYED_REBOOT, 'Delayed Reboot')
 
         self.notify(outlet_name, "Delayed %s (delay=%d duration=%d)" % (str_cmd, delay, duration))
+        return self.outlet_state(outlet, result)
 
-        self._escape_to_main()
 
 class MyAPC(AbstractAPC):
     APC_IMMEDIATE_ON     = '1'
@@ -384,29 +899,128 @@ class MyAPC(AbstractAPC):
     APC_DELAYED_OFF      = '5'
     APC_DELAYED_REBOOT   = '6'
 
-    def control_outlet(self, outlet):
-        self.sendnl('1')
-        self.sendnl(str(outlet))
-        self.sendnl('1')
-        self.child.before
+    APC_OUTLET_MENU    = ('1',)
+    APC_STATUS_MENU    = ('1', '9', '2')
+    APC_STATUS_HEADER  = "Configuration of MasterSwitch"
+    APC_COMMAND_RESULT = 'Outlet State'
 
-    def get_command_result(self):
-        self.child.expect('Outlet State')
+    def status_menu(self):
+        # The table is under the master control entry, 9 on 8 outlet PDUs
+        return self.APC_OUTLET_MENU + (str(self.master_outlet()), '2')
 
-    def status(self):
-        self.sendnl('1')
-        self.sendnl('9')
-        self.sendnl('2')
-        self.child.expect("Configuration of MasterSwitch")
-        self.child.expect("<ESC>")
-        s = self.child.before
-        s = s.decode("utf-8")  # b'' -> string
-        s = s.strip()
-        rows = s.split("\n")
-        lst_outlets = []
-        for row in rows[:-1]:
-            row = row.strip()[3:]
-            ol = Outlet.parse(row)
-            lst_outlets.append(ol)
-        ol_collection = Outlets(lst_outlets)
-        return ol_collection
+
+class SNMPAPC(AbstractAPC):
+    '''
+    Driver over SNMP (PowerNet MIB, see apc.snmp) instead of the menus
+
+    There is no session to log in to nor to lock: the status is a single
+    GETBULK of the outlet table and each command a SET.  The child is an
+    apc.snmp.SNMPClient.
+    '''
+    def __init__(self, host, verbose, quiet):
+        AbstractAPC.__init__(self, host, verbose, quiet)
+        self.mib = None
+
+    def master_outlet(self):
+        # Numbers are always single outlets, only '*' and '+' the device
+        return APC_ALL_ALIASES[0]
+
+    def iter_status(self):
+        with self.timed('read'):
+            rows = self.child.walk_columns(self.mib.STATUS_COLUMNS)
+        for (index, (name, state, pending)) in rows:
+            if isinstance(name, bytes):
+                name = name.decode('utf-8', 'replace')
+            status = OutletStatus(state == self.mib.STATE_ON, pending == self.mib.PENDING)
+            yield Outlet(index[-1], name.strip(), str(status))
+
+    def outlet_ids(self, outlet):
+        '''
+        Outlets a command on outlet applies to
+        '''
+        if outlet == self.master_outlet():
+            return [ol.id for ol in self.iter_status()]
+        return [outlet]
+
+    def set_outlet_setting(self, column, outlet, value):
+        with self.timed('configure'):
+            self.child.set([(column + (id,), value) for id in self.outlet_ids(outlet)])
+
+    def outlet_state(self, outlet, screen=None):
+        '''
+        @return: OutletStatus of outlet, None for the master control
+        '''
+        if outlet == self.master_outlet():
+            return None
+        (name, state, pending) = self.mib.STATUS_COLUMNS
+        with self.timed('read'):
+            (state, pending) = self.child.get([state + (outlet,), pending + (outlet,)])
+        return OutletStatus(state == self.mib.STATE_ON, pending == self.mib.PENDING)
+
+    def command(self, outlet, command):
+        self.command_sent = True
+        with self.timed('confirm'):
+            if outlet == self.master_outlet():
+                self.child.set([(self.mib.DEVICE_COMMAND, self.mib.DEVICE_COMMANDS[command])])
+            else:
+                self.child.set([(self.mib.OUTLET_COMMAND + (outlet,),
+                                 self.mib.OUTLET_COMMANDS[command])])
+
+    def set_reboot_duration(self, outlet, duration):
+        if duration < 5 or duration > 60:
+            raise SystemExit("Reboot Duration Range: 5 to 60 sec")
+        self.set_outlet_setting(self.mib.REBOOT_DURATION, outlet, duration)
+
+    def set_power_delay(self, outlet, on, delay):
+        if on:
+            str_cmd = "On"
+            column = self.mib.ON_DELAY
+        else:
+            str_cmd = "Off"
+            column = self.mib.OFF_DELAY
+        if not (delay == -1 or delay >= 0 and delay <= 7200):
+            raise SystemExit("Power %s Delay Range: -1 to 7200 sec, where -1=Never" % str_cmd)
+        self.set_outlet_setting(column, outlet, delay)
+
+    def reboot_immediate(self, outlet, duration):
+        (outlet, outlet_name) = self.get_outlet(outlet)
+        self.set_reboot_duration(outlet, duration)
+        self.command(outlet, 'reboot')
+        self.notify(outlet_name, 'Rebooted')
+        return self.outlet_state(outlet)
+
+    def reboot_delayed(self, outlet, delay, duration):
+        (outlet, outlet_name) = self.get_outlet(outlet)
+        self.set_reboot_duration(outlet, duration)
+        self.set_power_delay(outlet, False, delay)
+        self.set_power_delay(outlet, True, delay)
+        self.command(outlet, 'delayed reboot')
+        self.notify(outlet_name, "Delayed reboot (delay=%d duration=%d)" % (delay, duration))
+        return self.outlet_state(outlet)
+
+    def on_off_immediate(self, outlet, on):
+        (outlet, outlet_name) = self.get_outlet(outlet)
+        status = self.outlet_state(outlet)
+        if self.unchanged(status, on):
+            self.notify(outlet_name, 'already %s' % ('On' if on else 'Off'))
+            return status
+        self.command(outlet, 'on' if on else 'off')
+        self.notify(outlet_name, 'On' if on else 'Off')
+        return self.outlet_state(outlet)
+
+    def on_off_delayed(self, outlet, on, delay):
+        (outlet, outlet_name) = self.get_outlet(outlet)
+        self.set_power_delay(outlet, on, delay)
+        self.command(outlet, 'delayed on' if on else 'delayed off')
+        self.notify(outlet_name, "Delayed %s (%d s)" % ('On' if on else 'Off', delay))
+        return self.outlet_state(outlet)
+
+    def debug(self):
+        raise SystemExit('ERROR: --debug needs a terminal session, not snmp')
+
+    def disconnect(self):
+        self.operation = 'disconnect'
+        with self.timed('logout'):
+            self.child.close()
+        if not self.quiet:
+            print('DISCONNECTED from %s' % self.host)
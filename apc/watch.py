@@ -0,0 +1,174 @@
+'''
+Outlet state changes, as they happen
+
+A Watcher keeps its session open and re-reads the outlet table at an
+adaptive interval: every WATCH_MIN_INTERVAL while an outlet is pending
+(ON* or OFF*) or has just changed, then backing off to
+WATCH_MAX_INTERVAL while the table stays the same.  Only the outlets
+whose state changed are reported, one event each:
+
+    {"time": 1700000000.123, "host": "pdu1", "outlet": 3, "name": "NAS",
+     "old": "ON", "new": "OFF*"}
+
+The first read reports every outlet, with a null old state.
+
+    >>> with APCSession(host, user, password) as session:
+    ...     for event in Watcher(session, host):
+    ...         print(format_event(event))
+
+The session holds the host lock all along: direct commands to the PDU
+wait for the watch to end (send them through the daemon instead).
+
+wait_settled() polls the same way after a command, until its outlets
+have reached their new state:
+
+    >>> session.reboot(8)
+    >>> wait_settled(session, [8], on=True, rebooted=True, timeout=60)
+'''
+
+import json
+import time
+from apc.batch import OUTLET_ALL_ALIASES
+from apc.defaults import WAIT_TIMEOUT
+
+
+WATCH_MIN_INTERVAL = 1.0
+# Below the idle logout of the PDUs (3 minutes): the session stays open
+WATCH_MAX_INTERVAL = 30.0
+WATCH_BACKOFF      = 2.0
+
+WAIT_INTERVAL     = 0.25
+WAIT_MAX_INTERVAL = 1.0
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+class Watcher:
+    '''
+    @param session: APCSession, APCClient or driver, anything with status()
+    @param host: reported in the events
+    '''
+    def __init__(self, session, host=None, min_interval=WATCH_MIN_INTERVAL,
+                 max_interval=WATCH_MAX_INTERVAL, backoff=WATCH_BACKOFF):
+        self.session = session
+        self.host = host if host is not None else getattr(session, 'host', None)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self.snapshot = None
+
+    def poll(self):
+        '''
+        Read the outlet table once
+
+        @return: list of the events of the outlets changed since the last
+            read, and sets interval to the time to wait before the next one
+        '''
+        snapshot = self.session.status().snapshot()
+        now = time.time()
+        if self.snapshot is None:
+            changes = [(outlet.id, None, outlet.status) for outlet in snapshot]
+        else:
+            changes = self.snapshot.diff(snapshot)
+        self.snapshot = snapshot
+        if changes or snapshot.pending_mask:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        events = []
+        for (id, old, new) in changes:
+            outlet = snapshot[id] if new is not None else None
+            events.append({'time': round(now, 3), 'host': self.host, 'outlet': id,
+                           'name': outlet.name if outlet is not None else None,
+                           'old': str(old) if old is not None else None,
+                           'new': str(new) if new is not None else None})
+        return events
+
+    def __iter__(self):
+        return self.watch()
+
+    def watch(self, duration=None):
+        '''
+        Generate the events, forever or for duration seconds
+        '''
+        end = None if duration is None else time.time() + duration
+        while True:
+            started = time.time()
+            for event in self.poll():
+                yield event
+            delay = self.interval - (time.time() - started)
+            if end is not None:
+                if time.time() + max(delay, 0) >= end:
+                    return
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _settled(outlets, ids, on):
+    for id in ids:
+        try:
+            status = outlets[id].status
+        except KeyError:
+            raise SystemExit('Bad outlet: [%s]' % id)
+        if status.pending or status.on != on:
+            return False
+    return True
+
+
+def _outlet_ids(outlets, ols):
+    '''
+    Ids of the outlets read in ols the commands on outlets applied to:
+    the aliases and the master control entry, right after the last
+    outlet as the drivers resolve it, stand for all of them
+    '''
+    ids = [ol.id for ol in ols]
+    master = max(ids) + 1 if ids else None
+    resolved = []
+    for outlet in outlets:
+        if str(outlet) in OUTLET_ALL_ALIASES or int(outlet) == master:
+            return ids
+        resolved.append(int(outlet))
+    return resolved
+
+
+def wait_settled(session, outlets, on=True, timeout=WAIT_TIMEOUT, rebooted=False,
+                 duration=0, interval=WAIT_INTERVAL, max_interval=WAIT_MAX_INTERVAL,
+                 backoff=WATCH_BACKOFF):
+    '''
+    Wait until the outlets are all on (or off) and none is pending,
+    reading the table (bypassing any status cache) at intervals growing
+    from interval to max_interval
+
+    @param session: APCSession, APCClient or driver
+    @param outlets: outlet ids, or '*' (or the master control entry) for
+        all of them
+    @param rebooted: the outlets are rebooting: they only count as settled
+        once seen off or pending, or after duration seconds
+    @return: the Outlets read last
+    @raise WaitTimeout: if they are not settled after timeout seconds
+    '''
+    read = getattr(session, 'read_status', session.status)
+    start = time.time()
+    deadline = start + timeout
+    cycled = not rebooted
+    while True:
+        ols = read()
+        ids = _outlet_ids(outlets, ols)
+        if not cycled:
+            cycled = time.time() - start >= duration or not _settled(ols, ids, True)
+        if cycled and _settled(ols, ids, on):
+            return ols
+        now = time.time()
+        if now >= deadline:
+            raise WaitTimeout('Outlets %s of %s not settled %s after %ds' % (
+                ','.join(map(str, outlets)), getattr(session, 'host', 'the PDU'),
+                'ON' if on else 'OFF', timeout))
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * backoff, max_interval)
+
+
+def format_event(event):
+    return json.dumps(event)
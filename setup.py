@@ -16,17 +16,22 @@ setup(
     license='MIT',
     classifiers=[
             'Development Status :: 4 - Beta',
-            'Programming Language :: Python :: 2',
             'Programming Language :: Python :: 3',
+            'Programming Language :: Python :: 3 :: Only',
     ],
+    python_requires='>=3.7',
     keywords='apc power distribution unit pdu',
     packages=[
         'apc'
     ],
     install_requires=['pexpect'],
+    extras_require={
+        'ssh': ['paramiko'],
+    },
     entry_points={
         'console_scripts': [
-            'apc=apc.cli_apc:main'
+            'apc=apc.cli_apc:main',
+            'apc-emulator=apc.emulator:main'
         ],
     },
 )
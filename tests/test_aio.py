@@ -0,0 +1,52 @@
+import asyncio
+from apc.aio import AsyncAPC, gather_status
+from apc.telnet import IAC, WILL, ECHO
+
+BANNER = (b'American Power Conversion  Network Management Card AOS  v3.9.2\r\n'
+          b'User : apc  Communication Established\r\n> ')
+
+TABLE = (b'\r\n------- Outlet Control/Configuration ------\r\n\r\n'
+         b' 1- Outlet 1 NAS             ON\r\n'
+         b' 2- Outlet 2                 OFF\r\n'
+         b' 3- Master Control/Configuration\r\n\r\n'
+         b'<ESC>- Back, <ENTER>- Refresh\r\n> ')
+
+
+async def fake_pdu(reader, writer):
+    writer.write(bytes(bytearray([IAC, WILL, ECHO])) + b'User Name : ')
+    await reader.readline()
+    writer.write(b'Password  : ')
+    await reader.readline()
+    writer.write(BANNER)
+    for i in range(3):  # 1- Device Manager, 2- Outlet Management, 1- Control
+        await reader.readline()
+    writer.write(TABLE)
+    await reader.read()
+    writer.close()
+
+
+def test_async_status(tmpdir):
+    async def run():
+        server = await asyncio.start_server(fake_pdu, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncAPC('127.0.0.1', 'apc', 'apc', port=port, lock_dir=str(tmpdir)) as apc:
+            assert apc.version == '3.9.2'
+            ols = await apc.status()
+        server.close()
+        return ols
+    ols = asyncio.run(run())
+    assert len(ols) == 2
+    assert ols[1].name == 'NAS'
+    assert ols[2].status.off
+
+def test_gather_status_isolates_failures(tmpdir):
+    async def run():
+        server = await asyncio.start_server(fake_pdu, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        results = await gather_status(['127.0.0.1', '127.0.0.2'], 'apc', 'apc', port=port,
+                                      lock_dir=str(tmpdir), timeout=1)
+        server.close()
+        return results
+    results = asyncio.run(run())
+    assert len(results['127.0.0.1']) == 2
+    assert isinstance(results['127.0.0.2'], Exception)
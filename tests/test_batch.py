@@ -0,0 +1,42 @@
+import pytest
+from apc.batch import parse_outlets, parse_batch, run_batch, BatchParseException
+
+
+class FakeAPC:
+    def __init__(self):
+        self.log = []
+
+    def on(self, outlet, delay):
+        self.log.append(('on', outlet, delay))
+        return len(self.log)
+
+    def off(self, outlet, delay):
+        self.log.append(('off', outlet, delay))
+        return len(self.log)
+
+    def reboot(self, outlet, delay, duration):
+        self.log.append(('reboot', outlet, delay, duration))
+        return len(self.log)
+
+
+def test_parse_outlets():
+    assert parse_outlets('4') == [4]
+    assert parse_outlets('1,3,5-8') == [1, 3, 5, 6, 7, 8]
+    assert parse_outlets('3, 1-4') == [3, 1, 2, 4]
+    assert parse_outlets('10-12') == [10, 11, 12]
+    assert parse_outlets('*') == ['*']
+    for spec in ['', 'a', '8-5', '1,,2', '1-']:
+        with pytest.raises(BatchParseException):
+            parse_outlets(spec)
+
+def test_parse_batch():
+    assert parse_batch('off 1,3 ; reboot 5-8') == [('off', [1, 3]), ('reboot', [5, 6, 7, 8])]
+    assert parse_batch('ON 2;') == [('on', [2])]
+    for s in ['', 'blink 1', 'off', ';']:
+        with pytest.raises(BatchParseException):
+            parse_batch(s)
+
+def test_run_batch():
+    apc = FakeAPC()
+    assert run_batch(apc, parse_batch('off 1,3 ; reboot 5-6'), 0, 10) == [1, 2, 3, 4]
+    assert apc.log == [('off', 1, 0), ('off', 3, 0), ('reboot', 5, 0, 10), ('reboot', 6, 0, 10)]
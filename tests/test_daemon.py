@@ -0,0 +1,132 @@
+import threading
+import time
+import pytest
+from apc.daemon import APCServer, APCClient, APCDaemonError
+from apc.history import HistoryStore
+from apc.outlet import Outlet, Outlets, OutletStatus
+
+
+class FakeSession:
+    instances = []
+
+    def __init__(self, host, user, password, *args):
+        self.host = host
+        self.log = []
+        self.closed = 0
+        FakeSession.instances.append(self)
+
+    def status(self):
+        self.log.append('status')
+        return Outlets([Outlet(1, 'NAS', 'ON'), Outlet(2, '', 'OFF')])
+
+    def on(self, outlet, delay=0):
+        self.log.append('on %s' % outlet)
+        return OutletStatus(True)
+
+    def off(self, outlet, delay=0):
+        raise SystemExit('Bad outlet: [%s]' % outlet)
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def server(tmpdir):
+    FakeSession.instances = []
+    path = str(tmpdir.join('apc.sock'))
+    server = APCServer(path, session_factory=FakeSession)
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    t.join()
+
+def test_daemon_reuses_session(server):
+    with APCClient('pdu-a', 'apc', 'apc', socket_path=server) as client:
+        assert client.on(1).on
+        ols = client.status()
+    with APCClient('pdu-a', 'apc', 'apc', socket_path=server) as client:
+        client.on(2)
+    assert str(ols) == str(Outlets([Outlet(1, 'NAS', 'ON'), Outlet(2, '', 'OFF')]))
+    assert len(FakeSession.instances) == 1
+    assert FakeSession.instances[0].log == ['on 1', 'status', 'on 2']
+
+def test_daemon_one_session_per_host(server):
+    APCClient('pdu-a', 'apc', 'apc', socket_path=server).on(1)
+    APCClient('pdu-b', 'apc', 'apc', socket_path=server).on(1)
+    assert sorted(s.host for s in FakeSession.instances) == ['pdu-a', 'pdu-b']
+
+def test_daemon_reports_errors(server):
+    client = APCClient('pdu-a', 'apc', 'apc', socket_path=server)
+    with pytest.raises(APCDaemonError) as e:
+        client.off(42)
+    assert 'Bad outlet' in str(e.value)
+    client.on(1)  # the connection is still usable
+    with pytest.raises(APCDaemonError):
+        client.request('debug')
+    client.disconnect()
+
+def test_daemon_records_history(tmpdir):
+    FakeSession.instances = []
+    path = str(tmpdir.join('apc.sock'))
+    history = HistoryStore(str(tmpdir.join('history')))
+    server = APCServer(path, session_factory=FakeSession, history=history)
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    try:
+        with APCClient('pdu-a', 'apc', 'apc', socket_path=path) as client:
+            client.status()
+            client.status()
+    finally:
+        server.shutdown()
+        server.server_close()
+        t.join()
+    records = HistoryStore(str(tmpdir.join('history'))).query('pdu-a')
+    assert len(records) == 1
+    assert records[0][1].status(1).on
+
+def test_daemon_keeps_delayed_commands(server):
+    with APCClient('pdu-a', 'apc', 'secret', socket_path=server) as client:
+        client.status()
+        session = FakeSession.instances[0]
+        soon = client.on(1, 0.1)
+        later = client.on(2, 3600)
+        assert soon['host'] == 'pdu-a' and soon['op'] == 'on' and soon['args'] == [1, 0]
+        assert 'password' not in soon
+        assert [job['id'] for job in client.jobs()] == [soon['id'], later['id']]
+        assert session.log == ['status']  # nothing sent yet
+        assert client.cancel(later['id'])['id'] == later['id']
+        with pytest.raises(APCDaemonError):
+            client.cancel(later['id'])
+        for i in range(200):
+            if 'on 1' in session.log:
+                break
+            time.sleep(0.01)
+        assert session.log == ['status', 'on 1']
+        assert client.jobs() == []
+
+def test_cli_prints_scheduled_jobs(server):
+    from argparse import Namespace
+    from apc.cli_apc import run_steps
+    args = Namespace(host='pdu-a', wait=None, delay=3600, duration=5, status=False,
+                     json=False)
+    with APCClient('pdu-a', 'apc', 'apc', socket_path=server) as client:
+        lines = run_steps(args, client, [('on', [1, 2])])
+        jobs = client.jobs()
+    assert len(lines) == 2
+    for job, line in zip(jobs, lines):
+        assert line.split()[0] == str(job['id']) and line.split()[-2:] == ['on', str(job['args'][0])]
+
+def test_cli_broken_stdout_is_not_a_daemon_failure(server, monkeypatch):
+    from argparse import Namespace
+    from apc import cli_apc
+
+    def broken(*args):
+        raise BrokenPipeError(32, 'Broken pipe')
+    monkeypatch.setattr(cli_apc, 'print', broken, raising=False)
+    args = Namespace(host='pdu-a', user='apc', password='apc', cli=None, socket=server,
+                     transport='telnet', debug=False, wait=None, delay=0, duration=5,
+                     status=True, json=False)
+    with pytest.raises(BrokenPipeError):
+        cli_apc.run_client(args, [])
@@ -0,0 +1,122 @@
+import asyncio
+import sys
+import threading
+import pytest
+from apc.aio import AsyncAPC
+from apc.emulator import EmulatedPDU, EmulatorServer, EmulatorSession
+from apc.utility import APC, APC2, APC3, MyAPC, APC_CONFIRM_PROMPT
+
+
+def emulated_apc(tmpdir, firmware, outlets=8):
+    cli = '%s -m apc.emulator --stdio --firmware %s --outlets %d' % (sys.executable, firmware,
+                                                                     outlets)
+    return APC('emulator', 'apc', 'apc', False, True, cli, str(tmpdir))
+
+
+@pytest.mark.parametrize('firmware,driver', [('3.7.4', APC3), ('2.5.4', MyAPC)])
+def test_emulator_status_and_commands(tmpdir, firmware, driver):
+    apc = emulated_apc(tmpdir, firmware)
+    try:
+        assert isinstance(apc, driver)
+        assert apc.version == firmware
+        apc.off(3, 0)
+        apc.reboot(5, 0, 5)
+        ols = apc.status()
+        assert len(ols) == 8
+        assert str(ols[3].status) == 'OFF'
+        assert str(ols[5].status) == 'OFF*'  # back on after the reboot duration
+        assert ols[1].status.on
+        apc.on('*', 0)
+        assert all(ol.status.on for ol in apc.status())
+    finally:
+        apc.disconnect()
+
+@pytest.mark.parametrize('firmware', ['3.7.4', '2.5.4', '2.7.0'])
+def test_emulator_commands_read_outlet_state(tmpdir, firmware):
+    apc = emulated_apc(tmpdir, firmware)
+    try:
+        assert str(apc.off(3, 0)) == 'OFF'
+        assert str(apc.off(3, 0)) == 'OFF'  # already off: only redrawn
+        assert APC_CONFIRM_PROMPT not in apc.screen
+        assert str(apc.on(3, 0)) == 'ON'
+        assert str(apc.reboot(4, 0, 5)) == 'OFF*'
+        assert apc.on('*', 0) is None
+    finally:
+        apc.disconnect()
+
+@pytest.mark.parametrize('firmware', ['3.7.4', '2.5.4'])
+def test_emulator_master_control_before_status(tmpdir, firmware):
+    apc = emulated_apc(tmpdir, firmware, outlets=24)
+    try:
+        assert apc.get_outlet(9) == (9, 'Outlet #9')
+        assert str(apc.off(9, 0)) == 'OFF'
+        assert apc.get_outlet('*') == (25, 'ALL outlets')
+        ols = apc.status()
+        assert [ol.id for ol in ols if ol.status.off] == [9]
+        apc.off('*', 0)
+        assert all(ol.status.off for ol in apc.status())
+    finally:
+        apc.disconnect()
+
+def test_emulator_delayed_commands(tmpdir):
+    apc = emulated_apc(tmpdir, '3.7.4')
+    try:
+        apc.off(2, 30)
+        assert str(apc.status()[2].status) == 'ON*'
+    finally:
+        apc.disconnect()
+
+def test_emulator_v2(tmpdir):
+    apc = emulated_apc(tmpdir, '2.7.0')
+    try:
+        assert isinstance(apc, APC2)
+        apc.off(1, 0)
+        assert 'State        : OFF' in apc.screen
+    finally:
+        apc.disconnect()
+
+def run_server(pdu):
+    server = EmulatorServer(('127.0.0.1', 0), pdu)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    return server, thread
+
+def test_emulator_telnet_server_and_session_limit(tmpdir):
+    server, thread = run_server(EmulatedPDU('3.7.4', outlets=16))
+    port = server.server_address[1]
+
+    async def run():
+        async with AsyncAPC('127.0.0.1', 'apc', 'apc', port=port,
+                            lock_dir=str(tmpdir.join('a')), timeout=2) as apc:
+            await apc.off(12)
+            # Another client (not sharing our lock directory) is turned away
+            with pytest.raises(Exception):
+                async with AsyncAPC('127.0.0.1', 'apc', 'apc', port=port,
+                                    lock_dir=str(tmpdir.join('b')), timeout=2):
+                    pass
+            return await apc.status()
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    try:
+        ols = asyncio.run(run())
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert len(ols) == 16
+    assert ols[12].status.off
+
+def test_emulator_login_and_drops():
+    output = []
+    session = EmulatorSession(EmulatedPDU('3.7.4', password='secret'), output.append)
+    session.feed('apc\r\nwrong\r\n')
+    assert ''.join(output).endswith('User Name : ')
+    session.feed('apc\r\nsecret\r\n')
+    assert 'v3.7.4' in ''.join(output)
+    assert ''.join(output).endswith('\r\n> ')
+    session.feed('4\r\n')
+    assert session.closed and not session.dropped
+
+    session = EmulatorSession(EmulatedPDU(drop_rate=1), output.append)
+    session.feed('apc\r\n')
+    assert session.dropped
@@ -0,0 +1,45 @@
+import json
+import time
+import apc.fleet
+from apc.fleet import fleet_status, format_json, format_table, read_inventory, FleetTimeout
+from apc.outlet import Outlet, Outlets
+
+
+def fake_status(host, user, password, cli, lock_dir, timings, transport, health, deadline):
+    if host == 'dead':
+        raise SystemError('Cannot reach %s' % host)
+    if host == 'hung':
+        time.sleep(1)
+    if host.startswith('slow'):
+        time.sleep(0.3)
+    return Outlets([Outlet(1, host, 'ON')])
+
+
+def test_read_inventory(tmpdir):
+    inventory = tmpdir.join('pdus')
+    inventory.write('# rack 12\npdu-1\n\npdu-2  # top\n  pdu-3 row=b\n')
+    assert read_inventory(str(inventory)) == ['pdu-1', 'pdu-2', 'pdu-3']
+
+def test_fleet_status(monkeypatch):
+    monkeypatch.setattr(apc.fleet, '_status', fake_status)
+    start = time.time()
+    results = fleet_status(['pdu-1', 'dead', 'hung', 'pdu-2'], 'apc', 'apc', timeout=0.3)
+    assert time.time() - start < 0.9
+    assert list(results) == ['pdu-1', 'dead', 'hung', 'pdu-2']
+    assert results['pdu-2'][1].name == 'pdu-2'
+    assert isinstance(results['dead'], SystemError)
+    assert isinstance(results['hung'], FleetTimeout)
+
+    d = json.loads(format_json(results))
+    assert d['pdu-1'] == {'outlets': [{'id': 1, 'name': 'pdu-1', 'status': 'ON'}]}
+    assert d['dead'] == {'error': 'Cannot reach dead'}
+    assert 'dead\nERROR: Cannot reach dead' in format_table(results)
+
+def test_fleet_timeout_per_host(monkeypatch):
+    monkeypatch.setattr(apc.fleet, '_status', fake_status)
+    # slow-2 waits for the worker, then gets its own 0.5 s
+    results = fleet_status(['slow-1', 'slow-2'], 'apc', 'apc', workers=1, timeout=0.5)
+    assert results['slow-2'][1].name == 'slow-2'
+    results = fleet_status(['hung', 'pdu-1'], 'apc', 'apc', workers=1, timeout=0.2)
+    assert isinstance(results['hung'], FleetTimeout)
+    assert isinstance(results['pdu-1'], FleetTimeout)
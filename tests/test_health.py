@@ -0,0 +1,33 @@
+import time
+import pytest
+from apc.health import CircuitOpen, HealthTracker, health_path
+
+
+def test_circuit_opens_and_probes(tmpdir):
+    path = health_path(str(tmpdir))
+    health = HealthTracker(path, failures=2, cooldown=0.2)
+    health.check('pdu')
+    health.failure('pdu', OSError('refused'))
+    health.check('pdu')  # one failure is not enough
+    health.failure('pdu', OSError('refused'))
+    assert health.state('pdu') == 'open'
+    other = HealthTracker(path, failures=2, cooldown=0.2)  # another process
+    with pytest.raises(CircuitOpen) as e:
+        other.check('pdu')
+    assert 'refused' in str(e.value)
+    health.check('pdu-b')  # other hosts are not affected
+
+    time.sleep(0.2)
+    health.check('pdu')  # the probe
+    assert health.state('pdu') == 'half-open'
+    with pytest.raises(CircuitOpen):
+        other.check('pdu')  # while the probe runs
+    health.failure('pdu', OSError('refused'))
+    with pytest.raises(CircuitOpen):
+        other.check('pdu')  # reopened
+
+    time.sleep(0.2)
+    other.check('pdu')
+    other.success('pdu')
+    assert health.state('pdu') == 'closed'
+    health.check('pdu')
@@ -0,0 +1,76 @@
+import time
+import pytest
+import apc.history
+from apc.history import HistoryStore, HistoryException, HISTORY_MAGIC, HISTORY_RECORD
+from apc.outlet import Outlet, Outlets
+
+
+def outlets(*states):
+    return Outlets([Outlet(i, 'server-%d' % i, state) for i, state in enumerate(states, 1)])
+
+
+def test_history_records_changes_only(tmpdir):
+    history = HistoryStore(str(tmpdir))
+    assert history.append('pdu-12', outlets('ON', 'ON'), t=100)
+    assert not history.append('pdu-12', outlets('ON', 'ON'), t=105)
+    assert history.append('pdu-12', outlets('ON', 'OFF*'), t=110)
+    assert history.append('pdu-12', outlets('ON', 'OFF'), t=115)
+    history.append('pdu-13', outlets('OFF'), t=100)
+    history.close()
+
+    size = tmpdir.join('pdu-12.hist').size()
+    assert size == len(HISTORY_MAGIC) + 3 * HISTORY_RECORD.size
+
+    history = HistoryStore(str(tmpdir))
+    records = history.query('pdu-12')
+    assert [t for (t, snapshot) in records] == [100, 110, 115]
+    assert str(records[1][1][2].status) == 'OFF*'
+    assert [t for (t, snapshot) in history.query('pdu-12', 105, 115)] == [110]
+    assert str(history.before('pdu-12', 112)[2].status) == 'OFF*'
+    assert history.before('pdu-12', 100) is None
+    assert not history.append('pdu-12', outlets('ON', 'OFF'), t=120)  # last record reloaded
+
+def test_history_outlet_changes(tmpdir):
+    history = HistoryStore(str(tmpdir))
+    for t, states in enumerate([('ON', 'ON'), ('ON', 'OFF'), ('OFF', 'OFF'), ('OFF', 'ON')]):
+        history.append('pdu-12', outlets(*states), t=t)
+    changes = [(t, str(old), str(new)) for (t, old, new) in history.outlet_changes('pdu-12', 2)]
+    assert changes == [(1, 'ON', 'OFF'), (3, 'OFF', 'ON')]
+    changes = history.outlet_changes('pdu-12', 2, start=2)
+    assert [t for (t, old, new) in changes] == [3]
+
+def test_history_compact(tmpdir):
+    history = HistoryStore(str(tmpdir))
+    for t in range(10):
+        history.append('pdu-12', outlets('ON' if t % 2 else 'OFF'), t=t)
+    history.compact('pdu-12', before=7.5)
+    records = history.query('pdu-12')
+    assert [t for (t, snapshot) in records] == [7, 8, 9]  # 7 is the state at 7.5
+    assert history.append('pdu-12', outlets('OFF'), t=10)
+    assert len(history.query('pdu-12')) == 4
+
+def test_history_compact_streams_and_retention(tmpdir, monkeypatch):
+    monkeypatch.setattr(apc.history, 'HISTORY_COMPACT_CHUNK', 2 * HISTORY_RECORD.size)
+    history = HistoryStore(str(tmpdir), retention=5.5, compact_interval=0)
+    now = time.time()
+    for t in range(10):
+        history.append('pdu-12', outlets('ON' if t % 2 else 'OFF'), t=now - 10 + t)
+    # Compacted by each append: records 4 (the state 5.5 s ago) to 9 are left
+    assert [round(now - t) for (t, snapshot) in history.query('pdu-12')] == [6, 5, 4, 3, 2, 1]
+    assert history.query('pdu-12')[-1][1][1].status.on
+
+def test_history_truncated_record(tmpdir):
+    history = HistoryStore(str(tmpdir))
+    history.append('pdu-12', outlets('ON'), t=1)
+    history.close()
+    with open(str(tmpdir.join('pdu-12.hist')), 'ab') as f:
+        f.write(b'\x00' * 5)  # crash in the middle of a record
+    history = HistoryStore(str(tmpdir))
+    assert len(history.query('pdu-12')) == 1
+    history.append('pdu-12', outlets('OFF'), t=2)
+    assert [t for (t, snapshot) in history.query('pdu-12')] == [1, 2]
+
+def test_history_too_many_outlets(tmpdir):
+    history = HistoryStore(str(tmpdir))
+    with pytest.raises(HistoryException):
+        history.append('pdu-12', outlets(*(['ON'] * 65)))
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from apc.lockfile import FlockLock, isLocked
+
+
+def test_flock_lock_unlock(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    lock = FlockLock(name)
+    assert lock.lock()
+    assert lock.locked
+    assert not FlockLock(name).lock()
+    lock.unlock()
+    assert not lock.locked
+    assert FlockLock(name).lock()
+
+def test_flock_timeout(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    owner = FlockLock(name)
+    assert owner.lock()
+    start = time.time()
+    assert not FlockLock(name).lock(timeout=0.2)
+    elapsed = time.time() - start
+    assert 0.2 <= elapsed < 0.5
+    owner.unlock()
+
+def _release_later(lock, delay, released):
+    time.sleep(delay)
+    released.append(time.time())
+    lock.unlock()
+
+def test_flock_wakeup_on_release(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    owner = FlockLock(name)
+    assert owner.lock()
+    released = []
+    t = threading.Thread(target=_release_later, args=(owner, 0.2, released))
+    t.start()
+    waiter = FlockLock(name)
+    assert waiter.lock(timeout=5)
+    assert time.time() - released[0] < 0.1
+    waiter.unlock()
+    t.join()
+
+def test_flock_wakeup_outside_main_thread(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    owner = FlockLock(name)
+    assert owner.lock()
+    result = []
+
+    def wait():
+        waiter = FlockLock(name)
+        result.append(waiter.lock(timeout=5))
+        result.append(time.time())
+        waiter.unlock()
+
+    t = threading.Thread(target=wait)
+    t.start()
+    time.sleep(0.2)
+    released = time.time()
+    owner.unlock()
+    t.join()
+    assert result[0]
+    assert result[1] - released < 0.1
+
+def test_filesystem_lock_fallback(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    assert not isLocked(name)
+
+def test_flock_first_come_first_served(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    owner = FlockLock(name)
+    assert owner.lock()
+    order = []
+
+    def wait(i):
+        waiter = FlockLock(name)
+        assert waiter.lock(timeout=5)
+        order.append(i)
+        time.sleep(0.01)
+        waiter.unlock()
+
+    threads = [threading.Thread(target=wait, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+        time.sleep(0.05)  # in line before the next one
+    owner.unlock()
+    for t in threads:
+        t.join()
+    assert order == list(range(5))
+
+def test_flock_queue_skips_gone_waiters(tmpdir):
+    name = str(tmpdir.join('apc.lock'))
+    owner = FlockLock(name)
+    assert owner.lock()
+    assert not FlockLock(name).lock(timeout=0.05)  # gave up: out of the queue
+    owner.unlock()
+    # The ticket of a dead process is left in the queue, unlocked
+    tmpdir.join('apc.lock.queue', '%020d' % 0).write('')
+    lock = FlockLock(name)
+    assert lock.lock(timeout=1)
+    lock.unlock()
+    assert sorted(os.listdir(lock.queue)) == ['next']
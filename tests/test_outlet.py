@@ -1,5 +1,5 @@
 import pytest
-from apc.outlet import OutletStatus, Outlet, Outlets
+from apc.outlet import OutletStatus, Outlet, Outlets, OutletStreamParser
 from apc.outlet import OutletsException, OutletStatusParseException, OutletParseException
 
 
@@ -109,3 +109,84 @@ Outlet 8 MyServer#8      ON*"""
 
     for i, ol in enumerate(ol_collection, 1):
         assert ol.id == i
+
+def test_outlets_to_list():
+    ol_collection = Outlets([
+        Outlet(1, 'MyServer#1', 'OFF'),
+        Outlet(2, 'MyServer#2', 'ON*'),
+    ])
+    lst = ol_collection.to_list()
+    assert lst == [
+        {'id': 1, 'name': 'MyServer#1', 'status': 'OFF'},
+        {'id': 2, 'name': 'MyServer#2', 'status': 'ON*'},
+    ]
+    assert str(Outlets.from_list(lst)) == str(ol_collection)
+
+def test_outlets_parse_table():
+    screen = """
+ 1- Outlet 1 NAS             ON
+ 2- Outlet 2                 OFF*
+ 3- Master Control/Configuration
+"""
+    ol_collection = Outlets.parse_table(screen)
+    assert len(ol_collection) == 2
+    assert ol_collection[1].name == 'NAS'
+    assert str(ol_collection[2].status) == 'OFF*'
+
+def test_outlet_parse_multi_digit():
+    ol = Outlet.parse('Outlet 24 Rack 12 / db-primary  ON')
+    assert ol.id == 24
+    assert ol.name == 'Rack 12 / db-primary'
+    ol = Outlet.parse('Outlet 3 Lab ON  OFF*\r')
+    assert ol.name == 'Lab ON'
+    assert str(ol.status) == 'OFF*'
+
+def test_outlet_stream_parser():
+    screen = (b'1- Device Manager\r\n------- Outlet Control/Configuration ------\r\n'
+              b' 1- Outlet 1 NAS             ON\r\n'
+              b'10- Outlet 10                OFF*\r\n'
+              b'49- Master Control/Configuration\r\n'
+              b'\r\n<ESC>- Back, <ENTER>- Refresh\r\n> ')
+    parser = OutletStreamParser('-+ Outlet Control/Configuration -+')
+    outlets = []
+    for i in range(len(screen)):
+        outlets.extend(parser.feed(screen[i:i + 1]))
+        if i == screen.index(b'10-'):
+            assert [ol.id for ol in outlets] == [1]  # first row out before the screen ends
+    assert parser.done
+    assert [ol.id for ol in outlets] == [1, 10]
+    assert parser.remainder == b'- Back, <ENTER>- Refresh\r\n> '
+
+def test_outlets_snapshot():
+    ol_collection = Outlets([
+        Outlet(1, 'MyServer#1', 'OFF'),
+        Outlet(2, 'MyServer#2', 'ON'),
+        Outlet(3, 'MyServer#3', 'OFF*'),
+        Outlet(4, 'MyServer#4', 'ON*'),
+    ])
+    snapshot = ol_collection.snapshot()
+    assert snapshot.on_mask == 0b1010
+    assert snapshot.pending_mask == 0b1100
+    assert str(snapshot) == str(ol_collection)
+    assert len(snapshot) == 4
+    assert [ol.id for ol in snapshot] == [1, 2, 3, 4]
+    assert snapshot[4].name == 'MyServer#4'
+    assert str(snapshot[4].status) == 'ON*'
+    assert snapshot.to_list() == ol_collection.to_list()
+
+    same = Outlets.from_list(ol_collection.to_list()).snapshot()
+    assert same == snapshot
+    assert hash(same) == hash(snapshot)
+    assert same.names is snapshot.names  # layout shared between snapshots
+
+def test_outlets_snapshot_diff():
+    before = Outlets([Outlet(1, 'a', 'ON'), Outlet(2, 'b', 'ON'), Outlet(3, 'c', 'OFF')]).snapshot()
+    after = Outlets([Outlet(1, 'a', 'ON'), Outlet(2, 'b', 'OFF*'), Outlet(3, 'c', 'ON')]).snapshot()
+    assert before != after
+    changes = [(id, str(old), str(new)) for (id, old, new) in before.diff(after)]
+    assert changes == [(2, 'ON', 'OFF*'), (3, 'OFF', 'ON')]
+    assert before.diff(before) == []
+
+    other = Outlets([Outlet(1, 'a', 'OFF'), Outlet(4, 'd', 'ON')]).snapshot()
+    changes = [(id, str(old), str(new)) for (id, old, new) in before.diff(other)]
+    assert changes == [(1, 'ON', 'OFF'), (2, 'ON', 'None'), (3, 'OFF', 'None'), (4, 'None', 'ON')]
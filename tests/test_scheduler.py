@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+from apc.scheduler import Scheduler
+
+
+def collect():
+    done = []
+    event = threading.Event()
+
+    def execute(job):
+        done.append((job.id, time.time()))
+        event.set()
+    return done, event, execute
+
+def test_scheduler_runs_jobs_in_due_order():
+    done, event, execute = collect()
+    scheduler = Scheduler(execute)
+    scheduler.start()
+    now = time.time()
+    late = scheduler.add(now + 0.2, {'op': 'on'})
+    early = scheduler.add(now + 0.05, {'op': 'off'})
+    cancelled = scheduler.add(now + 0.1, {'op': 'reboot'})
+    assert scheduler.cancel(cancelled.id) is cancelled
+    assert scheduler.cancel(cancelled.id) is None
+    assert [job.id for job in scheduler.jobs()] == [early.id, late.id]
+    deadline = time.time() + 2
+    while len(done) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+    assert [job_id for (job_id, t) in done] == [early.id, late.id]
+    assert done[0][1] >= now + 0.05 and done[1][1] >= now + 0.2
+    assert scheduler.jobs() == []
+
+def test_scheduler_many_jobs():
+    done, event, execute = collect()
+    scheduler = Scheduler(execute)
+    now = time.time()
+    for i in range(5000):
+        scheduler.add(now + 3600 + i, {'op': 'on', 'args': [i % 8 + 1, 0]})
+    soon = scheduler.add(now, {'op': 'off'})
+    scheduler.start()
+    assert event.wait(2)
+    scheduler.stop()
+    assert done[0][0] == soon.id and len(done) == 1
+    assert len(scheduler.jobs()) == 5000
+
+def test_scheduler_persistence(tmpdir):
+    path = str(tmpdir.join('jobs'))
+    done, event, execute = collect()
+    scheduler = Scheduler(execute, path)
+    now = time.time()
+    kept = scheduler.add(now + 3600, {'op': 'on', 'host': 'pdu1'})
+    cancelled = scheduler.add(now + 3600, {'op': 'off', 'host': 'pdu1'})
+    scheduler.cancel(cancelled.id)
+    scheduler.stop()
+    with open(path, 'a') as f:
+        f.write(json.dumps({'add': {'id': 7, 'due': now - 7200, 'request': {}}}) + '\n')
+        f.write('{"add": {"id": 8')  # cut short by a crash
+
+    scheduler = Scheduler(execute, path)
+    assert [job.id for job in scheduler.jobs()] == [kept.id]
+    assert scheduler.jobs()[0].request == {'op': 'on', 'host': 'pdu1'}
+    assert [job.id for job in scheduler.expired] == [7]
+    assert scheduler.add(now + 60, {}).id == 8
+    scheduler.stop()
+    with open(path) as f:
+        assert len(f.readlines()) == 2  # compacted, plus the new job
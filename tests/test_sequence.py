@@ -0,0 +1,128 @@
+import threading
+import time
+import pytest
+from apc.sequence import (Circuit, Sequencer, SequenceParseException, format_event,
+                          parse_plan)
+
+
+PLAN = '''
+# circuit NAME LIMIT GAP
+circuit A 2 0.05
+1 on  pdu1 1-3 A
+1 on  pdu2 1-3 A
+1 on  pdu3 1,2       # its own circuit
+2 off pdu1 *
+'''
+
+
+class FakeSession:
+    def __init__(self, host, log, lock, seconds=0.02, fail=()):
+        self.host = host
+        self.log = log
+        self.lock = lock
+        self.seconds = seconds
+        self.fail = fail
+        self.closed = False
+
+    def _command(self, action, outlet):
+        if outlet in self.fail:
+            raise SystemExit('Bad outlet: [%s]' % outlet)
+        start = time.time()
+        time.sleep(self.seconds)
+        with self.lock:
+            self.log.append((self.host, action, outlet, start, time.time()))
+
+    def on(self, outlet, delay=0):
+        self._command('on', outlet)
+
+    def off(self, outlet, delay=0):
+        self._command('off', outlet)
+
+    def reboot(self, outlet, delay=0, duration=5):
+        self._command('reboot', outlet)
+
+    def close(self):
+        self.closed = True
+
+
+def fake_connect(sessions, **kwargs):
+    log = []
+    lock = threading.Lock()
+
+    def connect(host):
+        if host == 'dead':
+            raise SystemExit('Cannot acquire lock')
+        sessions[host] = FakeSession(host, log, lock, **kwargs)
+        return sessions[host]
+    return connect, log
+
+def test_parse_plan():
+    steps, circuits = parse_plan(PLAN.splitlines())
+    assert [(s.group, s.action, s.host, s.outlet, s.circuit) for s in steps][:4] == [
+        (1, 'on', 'pdu1', 1, 'A'), (1, 'on', 'pdu1', 2, 'A'), (1, 'on', 'pdu1', 3, 'A'),
+        (1, 'on', 'pdu2', 1, 'A')]
+    assert steps[-1].outlet == '*' and steps[-1].circuit == 'pdu1'
+    assert (circuits['A'].limit, circuits['A'].gap) == (2, 0.05)
+    for plan in ['', 'circuit A', '1 blink pdu1 1', 'x on pdu1 1', '1 on pdu1 9-2']:
+        with pytest.raises(SequenceParseException):
+            parse_plan([plan])
+
+def test_sequencer_respects_circuits_and_groups():
+    steps, circuits = parse_plan(PLAN.splitlines())
+    sessions = {}
+    connect, log = fake_connect(sessions, seconds=0.15)
+    events = []
+    timeline = Sequencer(connect, circuits, gap=0.1, progress=events.append).run(steps)
+    assert len(timeline) == len(steps) == len(log) and events == timeline
+    assert all(event['error'] is None for event in timeline)
+    assert all(session.closed for session in sessions.values())
+
+    on_a = sorted(entry for entry in log if entry[0] in ('pdu1', 'pdu2') and entry[1] == 'on')
+    starts = sorted(entry[3] for entry in on_a)
+    assert all(b - a >= 0.05 - 0.005 for (a, b) in zip(starts, starts[1:]))
+    # Never more than 2 commands at once on circuit A, but both PDUs overlap
+    for (host, action, outlet, start, end) in on_a:
+        assert len([e for e in on_a if e[3] <= start < e[4]]) <= 2
+    assert any(a[0] != b[0] and a[3] < b[3] < a[4] for a in on_a for b in on_a)
+
+    pdu3 = [entry[3] for entry in log if entry[0] == 'pdu3']
+    assert pdu3[1] - pdu3[0] >= 0.1 - 0.005
+    group2 = [entry for entry in log if entry[1] == 'off']
+    assert group2[0][3] >= max(entry[4] for entry in log if entry[1] == 'on')
+
+def test_sequencer_failures():
+    steps, circuits = parse_plan(['1 on pdu1 1-3', '1 on dead 1-2', '2 on pdu1 4'])
+    sessions = {}
+    connect, log = fake_connect(sessions, fail=(2,))
+    timeline = Sequencer(connect, gap=0).run(steps)
+    errors = dict(((e['host'], e['outlet']), e['error']) for e in timeline)
+    assert errors[('pdu1', 1)] is None and errors[('pdu1', 3)] is None
+    assert errors[('pdu1', 2)] == 'Bad outlet: [2]'
+    assert errors[('dead', 1)] == errors[('dead', 2)] == 'Cannot connect: Cannot acquire lock'
+    assert ('pdu1', 4) not in errors  # group 2 not run
+    assert 'FAILED' in format_event(timeline[-1]) or 'FAILED' in format_event(timeline[0])
+    timeline = Sequencer(connect, gap=0, keep_going=True).run(steps)
+    assert len(timeline) == len(steps)
+
+def test_circuit_gap():
+    circuit = Circuit('A', limit=3, gap=0.05)
+    starts = []
+    for i in range(3):
+        circuit.acquire()
+        starts.append(time.time())
+        circuit.release()
+    assert starts[2] - starts[0] >= 0.1 - 0.005
+
+def test_sequencer_spaces_commands_not_logins():
+    # pdu1 is slow to log in: its command must still come a gap after pdu2's
+    steps, circuits = parse_plan(['circuit A 2 0.3', '1 on pdu1 1 A', '1 on pdu2 1 A'])
+    sessions = {}
+    connect, log = fake_connect(sessions)
+
+    def slow_connect(host):
+        time.sleep(0.45 if host == 'pdu1' else 0.03)
+        return connect(host)
+    timeline = Sequencer(slow_connect, circuits).run(steps)
+    assert all(event['error'] is None for event in timeline)
+    starts = sorted(entry[3] for entry in log)
+    assert starts[1] - starts[0] >= 0.3 - 0.005
@@ -0,0 +1,110 @@
+import pexpect
+import pytest
+import apc.session
+import apc.utility
+from apc.session import APCSession
+
+
+class FakeChild:
+    def __init__(self):
+        self.alive = True
+
+    def isalive(self):
+        return self.alive
+
+
+class FakeAPC:
+    def __init__(self, log):
+        self.child = FakeChild()
+        self.log = log
+        self.drop_next = False
+
+    def on(self, outlet, delay):
+        if self.drop_next:
+            self.child.alive = False
+            raise pexpect.EOF('session closed')
+        self.log.append(('on', outlet))
+
+    def reboot(self, outlet, delay, duration):
+        self.log.append(('reboot', outlet))
+        self.command_sent = True
+        if self.drop_next:
+            self.child.alive = False
+            raise pexpect.EOF('session closed')
+
+    def status(self):
+        self.log.append(('status',))
+        return 'status'
+
+    def disconnect(self):
+        self.log.append(('disconnect',))
+
+
+def fake_factory(log, connections):
+    def factory(*args, **kwargs):
+        connections.append(FakeAPC(log))
+        log.append(('connect',))
+        return connections[-1]
+    return factory
+
+
+def test_session_logs_in_once(monkeypatch):
+    log, connections = [], []
+    monkeypatch.setattr(apc.session, 'APC', fake_factory(log, connections))
+    with APCSession('pdu', 'apc', 'apc') as session:
+        session.on(1)
+        session.on(2)
+        assert session.status() == 'status'
+    assert log == [('connect',), ('on', 1), ('on', 2), ('status',), ('disconnect',)]
+
+def test_session_reconnects_after_drop(monkeypatch):
+    log, connections = [], []
+    monkeypatch.setattr(apc.session, 'APC', fake_factory(log, connections))
+    with APCSession('pdu', 'apc', 'apc') as session:
+        connections[-1].drop_next = True
+        session.on(3)
+        assert len(connections) == 2
+    assert log[-2:] == [('on', 3), ('disconnect',)]
+
+def test_session_does_not_run_a_sent_command_twice(monkeypatch):
+    log, connections = [], []
+    monkeypatch.setattr(apc.session, 'APC', fake_factory(log, connections))
+    session = APCSession('pdu', 'apc', 'apc')
+    session.connect()
+    connections[-1].drop_next = True
+    with pytest.raises(pexpect.EOF):
+        session.reboot(3)
+    assert log == [('connect',), ('reboot', 3), ('disconnect',)]
+    assert not session.connected
+    session.reboot(4)  # on a new session
+    assert log[-2:] == [('connect',), ('reboot', 4)]
+
+def test_session_reconnects_when_idle(monkeypatch):
+    log, connections = [], []
+    monkeypatch.setattr(apc.session, 'APC', fake_factory(log, connections))
+    session = APCSession('pdu', 'apc', 'apc', idle_timeout=0)
+    session.connect()
+    session.on(1)
+    assert len(connections) == 2
+    session.close()
+    assert not session.connected
+
+class DroppedChild(FakeChild):
+    def send(self, s):
+        pass
+
+    def expect(self, pattern, timeout=None):
+        raise pexpect.EOF('session closed')
+
+    def close(self, force=True):
+        self.alive = False
+
+def test_session_close_after_drop(tmpdir):
+    session = APCSession('pdu', 'apc', 'apc')
+    session.apc = apc.utility.APC3('pdu', False, True)
+    session.apc.child = DroppedChild()
+    session.apc.lock = apc.utility.APCLock(True, 'pdu', str(tmpdir))
+    session.apc.lock.lock()
+    session.apc.menu = ('1',)
+    session.close()  # the lock is released once only
+    assert not session.connected
@@ -0,0 +1,96 @@
+import threading
+import pytest
+from apc import snmp
+from apc.emulator import EmulatedPDU, SNMPAgent
+from apc.utility import APC, SNMPAPC
+
+
+def test_ber_roundtrip():
+    for value in (0, 127, 128, -1, -129, 2 ** 31, b'', b'x' * 300, 'Outlet 1', None,
+                  (1, 3, 6, 1, 4, 1, 318, 1, 1, 12, 3, 5, 1, 1, 4, 200000)):
+        (tag, decoded, end) = snmp.decode(snmp.encode(value))
+        assert decoded == (value.encode() if isinstance(value, str) else value)
+    message = snmp.encode_message('private', snmp.GET_BULK_REQUEST, 42,
+                                  [(snmp.SYS_DESCR, None)], 0, 24)
+    assert snmp.decode_message(message) == (1, b'private', snmp.GET_BULK_REQUEST, 42, 0, 24,
+                                            [(snmp.SYS_DESCR, None)])
+    with pytest.raises(snmp.SNMPError):
+        snmp.decode_message(message[:-3])
+
+def test_split_community():
+    assert snmp.split_community('public@pdu1:1161') == ('public', 'pdu1:1161')
+    assert snmp.split_community('pdu1') == (snmp.SNMP_DEFAULT_COMMUNITY, 'pdu1')
+
+@pytest.fixture
+def agent():
+    servers = []
+
+    def start(firmware='3.7.4', outlets=8, community='private'):
+        server = SNMPAgent(('127.0.0.1', 0), EmulatedPDU(firmware, outlets), community)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        servers.append((server, thread))
+        return server
+    yield start
+    for (server, thread) in servers:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+@pytest.mark.parametrize('firmware,mib', [('3.7.4', snmp.RackPDUMIB),
+                                          ('2.5.4', snmp.MasterSwitchMIB)])
+def test_snmp_driver(tmpdir, agent, firmware, mib):
+    server = agent(firmware)
+    host = 'snmp://127.0.0.1:%d' % server.server_address[1]
+    apc = APC(host, 'apc', 'apc', False, True, '', str(tmpdir))
+    try:
+        assert isinstance(apc, SNMPAPC)
+        assert apc.version == firmware
+        assert apc.mib is mib
+        assert str(apc.off(3, 0)) == 'OFF'
+        assert str(apc.off(3, 0)) == 'OFF'  # already off
+        assert str(apc.reboot(5, 0, 5)) == 'OFF*'
+        assert str(apc.off(2, 30)) == 'ON*'
+        ols = apc.status()
+        assert len(ols) == 8
+        assert [str(ol.status) for ol in ols] == ['ON', 'ON*', 'OFF', 'ON', 'OFF*',
+                                                  'ON', 'ON', 'ON']
+        assert server.pdu.outlets[1].off_delay == 30
+        apc.on('*', 0)
+        assert all(ol.status.on for ol in apc.status())
+    finally:
+        apc.disconnect()
+
+def test_snmp_numbers_are_single_outlets(tmpdir, agent):
+    server = agent(outlets=24)
+    host = 'snmp://127.0.0.1:%d' % server.server_address[1]
+    apc = APC(host, 'apc', 'apc', False, True, '', str(tmpdir))
+    try:
+        assert str(apc.off(9, 0)) == 'OFF'
+        assert [ol.id for ol in apc.status() if ol.status.off] == [9]
+        assert str(apc.off(9, 0)) == 'OFF'  # even once the outlets are counted
+        assert [ol.id for ol in apc.status() if ol.status.off] == [9]
+        apc.off('+', 0)
+        assert all(ol.status.off for ol in apc.status())
+    finally:
+        apc.disconnect()
+
+def test_snmp_bulk_walk_and_errors(agent):
+    server = agent(outlets=30, community='secret')
+    port = server.server_address[1]
+    client = snmp.connect('secret@127.0.0.1:%d' % port)
+    try:
+        rows = client.walk_columns(snmp.RackPDUMIB.STATUS_COLUMNS, max_repetitions=7)
+        assert [index for (index, values) in rows] == [(i,) for i in range(1, 31)]
+        with pytest.raises(snmp.SNMPError) as e:
+            client.set([(snmp.RackPDUMIB.REBOOT_DURATION + (1,), 600)])
+        assert 'wrongValue' in str(e.value)
+        assert server.pdu.outlets[0].reboot_duration == 5
+    finally:
+        client.close()
+    client = snmp.SNMPClient('127.0.0.1', 'public', port, timeout=0.2, retries=1)
+    try:
+        with pytest.raises(snmp.SNMPTimeout):
+            client.get([snmp.SYS_DESCR])
+    finally:
+        client.close()
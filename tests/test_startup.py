@@ -0,0 +1,46 @@
+import subprocess
+import sys
+
+# Import time (seconds) the command line may add to the one of argparse
+CLI_IMPORT_BUDGET = 0.03
+
+
+def imported_modules(code):
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'import sys\n%s\nprint(" ".join(sys.modules))' % code])
+    return set(output.decode().split())
+
+def test_lazy_imports():
+    modules = imported_modules('import apc.cli_apc')
+    assert not [m for m in modules if m.startswith('pexpect')]
+    assert 'apc.utility' not in modules and 'apc.daemon' not in modules
+    assert 'apc.sequence' not in modules and 'apc.watch' not in modules
+    modules = imported_modules('from apc.client import APCClient')
+    assert 'pexpect' not in modules
+    modules = imported_modules('import apc; apc.APCSession')
+    assert 'apc.session' in modules and 'pexpect' in modules
+
+def test_public_api():
+    import apc
+    from apc.utility import APC
+    from apc.session import APCSession
+    assert apc.APC is APC
+    assert apc.APCSession is APCSession
+    assert 'APC_DEFAULT_HOST' in dir(apc)
+
+def cumulative_import_times(code):
+    # python -X importtime: 'import time: self [us] | cumulative | name'
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE).stderr.decode()
+    times = {}
+    for line in output.splitlines()[1:]:
+        (self_time, cumulative, name) = line.split(':', 1)[1].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+def test_cli_import_time():
+    excess = []
+    for i in range(3):
+        times = cumulative_import_times('import apc.cli_apc')
+        excess.append(times['apc.cli_apc'] - times.get('argparse', 0))
+    assert min(excess) < CLI_IMPORT_BUDGET
@@ -0,0 +1,28 @@
+from apc.telnet import TelnetParser, escape, IAC, DO, DONT, WILL, WONT, SB, SE, ECHO, SGA
+
+NAWS = 31
+
+
+def test_telnet_payload():
+    parser = TelnetParser()
+    assert parser.feed(b'User Name : ') == (b'User Name : ', b'')
+    assert parser.feed(bytes(bytearray([IAC, IAC]))) == (bytes(bytearray([IAC])), b'')
+    assert escape(bytes(bytearray([1, IAC]))) == bytes(bytearray([1, IAC, IAC]))
+
+def test_telnet_negotiation():
+    parser = TelnetParser()
+    data = bytearray([IAC, WILL, ECHO, IAC, DO, NAWS, IAC, DO, SGA]) + b'> '
+    payload, reply = parser.feed(bytes(data))
+    assert payload == b'> '
+    assert reply == bytes(bytearray([IAC, DO, ECHO, IAC, WONT, NAWS, IAC, WILL, SGA]))
+    # Already agreed: no answer, no negotiation loop
+    assert parser.feed(bytes(bytearray([IAC, WILL, ECHO]))) == (b'', b'')
+    assert parser.feed(bytes(bytearray([IAC, WONT, ECHO]))) == (b'', bytes(bytearray([IAC, DONT, ECHO])))
+
+def test_telnet_split_commands():
+    parser = TelnetParser()
+    data = bytearray([IAC, SB, NAWS, 0, 80, IAC, SE]) + b'ok'
+    payload = b''
+    for byte in data:
+        payload += parser.feed(bytes(bytearray([byte])))[0]
+    assert payload == b'ok'
@@ -0,0 +1,37 @@
+import sys
+import pytest
+from apc.timing import Timings
+from apc.utility import APC
+
+
+def test_phases_of_a_session(tmpdir):
+    timings = Timings()
+    cli = '%s -m apc.emulator --stdio --firmware 3.7.4' % sys.executable
+    apc = APC('emulator', 'apc', 'apc', False, True, cli, str(tmpdir), timings=timings)
+    apc.reboot(2, 0, 5)
+    apc.status()
+    apc.disconnect()
+    phases = [(e['operation'], e['phase']) for e in timings.events]
+    assert phases[:3] == [('connect', 'lock'), ('connect', 'spawn'), ('connect', 'login')]
+    assert ('reboot', 'configure') in phases
+    assert ('reboot', 'confirm') in phases
+    assert ('read_status', 'read') in phases
+    assert phases[-1] == ('disconnect', 'logout')
+    assert all(e['host'] == 'emulator' and e['ok'] for e in timings.events)
+
+def test_prometheus_histograms():
+    timings = Timings()
+    events = []
+    timings.listeners.append(events.append)
+    timings.record('pdu-1', 'on', 'navigate', 0.3)
+    timings.record('pdu-1', 'on', 'navigate', 2)
+    with pytest.raises(ValueError):
+        with timings.phase('pdu-"2"', 'off', 'confirm'):
+            raise ValueError()
+    assert len(events) == 3 and not events[-1]['ok']
+    text = timings.prometheus()
+    assert 'apc_phase_seconds_bucket{host="pdu-1",operation="on",phase="navigate",le="0.25"} 0' in text
+    assert 'apc_phase_seconds_bucket{host="pdu-1",operation="on",phase="navigate",le="0.5"} 1' in text
+    assert 'apc_phase_seconds_bucket{host="pdu-1",operation="on",phase="navigate",le="+Inf"} 2' in text
+    assert 'apc_phase_seconds_sum{host="pdu-1",operation="on",phase="navigate"} 2.300000' in text
+    assert 'apc_phase_errors_total{host="pdu-\\"2\\"",operation="off",phase="confirm"} 1' in text
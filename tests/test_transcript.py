@@ -0,0 +1,61 @@
+import os
+import sys
+import pytest
+from apc.benchmark import regressions, run
+from apc.transcript import ReplaySpawn, TranscriptMismatch, read_transcript
+from apc.utility import APC, APCFactory
+
+
+def test_record_and_replay(tmpdir):
+    path = str(tmpdir.join('session.jsonl'))
+    cli = '%s -m apc.emulator --stdio --firmware 3.7.4' % sys.executable
+    apc = APC('emulator', 'apc', 'apc', False, True, cli, str(tmpdir), record=path)
+    apc.off(2, 0)
+    status = str(apc.status())
+    apc.disconnect()
+
+    events = read_transcript(path)
+    assert events[0][1] == 'recv'
+    assert b'v3.7.4' in b''.join(data for (t, kind, data) in events)
+
+    child = ReplaySpawn(events)
+    apc = APCFactory().build('replay', 'apc', 'apc', False, True, '', str(tmpdir), child=child)
+    apc.off(2, 0)
+    assert str(apc.status()) == status
+    apc.disconnect()
+    assert child.keystrokes > 0
+    assert child.bytes_read == sum(len(data) for (t, kind, data) in events if kind == 'recv')
+
+    child = ReplaySpawn(events)
+    apc = APCFactory().build('replay', 'apc', 'apc', False, True, '', str(tmpdir), child=child)
+    with pytest.raises(TranscriptMismatch):
+        apc.off(3, 0)
+
+def test_record_redacts_the_password(tmpdir):
+    path = str(tmpdir.join('session.jsonl'))
+    cli = '%s -m apc.emulator --stdio --firmware 3.7.4 --password s3cret' % sys.executable
+    apc = APC('emulator', 'apc', 's3cret', False, True, cli, str(tmpdir), record=path)
+    apc.disconnect()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert 's3cret' not in open(path).read()
+
+    # Any password is taken for the redacted one
+    child = ReplaySpawn(read_transcript(path))
+    apc = APCFactory().build('replay', 'apc', 'other', False, True, '', str(tmpdir), child=child)
+    assert apc.version == '3.7.4'
+    apc.disconnect()
+
+def test_benchmark_recorded_transcripts():
+    results = run('benchmarks/transcripts', ['3.7.4'], repeat=1)
+    assert [r['operation'] for r in results] == ['status', 'on', 'off', 'reboot',
+                                                 'delayed-reboot']
+    assert all(r['driver'] == 'APC3' and r['keystrokes'] > 0 for r in results)
+    assert results[0]['parse'] > 0
+
+def test_benchmark_regressions():
+    baseline = [{'firmware': '3.7.4', 'operation': 'on', 'wall': 0.1, 'keystrokes': 8,
+                 'bytes_sent': 25, 'bytes_read': 2000}]
+    results = [dict(baseline[0], wall=0.11)]
+    assert regressions(results, baseline) == []
+    results = [dict(baseline[0], wall=0.2, keystrokes=9)]
+    assert len(regressions(results, baseline)) == 2
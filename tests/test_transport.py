@@ -0,0 +1,74 @@
+import threading
+import pytest
+import apc.defaults
+import apc.transport
+from apc.emulator import EmulatedPDU, EmulatorServer
+from apc.transport import TransportError, connect, split_host
+from apc.utility import APC, APC3
+
+
+def test_split_host():
+    assert split_host('pdu1', 23) == ('pdu1', 23)
+    assert split_host('pdu1:2323', 23) == ('pdu1', 2323)
+    assert split_host('[fe80::1]:2222', 22) == ('fe80::1', 2222)
+    assert split_host('fe80::1', 22) == ('fe80::1', 22)
+    with pytest.raises(TransportError):
+        split_host('pdu1:telnet', 23)
+
+def test_telnet_transport(tmpdir):
+    server = EmulatorServer(('127.0.0.1', 0), EmulatedPDU('3.7.4'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        host = '127.0.0.1:%d' % server.server_address[1]
+        apc = APC(host, 'apc', 'apc', False, True, '', str(tmpdir), transport='telnet')
+        try:
+            assert isinstance(apc, APC3)
+            apc.off(4, 0)
+            assert str(apc.status()[4].status) == 'OFF'
+        finally:
+            apc.disconnect()
+        assert not apc.child.isalive()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_transport_errors(monkeypatch):
+    with pytest.raises(TransportError):
+        connect('rlogin', 'pdu1', 'apc', 'apc')
+    monkeypatch.setattr(apc.transport, 'paramiko', None)
+    with pytest.raises(TransportError):
+        connect('ssh', 'pdu1', 'apc', 'apc')
+    with pytest.raises(TransportError):
+        connect('telnet', '127.0.0.1:1', 'apc', 'apc', timeout=1)
+
+def test_ssh_rejects_new_host_keys(monkeypatch):
+    policies = []
+
+    class FakeClient:
+        def load_system_host_keys(self):
+            pass
+
+        def set_missing_host_key_policy(self, policy):
+            policies.append(policy)
+
+        def connect(self, *args, **kwargs):
+            raise OSError('refused')
+
+        def close(self):
+            pass
+
+    class FakeParamiko:
+        SSHClient = FakeClient
+        SSHException = Exception
+        RejectPolicy = type('RejectPolicy', (), {})
+        WarningPolicy = type('WarningPolicy', (), {})
+    monkeypatch.setattr(apc.transport, 'paramiko', FakeParamiko)
+    with pytest.raises(TransportError):
+        connect('ssh', 'pdu1', 'apc', 'apc')
+    assert isinstance(policies[-1], FakeParamiko.RejectPolicy)
+    monkeypatch.setattr(apc.defaults, 'APC_SSH_ACCEPT_NEW_HOST_KEYS', True)
+    with pytest.raises(TransportError):
+        connect('ssh', 'pdu1', 'apc', 'apc')
+    assert isinstance(policies[-1], FakeParamiko.WarningPolicy)
@@ -0,0 +1,239 @@
+import time
+import pexpect
+import pytest
+from apc.health import CircuitOpen, HealthTracker, health_path
+from apc.utility import APCDeadlineError, APCFactory, APCLock, APC3, APCStepError, Deadline
+from apc.utility import StepTimeout, lock_path, APC_STEP_TIMEOUT_MIN, APC_STEP_TIMEOUT_MAX
+from apc.utility import APC_ESCAPE, APC_YES, APC_PROMPT, APC_CONFIRM_PROMPT, APC_CONTINUE_PROMPT
+
+
+def test_lock_path():
+    assert lock_path('10.8.0.142', '/tmp') == '/tmp/apc-10.8.0.142.lock'
+    assert lock_path('pdu-12.example.com', '/var/lock') == '/var/lock/apc-pdu-12.example.com.lock'
+    assert lock_path('../etc/passwd', '/tmp') == '/tmp/apc-.._etc_passwd.lock'
+
+def test_lock_per_host(tmpdir):
+    lock_a = APCLock(True, 'pdu-a', str(tmpdir))
+    lock_b = APCLock(True, 'pdu-b', str(tmpdir))
+    lock_a.lock()
+    lock_b.lock()  # a different PDU must not wait for pdu-a
+    assert lock_a.path != lock_b.path
+    lock_a.unlock()
+    lock_b.unlock()
+
+class FakeChild:
+    timeout = 10
+
+    def __init__(self, answers=None, screen=b''):
+        self.sent = []
+        self.before = b''
+        self.buffer = b''
+        self.answers = answers or {}
+        self.screen = screen  # sent back in chunks to read_nonblocking()
+
+    def read_nonblocking(self, size, timeout):
+        if not self.screen:
+            raise pexpect.TIMEOUT('timeout')
+        data, self.screen = self.screen[:7], self.screen[7:]
+        return data
+
+    def send(self, s):
+        self.sent.append(s)
+
+    def close(self, force=False):
+        self.closed = True
+
+    def expect(self, pattern, timeout=None):
+        if pattern not in self.answers:
+            self.before = b''
+            return 0
+        answer = self.answers[pattern]
+        if answer is None:
+            self.before = b'...'
+            raise pexpect.TIMEOUT('timeout')
+        self.before = answer
+        return 0
+
+
+def make_apc3(answers=None, screen=b''):
+    apc = APC3('pdu', False, True)
+    apc.child = FakeChild(answers or {APC_CONTINUE_PROMPT: b'Command successfully issued.\r\n'},
+                          screen)
+    return apc
+
+def test_navigate_shares_common_menus():
+    apc = make_apc3()
+    apc.control_outlet(3)
+    assert apc.child.sent == ['1\r\n', '2\r\n', '1\r\n', '3\r\n', '1\r\n']
+    apc.child.sent = []
+    apc.control_outlet(3)  # already there
+    assert apc.child.sent == []
+    apc.configure_outlet(3)
+    assert apc.child.sent == [APC_ESCAPE, '2\r\n']
+    apc.child.sent = []
+    apc.control_outlet(4)
+    assert apc.child.sent == [APC_ESCAPE, APC_ESCAPE, '4\r\n', '1\r\n']
+    assert apc.menu == ('1', '2', '1', '4', '1')
+
+def test_navigate_refresh_and_unknown_position():
+    apc = make_apc3()
+    apc._navigate(('1', '2', '1'))
+    apc.child.sent = []
+    apc._navigate(('1', '2', '1'), refresh=True)
+    assert apc.child.sent == ['\r\n']
+    apc.menu = None
+    apc.child.answers[APC_PROMPT] = None  # no more redraws after the first ones
+    apc.child.sent = []
+    with pytest.raises(APCStepError):
+        apc._navigate(('1',))
+    assert apc.child.sent == [APC_ESCAPE] * 6 + ['\r\n', '1\r\n']
+
+def test_consecutive_commands_skip_main_menu():
+    apc = make_apc3()
+    apc.on(1, 0)
+    apc.child.sent = []
+    apc.off(1, 0)
+    # The Control Outlet screen is only redrawn, to read the current state
+    assert apc.child.sent == ['\r\n', APC3.APC_IMMEDIATE_OFF + '\r\n', APC_YES + '\r\n',
+                              '\r\n']
+
+def test_step_error_names_the_failing_step():
+    apc = make_apc3({APC_CONFIRM_PROMPT: None})
+    with pytest.raises(APCStepError) as e:
+        apc.on(2, 0)
+    assert e.value.step == 'command'
+    assert isinstance(e.value, pexpect.TIMEOUT)
+    assert apc.menu is None
+
+def test_command_result_is_checked():
+    apc = make_apc3({APC_CONTINUE_PROMPT: b'Command failed'})
+    with pytest.raises(APCStepError) as e:
+        apc.off(2, 0)
+    assert e.value.step == 'command result'
+
+def test_step_timeout_adapts():
+    timeout = StepTimeout(minimum=1, maximum=10)
+    assert timeout.timeout == 10
+    for i in range(20):
+        timeout.observe(0.1)
+    assert timeout.timeout == 1
+    for i in range(20):
+        timeout.observe(1.5)
+    assert 1.5 < timeout.timeout < 10
+
+def test_step_timeout_per_kind_of_step():
+    apc = make_apc3()
+    for i in range(5):
+        apc.on(1, 0)
+    # Menus answering fast do not shorten the wait for an outlet table
+    assert apc.step_timeout('menu main').timeout == APC_STEP_TIMEOUT_MIN
+    assert apc.step_timeout('menu 1-2') is apc.step_timeout('menu main')
+    assert apc.step_timeout('status').timeout == APC_STEP_TIMEOUT_MAX
+
+
+STATUS_SCREEN = b'''
+------- Outlet Control/Configuration ------
+
+ 1- Outlet 1 NAS             ON
+ 2- Outlet 2                 OFF
+ 3- Master Control/Configuration
+
+<ESC>- Back, <ENTER>- Refresh'''
+
+def test_status_cache():
+    apc = make_apc3({APC_CONFIRM_PROMPT: b'Immediate Reboot\r\n',
+                     APC_CONTINUE_PROMPT: b'Command successfully issued.\r\n'},
+                    STATUS_SCREEN * 3)
+    apc.status_ttl = 60
+    ols = apc.status()
+    assert str(ols[2].status) == 'OFF'
+    apc.child.sent = []
+    assert apc.status() is ols  # served from cache
+    assert apc.child.sent == []
+
+    apc.on(2, 0)  # patched
+    assert str(apc.status()[2].status) == 'ON'
+    assert str(ols[2].status) == 'OFF'  # earlier results are not modified
+
+    apc.reboot(1, 0, 5)  # state unknown until read again
+    apc.child.sent = []
+    apc.status()
+    assert apc.child.sent != []
+
+def test_status_not_cached_by_default():
+    apc = make_apc3(screen=STATUS_SCREEN * 2)
+    apc.status()
+    apc.child.sent = []
+    apc.status()
+    assert apc.child.sent != []
+
+def test_iter_status_streams_wide_tables():
+    rows = b''.join(b' %d- Outlet %d server-%02d        ON\r\n' % (i, i, i) for i in range(1, 25))
+    header = b'\r\n------- Outlet Control/Configuration ------\r\n'
+    screen = header + rows + b' 25- Master Control/Configuration\r\n<ESC>- Back\r\n> '
+    apc = make_apc3(screen=screen)
+    outlets = apc.iter_status()
+    first = next(outlets)
+    assert first.id == 1
+    assert apc.child.screen  # the rest of the screen is not read yet
+    assert [ol.id for ol in outlets] == list(range(2, 25))
+    assert apc.child.buffer + apc.child.screen == b'- Back\r\n> '  # left for the prompt
+    apc = make_apc3(screen=screen)
+    assert apc.read_status()[24].name == 'server-24'
+    assert apc.all_outlets == 25
+    assert apc.get_outlet('9') == (9, 'Outlet #9')
+    assert apc.get_outlet('*') == (25, 'ALL outlets')
+
+def test_failed_login_releases_the_lock(tmpdir):
+    health = HealthTracker(health_path(str(tmpdir)), failures=2)
+    for i in range(2):
+        child = FakeChild({'User Name : ': None})
+        with pytest.raises(pexpect.TIMEOUT):
+            APCFactory().build('pdu', 'apc', 'apc', False, True, '', str(tmpdir), child=child,
+                               health=health)
+        assert child.closed
+        lock = APCLock(True, 'pdu', str(tmpdir))
+        lock.lock(timeout=0)  # not left locked
+        lock.unlock()
+    with pytest.raises(CircuitOpen):
+        APCFactory().build('pdu', 'apc', 'apc', False, True, '', str(tmpdir),
+                           child=FakeChild(), health=health)
+
+def test_deadline_covers_the_lock_wait(tmpdir):
+    lock = APCLock(True, 'pdu', str(tmpdir))
+    lock.lock()
+    start = time.time()
+    with pytest.raises(APCDeadlineError):
+        APCFactory().build('pdu', 'apc', 'apc', False, True, '', str(tmpdir),
+                           child=FakeChild(), deadline=0.2)
+    assert time.time() - start < 1
+    lock.unlock()
+
+def test_deadline_cuts_steps_short():
+    apc = make_apc3()
+    apc.deadline = Deadline(0)
+    with pytest.raises(APCDeadlineError):
+        apc.on(1, 0)
+
+def test_deadline_is_not_a_host_failure(tmpdir):
+    class SlowChild(FakeChild):
+        def expect(self, pattern, timeout=None):
+            time.sleep(0.1)
+            return FakeChild.expect(self, pattern, timeout)
+    health = HealthTracker(health_path(str(tmpdir)), failures=1)
+    with pytest.raises(APCDeadlineError):
+        APCFactory().build('pdu', 'apc', 'apc', False, True, '', str(tmpdir),
+                           child=SlowChild(), health=health, deadline=0.15)
+    assert health.state('pdu') == 'closed'
+
+def test_disconnect_hangs_up_when_the_logout_fails(tmpdir):
+    apc = make_apc3({APC_PROMPT: None})
+    apc.lock = APCLock(True, 'pdu', str(tmpdir))
+    apc.lock.lock()
+    apc.menu = ('1', '2')
+    with pytest.raises(APCStepError):
+        apc.disconnect()
+    assert apc.child.closed
+    lock = APCLock(True, 'pdu', str(tmpdir))
+    lock.lock(timeout=0)  # not left locked
+    lock.unlock()
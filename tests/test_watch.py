@@ -0,0 +1,120 @@
+import subprocess
+import sys
+import time
+from argparse import Namespace
+import pexpect
+import pytest
+from apc.outlet import Outlet, Outlets
+from apc.watch import Watcher, WaitTimeout, wait_settled
+
+
+class FakeSession:
+    def __init__(self, tables):
+        self.tables = tables
+        self.reads = 0
+
+    def status(self):
+        table = self.tables[min(self.reads, len(self.tables) - 1)]
+        self.reads += 1
+        return Outlets([Outlet(i + 1, 'ol%d' % (i + 1), s) for i, s in enumerate(table)])
+
+def test_watch_reports_changes_only():
+    session = FakeSession([['ON', 'OFF'], ['ON', 'OFF'], ['OFF*', 'OFF'], ['OFF', 'ON']])
+    watcher = Watcher(session, 'pdu1', min_interval=1, max_interval=8)
+    events = watcher.poll()
+    assert [(e['outlet'], e['old'], e['new']) for e in events] == [(1, None, 'ON'),
+                                                                   (2, None, 'OFF')]
+    assert events[0]['host'] == 'pdu1' and events[0]['name'] == 'ol1'
+    assert watcher.interval == 1
+    assert watcher.poll() == []
+    assert watcher.interval == 2
+    assert [(e['outlet'], e['old'], e['new']) for e in watcher.poll()] == [(1, 'ON', 'OFF*')]
+    assert watcher.interval == 1
+    assert [(e['outlet'], e['new']) for e in watcher.poll()] == [(1, 'OFF'), (2, 'ON')]
+    for interval in (2, 4, 8, 8):
+        assert watcher.poll() == []
+        assert watcher.interval == interval
+
+def test_watch_stays_fast_while_pending():
+    session = FakeSession([['ON*'], ['ON*'], ['ON*']])
+    watcher = Watcher(session, min_interval=0.5)
+    for i in range(3):
+        watcher.poll()
+        assert watcher.interval == 0.5
+
+def test_watch_generator():
+    session = FakeSession([['OFF'], ['ON*'], ['ON']])
+    events = list(Watcher(session, min_interval=0.01).watch(0.2))
+    assert [e['new'] for e in events] == ['OFF', 'ON*', 'ON']
+
+class CachedSession(FakeSession):
+    def status(self):
+        raise AssertionError('wait_settled must bypass the status cache')
+
+    def read_status(self):
+        return FakeSession.status(self)
+
+def test_wait_settled():
+    session = CachedSession([['ON', 'OFF*'], ['ON', 'OFF*'], ['ON', 'OFF']])
+    ols = wait_settled(session, [2], on=False, interval=0.01)
+    assert session.reads == 3 and not ols[2].status.on
+    session = FakeSession([['OFF*', 'OFF'], ['ON', 'ON']])
+    wait_settled(session, '*', interval=0.01)
+    assert session.reads == 2
+
+def test_wait_settled_reboot():
+    # Still on right after the command: not rebooted yet
+    session = FakeSession([['ON'], ['OFF*'], ['ON*'], ['ON']])
+    wait_settled(session, [1], rebooted=True, duration=60, interval=0.01)
+    assert session.reads == 4
+    session = FakeSession([['ON']])
+    wait_settled(session, [1], rebooted=True, duration=0.05, interval=0.01)
+    assert session.reads > 1
+
+def test_wait_settled_deadline():
+    session = FakeSession([['OFF*']])
+    start = time.time()
+    with pytest.raises(WaitTimeout):
+        wait_settled(session, [1], timeout=0.2, interval=0.01)
+    assert time.time() - start < 0.3
+    with pytest.raises(SystemExit):
+        wait_settled(session, [7], timeout=0.2)
+
+def test_wait_settled_master_entry():
+    # 9 is the master control of an 8 outlet PDU, not an outlet of its own
+    session = FakeSession([['OFF*'] * 8, ['OFF'] * 8])
+    wait_settled(session, [9], on=False, interval=0.01)
+    assert session.reads == 2
+
+def test_cli_wait_on_master_entry(tmpdir):
+    cli = '%s -m apc.emulator --stdio --firmware 3.7.4' % sys.executable
+    code = 'from apc.cli_apc import main; main()'
+    result = subprocess.run([sys.executable, '-c', code, '--cli', cli, '--lock-dir', str(tmpdir),
+                             '--no-breaker', '--quiet', '--off', '9', '--wait', '20'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 0, result.stderr
+
+class ClosedSession(FakeSession):
+    def __init__(self, *args, **kwargs):
+        FakeSession.__init__(self, [])
+        self.closed = 0
+
+    def status(self):
+        raise pexpect.EOF('End Of File (EOF)')
+
+    def close(self):
+        self.closed += 1
+
+def test_cli_watch_connection_closed(monkeypatch):
+    import apc.session
+    from apc.cli_apc import run_watch
+    sessions = []
+    monkeypatch.setattr(apc.session, 'APCSession',
+                        lambda *args, **kwargs: sessions.append(ClosedSession()) or sessions[-1])
+    args = Namespace(host='pdu1', inventory=None, socket=None, user='apc', password='apc',
+                     verbose=False, cli=None, lock_dir=None, transport='telnet',
+                     no_breaker=True, deadline=None, max_interval=None)
+    with pytest.raises(SystemExit) as e:
+        run_watch(args)
+    assert str(e.value) == 'ERROR: Connection to pdu1 closed'
+    assert sessions[0].closed == 1